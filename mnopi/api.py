@@ -1,6 +1,8 @@
+import copy
 import datetime
 import urlparse
 import json
+from collections import Counter
 
 from tastypie import fields, http
 from tastypie.http import HttpCreated
@@ -13,21 +15,84 @@ from tastypie.utils import trailing_slash, dict_strip_unicode_keys
 
 from django.conf.urls import url
 from django.contrib.auth import authenticate
+from django.db import transaction
 from django.utils.timezone import utc
 from django.core.validators import URLValidator, validate_email
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 
-from mnopi.models import User, PageVisited, Search, ClientSession, CategorizedDomain, Client
+from mnopi.models import User, PageVisited, Search, ClientSession, Client, sessions_cache, \
+    clients_cache, is_signed_session_token, load_signed_session_token, revoke_signed_session_token, \
+    revoked_session_tokens
 from mnopi import constants
 from mnopi import opendns
 from mnopi import models_mongo
 
 
-#TODO: poner un borrado de sessions de vez en cuando?
-
 def get_user_id_from_resource(user_resource):
     return user_resource.rsplit("/", 2)[-2]
 
+def get_request_client(request):
+    """
+    Gets the client of the session used in an authenticated request
+    The client is looked up only once per request
+    """
+    if not hasattr(request, 'mnopi_client'):
+        user, request.mnopi_client, expiration_time = get_session(request.META['HTTP_SESSION_TOKEN'])
+
+    return request.mnopi_client
+
+def get_session(session_token):
+    """
+    Returns the tuple (user, client, expiration time) of a session token, or None if there
+    is no such session. Signed tokens are checked without querying client_sessions
+
+    The user and client are copies owned by the caller. When the session is cached they are
+    loaded from the database up to SESSIONS_CACHE_TTL_SECONDS before, so their fields may be
+    stale by that time
+    """
+    # Sessions are cached with the id of their token if it is signed, None otherwise
+    cached_session = sessions_cache.get(session_token)
+    if cached_session is not None:
+        session, token_id = cached_session
+        # Tokens revoked in other workers are still in the cache of this one
+        if token_id is not None and token_id in revoked_session_tokens:
+            sessions_cache.delete(session_token)
+            return None
+        return copy.deepcopy(session)
+
+    token_id = None
+    if is_signed_session_token(session_token):
+        signed_session = load_signed_session_token(session_token)
+        if signed_session is None:
+            return None
+        try:
+            session = (User.objects.get(pk=signed_session['user_id']),
+                       clients_cache.get_by_pk(signed_session['client_id']),
+                       signed_session['expiration_time'])
+        except ObjectDoesNotExist:
+            return None
+        token_id = signed_session['token_id']
+    else:
+        try:
+            client_session = ClientSession.objects.select_related('user', 'client').get(session_token=session_token)
+        except ClientSession.DoesNotExist:
+            return None
+        session = (client_session.user, client_session.client, client_session.expiration_time)
+
+    # Requests running at the same time must not share the instances
+    sessions_cache.set(session_token, (copy.deepcopy(session), token_id))
+    return session
+
+def end_session(session_token):
+    """
+    Ends a session, whatever the kind of its token
+    """
+    if is_signed_session_token(session_token):
+        revoke_signed_session_token(session_token)
+    else:
+        # Deleting the session invalidates its cache entry
+        ClientSession.objects.filter(session_token=session_token).delete()
+
 class MnopiUserAuthentication(Authentication):
     """
     Basic API authentication which requires the user resource and the session token in the header
@@ -42,19 +107,53 @@ class MnopiUserAuthentication(Authentication):
 
         session_token = request.META['HTTP_SESSION_TOKEN']
 
-        try:
-            session = ClientSession.objects.get(session_token=session_token)
-        except ClientSession.DoesNotExist:
+        session = get_session(session_token)
+        if session is None:
             return False
 
-        if session.expiration_time < datetime.datetime.utcnow().replace(tzinfo=utc):
-            session.delete()
+        user, client, expiration_time = session
+        if expiration_time < datetime.datetime.utcnow().replace(tzinfo=utc):
+            end_session(session_token)
             return False
 
-        request.user = session.user
+        request.user = user
+        request.mnopi_client = client
 
         return True
 
+class IngestionContext(object):
+    """
+    Entities needed to register the data sent by a client in an authenticated request
+    Each one is loaded only once per request, no matter how many objects are registered
+    """
+
+    def __init__(self, request):
+        self.user = request.user
+        self.client = get_request_client(request)
+        self.domains = {}
+
+    def get_domain(self, url):
+        """
+        Returns the tuple (categorized domain, categories) for the domain of an url
+        """
+        url_domain = urlparse.urlparse(url)[1]
+        if url_domain not in self.domains:
+            self.domains[url_domain] = opendns.get_categorized_domain(url_domain)
+
+        return self.domains[url_domain]
+
+    def lock_pending_domains(self):
+        """
+        Locks the domains read pending of categorization until the end of the transaction,
+        taking the categories of those resolved meanwhile. Called before saving their visits
+        """
+        resolved_categories = opendns.lock_pending_domains([categorized_domain for categorized_domain, categories
+                                                            in self.domains.values()])
+        for url_domain, (categorized_domain, categories) in self.domains.items():
+            if categorized_domain.pk in resolved_categories:
+                categorized_domain.pending = False
+                self.domains[url_domain] = (categorized_domain, resolved_categories[categorized_domain.pk])
+
 class UserObjectsOnlyAuthorization(Authorization):
     """
     Allows users to read or create only their data
@@ -68,10 +167,10 @@ class UserObjectsOnlyAuthorization(Authorization):
         return bundle.obj.user == bundle.request.user
 
     def create_list(self, object_list, bundle):
-        return bundle.request.user == UserResource().get_via_uri(bundle.data['user'])
+        return bundle.data.get('user') == UserResource().get_resource_uri(bundle.request.user)
 
     def create_detail(self, object_list, bundle):
-        return bundle.request.user == UserResource().get_via_uri(bundle.data['user'])
+        return bundle.data.get('user') == UserResource().get_resource_uri(bundle.request.user)
 
     def update_list(self, object_list, bundle):
         raise Unauthorized("Update not possible")
@@ -212,7 +311,7 @@ class UserResource(ModelResource):
         client = data.get('client', '')
 
         try:
-            client = Client.objects.get(client_name=client)
+            client = clients_cache.get(client)
         except Client.DoesNotExist:
             return response_err("CLIENT_ERROR")
 
@@ -226,16 +325,15 @@ class UserResource(ModelResource):
 
         if renew:
             # Use key as session_token for the user, give a new session key
-            try:
-                session = ClientSession.objects.get(session_token=key, user=user)
-            except ClientSession.DoesNotExist:
+            session = get_session(key)
+            if session is None or session[0].pk != user.pk:
                 return response_err("UNEXPECTED_SESSION")
 
-            if session.expiration_time < datetime.datetime.utcnow().replace(tzinfo=utc):
-                session.delete()
+            if session[2] < datetime.datetime.utcnow().replace(tzinfo=utc):
+                end_session(key)
                 return response_err("UNEXPECTED_SESSION")
             else:
-                session.delete()
+                end_session(key)
                 session_token = user.new_session(client)
 
                 return self.create_response(request, {
@@ -257,6 +355,19 @@ class UserResource(ModelResource):
             else:
                 return response_err("INCORRECT_USER_PASSWORD")
 
+    def logout(self, request, **kwargs):
+        """
+        Ends the session used in the request
+        """
+        self.method_check(request, allowed=['post'])
+        # Users can be listed and created without a session, but logging out requires it
+        if not MnopiUserAuthentication().is_authenticated(request):
+            raise ImmediateHttpResponse(response=http.HttpUnauthorized())
+
+        end_session(request.META['HTTP_SESSION_TOKEN'])
+
+        return self.create_response(request, {'result': "OK"})
+
 class PageVisitedValidation(Validation):
 
     DATE_FORMAT_ACCEPTED = "%Y-%m-%d %H:%M:%S"
@@ -276,7 +387,7 @@ class PageVisitedValidation(Validation):
 
         val = URLValidator()
         try:
-            val(bundle.data['url'])
+            val(bundle.data.get('url', ''))
         except ValidationError, e:
             errors['url'] = "Must be a valid URL"
 
@@ -316,7 +427,10 @@ class PageVisitedResource(ModelResource):
         return True
 
     def prepend_urls(self):
-        return [url(r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/categories%s$" %
+        return [url(r"^(?P<resource_name>%s)/batch%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('add_pages_visited'), name="pages_visited_batch"),
+                url(r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/categories%s$" %
                 (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('page_categories'), name="page_categories")]
 
@@ -342,28 +456,95 @@ class PageVisitedResource(ModelResource):
         self.authorized_create_detail(None, bundle)
 
         url = data.get('url', '')
-        user_resource = data.get('user', '')
         date = data.get('date', '')
         html_code = data.get('html_code', '')
-        session_token = request.META['HTTP_SESSION_TOKEN']
 
-        user = User.objects.get(pk=int(get_user_id_from_resource(user_resource)))
+        # The user posted is the authenticated one, as authorization was granted
+        context = IngestionContext(request)
         html_id = ""
         if html_code:
             # Automatic keywords mining is performed when creating the object
-            html_id = models_mongo.register_html_visited(page_visited=url, html_code=html_code, user=user.username)
+            html_id = models_mongo.register_html_visited(page_visited=url, html_code=html_code,
+                                                         user=context.user.username)
+
+        # The domain is categorized out of the transaction, so OpenDNS is not queried holding it open
+        context.get_domain(url)
+        with transaction.commit_on_success():
+            context.lock_pending_domains()
+            categorized_domain, categories = context.get_domain(url)
+            PageVisited.objects.create(user=context.user, page_visited=url, domain=categorized_domain,
+                                       client=context.client, date=date, html_ref=html_id)
+            context.user.add_user_categories_visits(dict.fromkeys(categories, 1))
 
-        # TODO: refactor maybe?
-        url_domain = urlparse.urlparse(url)[1]
-        categories = opendns.getCategories(url_domain)
-        categorized_domain = CategorizedDomain.objects.get(domain=url_domain)
+        return self.create_response(request, '', HttpCreated) #TODO: try to send empty data instead of ""
 
-        client = ClientSession.objects.get(session_token=session_token).client
-        PageVisited.objects.create(user=user, page_visited=url, domain=categorized_domain,
-                                   client=client, date=date, html_ref=html_id)
-        user.update_categories_visited(categories)
+    def add_pages_visited(self, request, **kwargs):
+        """
+        Registers a batch of pages visited in a single request, so clients can send
+        the visits they have buffered without doing a request for each one
+
+        The request data is of the form {"objects": [page_visited_1, page_visited_2, ...]}
+        where each page visited has the same parameters as in a single post.
+        The user and client are resolved once for the whole batch. Every page is validated
+        separately and the response gives a result for each one, in the same order:
+            {"objects": [{"result": "OK"},
+                         {"result": "ERR", "reason": "BAD_PARAMETERS", "erroneous_parameters": {...}},
+                         {"result": "ERR", "reason": "UNAUTHORIZED"}, ...]}
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
 
-        return self.create_response(request, '', HttpCreated) #TODO: try to send empty data instead of ""
+        data = self.deserialize(request, request.body)
+        pages = data.get('objects') if isinstance(data, dict) else None
+        if not isinstance(pages, list) or len(pages) > constants.PAGES_VISITED_BATCH_MAX_SIZE:
+            raise ImmediateHttpResponse(response=self.error_response(request, {
+                'result': 'ERR',
+                'reason': 'BAD_PARAMETERS',
+                'erroneous_parameters': {'objects': "Must be a list of at most %d pages" %
+                                                    constants.PAGES_VISITED_BATCH_MAX_SIZE}
+            }))
+
+        context = IngestionContext(request)
+        user_resource = UserResource().get_resource_uri(context.user)
+
+        results = []
+        valid_pages = []
+        for page in pages:
+            if not isinstance(page, dict):
+                results.append({'result': 'ERR', 'reason': 'BAD_PARAMETERS'})
+                continue
+
+            bundle = self.build_bundle(data=dict_strip_unicode_keys(page), request=request)
+            if not self.is_valid(bundle):
+                results.append(bundle.errors)
+            elif page.get('user', '') != user_resource:
+                results.append({'result': 'ERR', 'reason': 'UNAUTHORIZED'})
+            else:
+                results.append({'result': 'OK'})
+                valid_pages.append(page)
+
+        # Each domain is categorized once, no matter how many pages of the batch belong to it
+        pages_visited = []
+        for page in valid_pages:
+            html_id = ""
+            if page.get('html_code', ''):
+                html_id = models_mongo.register_html_visited(page_visited=page['url'], html_code=page['html_code'],
+                                                             user=context.user.username)
+
+            categorized_domain, categories = context.get_domain(page['url'])
+            pages_visited.append(PageVisited(user=context.user, page_visited=page['url'],
+                                             domain=categorized_domain,
+                                             client=context.client, date=page['date'], html_ref=html_id))
+
+        with transaction.commit_on_success():
+            context.lock_pending_domains()
+            categories_visits = Counter()
+            for page in valid_pages:
+                categories_visits.update(context.get_domain(page['url'])[1])
+            PageVisited.objects.bulk_create(pages_visited)
+            context.user.add_user_categories_visits(categories_visits)
+
+        return self.create_response(request, {'objects': results}, http.HttpAccepted)
 
     def page_categories(self, request, **kwargs):
         self.method_check(request, allowed=['get'])
@@ -405,7 +586,7 @@ class SearchQueryValidation(Validation):
 
         val = URLValidator()
         try:
-            val(bundle.data['search_results'])
+            val(bundle.data.get('search_results', ''))
         except ValidationError, e:
             errors['search_results'] = "Search results must be a valid URL"
 
@@ -442,11 +623,64 @@ class SearchQueryResource(ModelResource):
 
         return True
 
+    def prepend_urls(self):
+        return [url(r"^(?P<resource_name>%s)/bulk%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('add_search_queries'), name="search_queries_bulk")]
+
     def hydrate(self, bundle):
         #bundle.obj.user = UserResource().get_via_uri(bundle.data['user_resource'])
 
         # Get the client from the current session
-        bundle.obj.client = ClientSession.objects.get(
-            session_token=bundle.request.META['HTTP_SESSION_TOKEN']).client
+        bundle.obj.client = get_request_client(bundle.request)
 
-        return bundle
\ No newline at end of file
+        return bundle
+
+    def add_search_queries(self, request, **kwargs):
+        """
+        Registers a list of search queries in a single request and a single database write
+
+        The request data is of the form {"objects": [search_1, search_2, ...]}, each search being
+        {"search_query": ..., "search_results": ..., "date": ...}. Searches are always stored for the
+        authenticated user; a search for any other user makes the whole request unauthorized.
+        If any search is not valid none is saved, and the errors are given for each search, in order:
+            {"result": "ERR", "reason": "BAD_PARAMETERS",
+             "erroneous_parameters": [{}, {"search_query": "Not specified"}, ...]}
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+
+        data = self.deserialize(request, request.body)
+        searches = data.get('objects') if isinstance(data, dict) else None
+        if (not isinstance(searches, list) or len(searches) > constants.SEARCH_QUERIES_BULK_MAX_SIZE or
+                not all(isinstance(search, dict) for search in searches)):
+            raise ImmediateHttpResponse(response=self.error_response(request, {
+                'result': 'ERR',
+                'reason': 'BAD_PARAMETERS',
+                'erroneous_parameters': {'objects': "Must be a list of at most %d searches" %
+                                                    constants.SEARCH_QUERIES_BULK_MAX_SIZE}
+            }))
+
+        user_resource = UserResource().get_resource_uri(request.user)
+        if any(search.get('user', user_resource) != user_resource for search in searches):
+            raise ImmediateHttpResponse(response=http.HttpUnauthorized())
+
+        searches_errors = []
+        for search in searches:
+            bundle = self.build_bundle(data=dict_strip_unicode_keys(search), request=request)
+            searches_errors.append(self._meta.validation.is_valid(bundle, request))
+        if any(searches_errors):
+            raise ImmediateHttpResponse(response=self.error_response(request, {
+                'result': 'ERR',
+                'reason': 'BAD_PARAMETERS',
+                'erroneous_parameters': searches_errors
+            }))
+
+        client = get_request_client(request)
+        Search.objects.bulk_create([Search(search_query=search['search_query'],
+                                           search_results=search['search_results'],
+                                           date=search['date'],
+                                           user=request.user,
+                                           client=client) for search in searches])
+
+        return self.create_response(request, '', HttpCreated)
\ No newline at end of file
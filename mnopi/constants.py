@@ -5,6 +5,9 @@ Application customizable constants
 
 USER_KEYWORDS_NUMBER = 50
 WORD_MAX_LENGTH = 30
+STEMS_CACHE_MAX_SIZE = 100000 # Stems of the words kept in memory by every process
+KEYWORDS_VOCABULARY_CACHE_MAX_SIZE = 200000 # Ids of the keywords kept in memory by every process
+KEYWORDS_PROCESSING_BATCH_SIZE = 1000 # Pages whose keywords are added at once by the process_keywords command
 
 #
 # Dashboard constants
@@ -54,4 +57,78 @@ LOGIN_BAD_PASSWORD = "Contraseña incorrecta"
 #
 # Plugin related values
 #
-PLUGIN_SESSION_EXPIRY_DAYS = 30
\ No newline at end of file
+PLUGIN_SESSION_EXPIRY_DAYS = 30
+
+# Validated session tokens kept in memory by every worker, so authentication does not query the database
+SESSIONS_CACHE_MAX_SIZE = 10000
+SESSIONS_CACHE_TTL_SECONDS = 60 # Bounds the time other workers accept a session deleted elsewhere
+
+# Time after which every worker reloads the signed session tokens revoked by the others
+REVOKED_SESSION_TOKENS_REFRESH_SECONDS = 30
+
+# Expired sessions deleted at once by the purge_sessions command
+SESSIONS_PURGE_BATCH_SIZE = 1000
+
+# Maximum number of pages visited accepted in a single batch request
+PAGES_VISITED_BATCH_MAX_SIZE = 500
+
+# Maximum number of search queries accepted in a single bulk request
+SEARCH_QUERIES_BULK_MAX_SIZE = 500
+
+# Time after which every worker reloads the categories and clients, to notice the changes made by others
+REFERENCE_DATA_CACHE_TTL_SECONDS = 300
+REFERENCE_DATA_CACHE_MIN_RELOAD_SECONDS = 10 # Between the reloads caused by unknown categories or clients
+
+# Categorized domains kept in memory by every worker, in front of the optional shared cache
+DOMAINS_CACHE_MAX_SIZE = 50000
+DOMAINS_CACHE_TTL_SECONDS = 600
+
+# Domains saved at once by the load_domains command
+DOMAINS_LOAD_BATCH_SIZE = 5000
+
+#
+# OpenDNS queries
+#
+OPENDNS_TIMEOUT_SECONDS = 10
+OPENDNS_MAX_RETRIES = 3
+OPENDNS_RETRY_DELAY_SECONDS = 0.5 # Doubled on every new attempt
+OPENDNS_RESOLVE_BATCH_SIZE = 500 # Pending domains categorized and saved at once
+OPENDNS_FAILURE_BACKOFF_SECONDS = 3600 # Domains whose query failed are not queried again before. Doubled
+OPENDNS_FAILURE_BACKOFF_MAX_SECONDS = 7 * 24 * 3600 # on every new failure, up to this maximum
+
+# OpenDNS is not queried for OPENDNS_BREAKER_COOLDOWN_SECONDS when, having made at least
+# OPENDNS_BREAKER_MIN_REQUESTS in the last OPENDNS_BREAKER_WINDOW_SECONDS, this ratio of them failed
+OPENDNS_BREAKER_ERROR_RATE = 0.5
+OPENDNS_BREAKER_MIN_REQUESTS = 20
+OPENDNS_BREAKER_WINDOW_SECONDS = 60
+OPENDNS_BREAKER_COOLDOWN_SECONDS = 300
+
+# Time after which the categories of a domain are retrieved again, when it is visited
+DOMAIN_CATEGORIES_TTL_DAYS = 90
+
+#
+# Html mining queue
+#
+HTML_MINING_MAX_ATTEMPTS = 5
+HTML_MINING_RETRY_DELAY_SECONDS = 60 # Doubled on every new attempt
+HTML_MINING_LEASE_SECONDS = 600 # Time after which a page being processed is considered abandoned
+HTML_MINING_IDLE_SECONDS = 5 # Wait between checks of an empty queue when following it
+
+#
+# Html storage
+#
+HTML_COMPRESSION_LEVEL = 6 # zlib level, from 1 (fastest) to 9 (smallest)
+HTML_COMPRESSION_BATCH_SIZE = 500 # Documents compressed at once by the compress_html command
+
+#
+# Language detection
+#
+LANGUAGE_SAMPLE_LENGTH = 1000 # Characters of a page classified, taken from LANGUAGE_SAMPLE_CHUNKS
+LANGUAGE_SAMPLE_CHUNKS = 4 # places spread over its text
+LANGUAGE_CONFIDENCE_THRESHOLD = 0.95 # Probability from which a detection counts for the domain caches
+
+# Once this number of pages of a domain (or of a country code top level domain) in a row were
+# detected confidently in the same language, the rest are assumed to be in it too
+LANGUAGE_DOMAIN_MIN_PAGES = 3
+LANGUAGE_TLD_MIN_PAGES = 20
+LANGUAGE_CACHE_MAX_SIZE = 50000
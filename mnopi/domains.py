@@ -0,0 +1,128 @@
+"""
+Normalization of the hosts of the urls visited, and their registrable domain (eTLD+1)
+found with the public suffix list bundled in data/public_suffix_list.dat
+(https://publicsuffix.org/list/), so that no network access is needed
+"""
+import os
+import re
+import threading
+
+PUBLIC_SUFFIX_LIST_PATH = os.path.join(os.path.dirname(__file__), 'data', 'public_suffix_list.dat')
+
+IPV4_RE = re.compile(r'^\d{1,3}(\.\d{1,3}){3}$')
+
+# Keys of the trie nodes which can not be labels
+RULE = ''
+EXCEPTION = '!'
+WILDCARD = '*'
+
+
+def normalize_host(netloc):
+    """
+    Returns the host of the netloc of an url, lower-cased and without credentials, port
+    or trailing dot: 'User@WWW.Elpais.com:80' -> 'www.elpais.com'
+    """
+    host = netloc.rpartition('@')[2].strip().lower()
+    if host.startswith('['):
+        # IPv6 address, the port goes after the brackets
+        return host[:host.find(']') + 1]
+    return host.partition(':')[0].rstrip('.')
+
+class PublicSuffixTrie(object):
+    """
+    Rules of the public suffix list kept in a trie of nested dicts, keyed by the labels
+    of the rules from right to left. Finding the suffix of a host takes a dict lookup for
+    each of its labels
+    """
+
+    def __init__(self, rules):
+        self.root = {}
+        for rule in rules:
+            is_exception = rule.startswith(EXCEPTION)
+            if is_exception:
+                rule = rule[1:]
+            node = self.root
+            for label in reversed(rule.split('.')):
+                node = node.setdefault(label, {})
+            node[EXCEPTION if is_exception else RULE] = True
+
+    @classmethod
+    def from_file(cls, path=PUBLIC_SUFFIX_LIST_PATH):
+        return cls(read_public_suffix_rules(path))
+
+    def get_public_suffix_length(self, labels):
+        """
+        Returns the number of labels of the public suffix of the host given as its list
+        of labels. Hosts with an unknown top level domain have a suffix of one label
+        """
+        suffix_length = 1
+        node = self.root
+        for i, label in enumerate(reversed(labels)):
+            child = node.get(label)
+            if child is not None and EXCEPTION in child:
+                # Exception rules make the suffix their rule without its leftmost label
+                return i
+            if child is None:
+                child = node.get(WILDCARD)
+                if child is None:
+                    break
+            if RULE in child:
+                suffix_length = i + 1
+            node = child
+
+        return suffix_length
+
+    def get_registrable_domain(self, host):
+        """
+        Returns the public suffix of a normalized host plus the label before it:
+        'm.elpais.com' -> 'elpais.com', 'www.bbc.co.uk' -> 'bbc.co.uk'
+        None is returned for ip addresses and hosts which are a public suffix themselves
+        """
+        if not host or IPV4_RE.match(host) or host.startswith('['):
+            return None
+
+        labels = host.split('.')
+        suffix_length = self.get_public_suffix_length(labels)
+        if len(labels) <= suffix_length:
+            return None
+        return '.'.join(labels[-suffix_length - 1:])
+
+def read_public_suffix_rules(path):
+    """
+    Returns the rules of a public suffix list file. Internationalized rules are given
+    both in unicode and punycode, hosts may be written either way
+    """
+    rules = []
+    with open(path) as suffix_list:
+        for line in suffix_list:
+            rule = line.decode('utf-8').split()[0] if line.strip() else u''
+            if not rule or rule.startswith(u'//'):
+                continue
+            rules.append(rule)
+            try:
+                rule.encode('ascii')
+            except UnicodeEncodeError:
+                rules.append(u'.'.join(label.encode('idna').decode('ascii') for label in rule.split(u'.')))
+    return rules
+
+_public_suffix_trie = None
+_public_suffix_trie_lock = threading.Lock()
+
+def get_public_suffix_trie():
+    """ The trie of the bundled list, loaded on first use """
+    global _public_suffix_trie
+    if _public_suffix_trie is None:
+        with _public_suffix_trie_lock:
+            if _public_suffix_trie is None:
+                _public_suffix_trie = PublicSuffixTrie.from_file()
+    return _public_suffix_trie
+
+def get_registrable_domain(host):
+    return get_public_suffix_trie().get_registrable_domain(host)
+
+def roll_up_host(host):
+    """
+    Returns the name a normalized host is categorized with when it is new: its registrable
+    domain, or the host itself if it has none (ip addresses, public suffixes)
+    """
+    return get_registrable_domain(host) or host
@@ -0,0 +1,23 @@
+"""
+This command compresses the html code and clean text of the pages saved in
+MongoDB's htmlVisited collection before compressed storage was enabled
+"""
+from optparse import make_option
+
+import mnopi.models_mongo as models_mongo
+from mnopi import constants
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Compresses the html pages saved without compression'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=constants.HTML_COMPRESSION_BATCH_SIZE,
+                    help='Number of documents compressed at once'),
+    )
+
+    def handle(self, *args, **options):
+
+        compressed, size_before, size_after = models_mongo.compress_html_visited(options['batch_size'])
+        self.stdout.write("Pages compressed: %d (%d bytes to %d bytes)" % (compressed, size_before, size_after))
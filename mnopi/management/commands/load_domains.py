@@ -0,0 +1,81 @@
+"""
+This command loads into the domains tables the categories of the domains saved
+in a BSON dump of the old opendns.domains MongoDB collection, such as
+dump/opendns/domains.bson, so they are not queried again to OpenDNS
+"""
+from optparse import make_option
+import struct
+import time
+
+import bson
+
+from mnopi import opendns
+from mnopi import constants
+from mnopi.domains import normalize_host
+from django.core.management.base import BaseCommand, CommandError
+
+def read_bson_documents(bson_file):
+    """
+    Yields one by one the documents of a BSON dump, without reading the whole file
+    Every document starts with its length as a little endian int32, which includes itself
+    """
+    while True:
+        length_bytes = bson_file.read(4)
+        if not length_bytes:
+            return
+        if len(length_bytes) < 4:
+            raise CommandError("Truncated BSON file")
+
+        length = struct.unpack("<i", length_bytes)[0]
+        document = bson_file.read(length - 4)
+        if len(document) < length - 4:
+            raise CommandError("Truncated BSON file")
+
+        yield bson.BSON(length_bytes + document).decode()
+
+class Command(BaseCommand):
+    args = '<domains.bson>'
+    help = 'Loads the categories of the domains of an OpenDNS BSON dump'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=constants.DOMAINS_LOAD_BATCH_SIZE,
+                    help='Number of domains saved at once'),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Usage: load_domains %s" % self.args)
+
+        start = time.time()
+        repeated, invalid = 0, 0
+        totals = [0, 0, 0] # Domains added, skipped and unknown categories ignored
+
+        with open(args[0], 'rb') as bson_file:
+            batch = {}
+            for document in read_bson_documents(bson_file):
+                domain = document.get('domain')
+                if not domain:
+                    continue
+                # Saved as the hosts visited are looked up
+                domain = normalize_host(domain) if isinstance(domain, basestring) else ''
+                if not opendns.is_valid_domain(domain):
+                    invalid += 1
+                    continue
+                if domain in batch:
+                    repeated += 1
+                    continue
+
+                batch[domain] = document.get('categories', [])
+                if len(batch) >= options['batch_size']:
+                    totals = [x + y for x, y in zip(totals, opendns.add_categorized_domains(batch))]
+                    batch = {}
+
+            if batch:
+                totals = [x + y for x, y in zip(totals, opendns.add_categorized_domains(batch))]
+
+        added, skipped, unknown_categories = totals
+        skipped += repeated
+        self.stdout.write("Domains added: %d, skipped: %d, invalid: %d, unknown categories ignored: %d "
+                          "(%.1f domains/s)" % (added, skipped, invalid, unknown_categories,
+                                                (added + skipped + invalid) / max(time.time() - start, 0.001)))
@@ -0,0 +1,101 @@
+"""
+This command mines the html pages waiting in the mining queue of MongoDB's
+htmlVisited collection. Clients get their html saved immediately and the heavy
+processing (cleaning, language detection, keywords frequency) is done here,
+off the request path
+"""
+from optparse import make_option
+from multiprocessing import Pool
+import time
+
+import mnopi.models_mongo as models_mongo
+from mnopi.mnopimining import language
+from mnopi import constants
+from django.core.management.base import BaseCommand
+
+
+def drain_mining_queue(worker_id, forked=False, follow=False):
+    """
+    Mines pages until the queue is empty (or forever if follow is set)
+    Returns the tuple (pages mined, pages to be retried, pages failed, languages classified,
+    languages known from the domain)
+    """
+    if forked:
+        models_mongo.reconnect()
+
+    mined, retried, failed = 0, 0, 0
+    language_stats = dict(language.detection_stats)
+    while True:
+        page = models_mongo.claim_html_visited()
+        if page is None:
+            if not follow:
+                break
+            time.sleep(constants.HTML_MINING_IDLE_SECONDS)
+            continue
+
+        try:
+            models_mongo.mine_html_visited(page)
+            mined += 1
+        except Exception, e:
+            if models_mongo.fail_html_visited(page, "%s: %s" % (type(e).__name__, e)):
+                retried += 1
+            else:
+                failed += 1
+
+    return (mined, retried, failed,
+            language.detection_stats['classified'] - language_stats['classified'],
+            language.detection_stats['cached'] - language_stats['cached'])
+
+def _drain_mining_queue_forked(args):
+    return drain_mining_queue(*args)
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Mines the html pages waiting in the mining queue'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=1,
+                    help='Number of worker processes mining pages'),
+        make_option('--follow', action='store_true', default=False,
+                    help='Keep waiting for new pages when the queue is empty'),
+        make_option('--stats', action='store_true', default=False,
+                    help='Only show the number of pages in the queue'),
+        make_option('--requeue-failed', action='store_true', default=False,
+                    help='Queue again the pages whose mining failed before mining'),
+    )
+
+    def show_stats(self):
+        stats = models_mongo.get_mining_queue_stats()
+        self.stdout.write("Queue: %(pending)d pending (%(ready)d ready), %(processing)d processing, "
+                          "%(failed)d failed" % stats)
+        stats = models_mongo.get_html_content_stats()
+        self.stdout.write("Different html saved: %(contents)d, mining results reused: %(hits)d, "
+                          "html mined: %(misses)d (hit rate %(hit_rate).2f)" % stats)
+
+    def handle(self, *args, **options):
+
+        if options['stats']:
+            self.show_stats()
+            return
+
+        models_mongo.ensure_mining_queue_index()
+        if options['requeue_failed']:
+            self.stdout.write("Failed pages queued again: %d" % models_mongo.requeue_failed_html_visited())
+
+        start = time.time()
+        processes = max(options['processes'], 1)
+        if processes == 1:
+            results = [drain_mining_queue(0, follow=options['follow'])]
+        else:
+            pool = Pool(processes)
+            try:
+                results = pool.map(_drain_mining_queue_forked,
+                                   [(worker_id, True, options['follow']) for worker_id in range(processes)])
+            finally:
+                pool.terminate()
+
+        mined, retried, failed, classified, cached = [sum(x) for x in zip(*results)]
+        self.stdout.write("Pages mined: %d, to be retried: %d, failed: %d (%.1f pages/s)" %
+                          (mined, retried, failed, mined / max(time.time() - start, 0.001)))
+        self.stdout.write("Languages classified: %d, known from the domain: %d" % (classified, cached))
+        self.show_stats()
@@ -4,31 +4,25 @@ MongoDB's htmlVisited tables. The keywords are added to the user profiles,
 which are recorded in keywords SQL tables, so they are easily accessed when
 needed
 """
+from optparse import make_option
+import time
+
 import mnopi.models_mongo as models_mongo
+from mnopi import constants
 from django.core.management.base import BaseCommand
 
 class Command(BaseCommand):
     args = ''
     help = 'Adds not processed keywords from html pages into user profiles'
 
-    def handle(self, *args, **options):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=constants.KEYWORDS_PROCESSING_BATCH_SIZE,
+                    help='Number of pages whose keywords are added at once'),
+    )
 
-        def add_frequencies(from_dict, to_dict):
-            for keyword in from_dict:
-                if keyword in to_dict:
-                    to_dict[keyword] += from_dict[keyword]
-                else:
-                    to_dict[keyword] = from_dict[keyword]
+    def handle(self, *args, **options):
 
-        users_keywords = models_mongo.get_non_processed_keywords()
-        # Each page reports a set of metadata and site keywords for the user who visited it
-        i = 0
-        for user_keywords in users_keywords:
-            print i
-            i += 1
-            current_user_keywords = models_mongo.get_user_keywords(user_keywords['user'])
-            add_frequencies(from_dict=user_keywords['site_keywords_freq'],
-                            to_dict=current_user_keywords['site_keywords_freq'])
-            add_frequencies(from_dict=user_keywords['metadata_keywords_freq'],
-                            to_dict=current_user_keywords['metadata_keywords_freq'])
-            models_mongo.set_users_keywords(current_user_keywords)
\ No newline at end of file
+        start = time.time()
+        processed, users_updated = models_mongo.add_non_processed_keywords(options['batch_size'])
+        self.stdout.write("Pages processed: %d, users updated: %d (%.1f pages/s)" %
+                          (processed, users_updated, processed / max(time.time() - start, 0.001)))
@@ -0,0 +1,27 @@
+"""
+This command deletes the expired plugin sessions, which otherwise are only
+deleted when a client presents them, and the revoked signed tokens that have
+expired as well
+"""
+from optparse import make_option
+import time
+
+from mnopi.models import purge_expired_sessions
+from mnopi import constants
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Deletes the expired sessions'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=constants.SESSIONS_PURGE_BATCH_SIZE,
+                    help='Number of sessions deleted at once'),
+    )
+
+    def handle(self, *args, **options):
+
+        start = time.time()
+        sessions, revoked_tokens = purge_expired_sessions(options['batch_size'])
+        self.stdout.write("Sessions deleted: %d, revoked tokens deleted: %d (%.1f sessions/s)" %
+                          (sessions, revoked_tokens, sessions / max(time.time() - start, 0.001)))
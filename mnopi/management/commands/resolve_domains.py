@@ -0,0 +1,82 @@
+"""
+This command categorizes with OpenDNS the domains saved as pending when they
+were first visited, adding their categories to the users who visited them.
+Domains can also be given in a file, one per line, to categorize them before
+they are visited. With --refresh, the domains whose categories expired are
+categorized again instead, applying the changes to the users who visited them
+"""
+from optparse import make_option
+import time
+
+from mnopi import opendns
+from mnopi import constants
+from mnopi.domains import normalize_host, roll_up_host
+from django.core.management.base import BaseCommand
+
+def read_domains(domains_file, batch_size):
+    """
+    Yields the domains of a file, one per line, in lists of batch_size domains
+    They are given with the names new domains get when they are visited
+    """
+    batch = []
+    for line in domains_file:
+        domain = line.strip()
+        if not domain or domain.startswith("#"):
+            continue
+        domain = roll_up_host(normalize_host(domain.decode('utf-8')))
+        if not opendns.is_valid_domain(domain):
+            continue
+        batch.append(domain)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Categorizes the domains waiting to be categorized'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=None,
+                    help='Maximum number of domains to categorize'),
+        make_option('--file', default=None,
+                    help='File with the domains to categorize, one per line, instead of the pending ones'),
+        make_option('--threads', type='int', default=1,
+                    help='Number of concurrent queries to OpenDNS'),
+        make_option('--rate', type='float', default=None,
+                    help='Maximum number of queries to OpenDNS per second'),
+        make_option('--refresh', action='store_true', default=False,
+                    help='Categorize again the domains whose categories expired instead of the pending ones'),
+    )
+
+    def handle(self, *args, **options):
+
+        start = time.time()
+        threads = max(options['threads'], 1)
+        if options['file']:
+            resolved, failed = 0, 0
+            with open(options['file']) as domains_file:
+                for domains in read_domains(domains_file, constants.OPENDNS_RESOLVE_BATCH_SIZE):
+                    # Domains of the file already categorized are skipped
+                    opendns.add_pending_domains(domains)
+                    batch_resolved, batch_failed = opendns.resolve_pending_domains(domains=domains, threads=threads,
+                                                                                    rate=options['rate'])
+                    resolved += batch_resolved
+                    failed += batch_failed
+        elif options['refresh']:
+            resolved, failed = opendns.refresh_domains(limit=options['limit'], threads=threads,
+                                                       rate=options['rate'])
+        else:
+            resolved, failed = opendns.resolve_pending_domains(limit=options['limit'], threads=threads,
+                                                               rate=options['rate'])
+
+        self.stdout.write("Domains categorized: %d, failed: %d (%.1f domains/s)" %
+                          (resolved, failed, (resolved + failed) / max(time.time() - start, 0.001)))
+
+        stats = opendns.get_stats()
+        if stats['circuit_breaker']['open']:
+            self.stdout.write("OpenDNS queries stopped for %d seconds, too many of them failed" %
+                              constants.OPENDNS_BREAKER_COOLDOWN_SECONDS)
+        self.stdout.write("OpenDNS queries: %(successes)d succeeded, %(failures)d failed, %(rejected)d not made "
+                          "(circuit breaker opened %(trips)d times)" % stats['circuit_breaker'])
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'CategorizedDomain.pending'
+        db.add_column('domains', 'pending',
+                      self.gf('django.db.models.fields.BooleanField')(default=False),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'CategorizedDomain.pending'
+        db.delete_column('domains', 'pending')
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'mnopi.categorizeddomain': {
+            'Meta': {'object_name': 'CategorizedDomain', 'db_table': "'domains'"},
+            'categories': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['mnopi.UserCategory']", 'symmetrical': 'False'}),
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'pending': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        u'mnopi.client': {
+            'Meta': {'object_name': 'Client'},
+            'allowed': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'client_name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        u'mnopi.clientsession': {
+            'Meta': {'object_name': 'ClientSession', 'db_table': "'client_sessions'"},
+            'client': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.Client']"}),
+            'expiration_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2026, 11, 17, 0, 0)'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'session_token': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.User']"})
+        },
+        u'mnopi.pagevisited': {
+            'Meta': {'object_name': 'PageVisited', 'db_table': "'pages_visited'"},
+            'client': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.Client']"}),
+            'date': ('django.db.models.fields.DateTimeField', [], {}),
+            'domain': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.CategorizedDomain']"}),
+            'html_ref': ('django.db.models.fields.CharField', [], {'max_length': '24'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'page_visited': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.User']"})
+        },
+        u'mnopi.search': {
+            'Meta': {'object_name': 'Search', 'db_table': "'searches'"},
+            'client': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.Client']"}),
+            'date': ('django.db.models.fields.DateTimeField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'search_query': ('django.db.models.fields.CharField', [], {'max_length': '300'}),
+            'search_results': ('django.db.models.fields.CharField', [], {'max_length': '500'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.User']"})
+        },
+        u'mnopi.user': {
+            'Meta': {'object_name': 'User', 'db_table': "'users'"},
+            'categories': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['mnopi.UserCategory']", 'through': u"orm['mnopi.UserCategorization']", 'symmetrical': 'False'}),
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'mnopi.usercategorization': {
+            'Meta': {'object_name': 'UserCategorization', 'db_table': "'user_categorization'"},
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.UserCategory']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['mnopi.User']"}),
+            'weigh': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'mnopi.usercategory': {
+            'Meta': {'object_name': 'UserCategory', 'db_table': "'user_categories'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'taxonomy': ('django.db.models.fields.CharField', [], {'max_length': '10'})
+        }
+    }
+
+    complete_apps = ['mnopi']
\ No newline at end of file
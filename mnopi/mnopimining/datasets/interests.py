@@ -1,11 +1,10 @@
-from nltk.stem.snowball import SnowballStemmer
+from mnopi.mnopimining.keywords import stem_word
 
 def stem_dictionary_keys(d, language='english'):
     """
     Stems the keys in a dictionary whose keys are words
     """
-    stemmer = SnowballStemmer(language)
-    return {stemmer.stem(k): v for (k, v) in d.items()}
+    return {stem_word(k, language): v for (k, v) in d.items()}
 
 
 BUY_INTENTION_WORDS_ES = {
@@ -1,47 +1,61 @@
+from HTMLParser import HTMLParser
 import re
 
 RELEVANT_META_PROPERTIES = ["keywords",
                             "description"]
 
-def get_html_metadata(html_code):
+def _any_case(word):
+    """ Regular expression matching a word in any case, much faster than the IGNORECASE flag """
+    return "".join("[%s%s]" % (char.lower(), char.upper()) for char in word)
+
+# Everything which is not text of the page, as removed by nltk.clean_html: scripts, styles,
+# comments and tags. Tags not starting with s, the most, are tried first
+NOT_TEXT_RE = re.compile(r"<(?:[a-rt-zA-RT-Z/][^>]*>"
+                         r"|%(script)s\b.*?</%(script)s\s*>"
+                         r"|%(style)s\b.*?</%(style)s\s*>"
+                         r"|!--.*?-->"
+                         r"|[sS!?][^>]*>)" % {'script': _any_case("script"), 'style': _any_case("style")}, re.S)
+HEAD_PROPERTIES_RE = re.compile(r"<(?:%(meta)s\b([^>]*)>|%(title)s\b[^>]*>(.*?)</%(title)s\s*>)" %
+                                {'meta': _any_case("meta"), 'title': _any_case("title")}, re.S)
+ATTRIBUTE_RE = re.compile(r"""([^\s=/>]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""")
+HEAD_END_RE = re.compile(r"</%s\s*>" % _any_case("head"))
+
+# unescape does not use the state of the parser
+unescape = HTMLParser().unescape
+
+def get_html_features(html_code):
     """
-    Process html code and returns a dictionary of relevant properties
-    from meta and other tags
-    """
-    properties_list = {}
+    Process html code and returns the tuple (clean text, dictionary of relevant properties)
 
-    # Retrieve important meta properties
-    meta_tags = re.findall("<meta.*?>", html_code)
-    for tag in meta_tags:
-        relevant_tag = match_relevant_meta(tag)
-        if relevant_tag:
-            properties_list[relevant_tag[0]] = relevant_tag[1]
-
-    # Title of page
-    title_match = re.search("<title>(.*)</title>", html_code)
-    if title_match:
-        title = title_match.groups()[0]
-        properties_list["title"] = title
+    The text is got in a single pass which removes everything but it, and the properties
+    from the head of the page. Html entities are only unescaped in the text found, not in
+    the whole html code
+    """
+    text = NOT_TEXT_RE.sub(" ", html_code)
+    if "&" in text:
+        text = unescape(text)
+    text = " ".join(text.split())
 
-    return properties_list
+    return text, get_head_properties(html_code)
 
-def match_relevant_meta(meta_tag):
+def get_head_properties(html_code):
     """
-    Return tuples (name, content) of relevant meta properties
-    <meta name="description" content="Fancy webpage" -> ("description", "Fancy webpage")
+    Returns a dictionary of the title and relevant meta properties in the head of the
+    page (or the whole page if it has no head)
     """
-    for tag in RELEVANT_META_PROPERTIES:
-        name_matcher = re.compile("name.*?\"(.*?)\"")
-        match = name_matcher.search(meta_tag)
-        if match:
-            meta_name = match.groups()[0]
-
-            # Check if the type of meta data is of our interest
-            if meta_name == tag:
-                content_matcher = re.compile("content.*?\"(.*?)\"")
-                match = content_matcher.search(meta_tag)
-                meta_content = match.groups()[0]
+    head_end = HEAD_END_RE.search(html_code)
+    head = html_code[:head_end.start()] if head_end else html_code
 
-                return (meta_name, meta_content)
+    properties_list = {}
+    for match in HEAD_PROPERTIES_RE.finditer(head):
+        meta_attributes, title = match.groups()
+        if meta_attributes is not None:
+            attributes = dict((name.lower(), double_quoted or single_quoted or unquoted) for
+                              name, double_quoted, single_quoted, unquoted in ATTRIBUTE_RE.findall(meta_attributes))
+            name = attributes.get("name", "").lower()
+            if name in RELEVANT_META_PROPERTIES and "content" in attributes:
+                properties_list[name] = unescape(attributes["content"])
+        elif "title" not in properties_list:
+            properties_list["title"] = " ".join(unescape(title).split())
 
-    return None
\ No newline at end of file
+    return properties_list
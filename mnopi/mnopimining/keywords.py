@@ -5,11 +5,39 @@ from nltk.corpus import stopwords
 from nltk.stem.snowball import SnowballStemmer
 from nltk import FreqDist
 
+import re
 import string
-from mnopi.constants import WORD_MAX_LENGTH
+import unicodedata
+from django.conf import settings
+from mnopi.constants import WORD_MAX_LENGTH, STEMS_CACHE_MAX_SIZE
+from mnopi.utils import LRUCache
+from language import LANGUAGE_NAMES
 
 REMOVE_PUNCTUATION_MAPPING = dict.fromkeys(map(ord, string.punctuation))
-SPANISH_STOPWORDS_UNICODE = [unicode(word, 'utf-8') for word in stopwords.words('spanish')]
+
+# The regex tokenizer splits words on spaces and on the punctuation that word_tokenize splits
+# them on, and removes the rest of punctuation. Unlike word_tokenize, english contractions are
+# not split (don't -> dont)
+SEPARATORS_RE = re.compile(r'[;@#$%&?!()\[\]{}<>"]|[,:](?!\d)')
+PUNCTUATION_RE = re.compile('[%s]' % re.escape(string.punctuation))
+
+def fold_accents(word):
+    """
+    Removes the accents of a word: u'está' -> u'esta'
+    """
+    return u"".join(char for char in unicodedata.normalize('NFKD', word) if not unicodedata.combining(char))
+
+def build_stopwords(words):
+    """
+    Returns the frozenset of the stopwords given plus their variants without accents,
+    as they are often written
+    """
+    words = [word if isinstance(word, unicode) else unicode(word, 'utf-8') for word in words]
+    return frozenset(words) | frozenset(fold_accents(word) for word in words)
+
+# Stopwords of every language detected, built once
+STOPWORDS = dict((language, build_stopwords(stopwords.words(language))) for language in LANGUAGE_NAMES.values())
+ALL_STOPWORDS = frozenset().union(*STOPWORDS.values())
 
 def remove_punctuation(tokens):
     """
@@ -31,17 +59,9 @@ def remove_punctuation(tokens):
 def clean_stopwords(words, language='english'):
     """
     Removes stopwords from a list of words
+    The stopwords of every language detected are removed, pages often mix them
     """
-    no_stop_words = []
-    for word in words:
-
-        # TODO: For the moment only English and Spanish words are deleted. Points to be reviewed:
-        #    - Spanish stopwords without tildes (bad written)
-        if (not word in stopwords.words('english') and
-        not word in SPANISH_STOPWORDS_UNICODE):
-            no_stop_words.append(word)
-
-    return no_stop_words
+    return [word for word in words if word not in ALL_STOPWORDS]
 
 def clean_invalid_words(words):
     """
@@ -54,41 +74,73 @@ def clean_invalid_words(words):
 
     return valid_words
 
+# Stemmers are built once per language, and the stems of the words seen kept, as the same
+# words are stemmed again and again
+stemmers = {}
+stems_cache = LRUCache(STEMS_CACHE_MAX_SIZE) # (language, word) -> stem
+
+def get_stemmer(language):
+    stemmer = stemmers.get(language)
+    if stemmer is None:
+        stemmer = stemmers[language] = SnowballStemmer(language)
+    return stemmer
+
+def stem_word(word, language='english'):
+    """
+    Returns the stem of a word
+    """
+    key = (language, word)
+    stem = stems_cache.get(key)
+    if stem is None:
+        stem = get_stemmer(language).stem(word)
+        stems_cache.set(key, stem)
+    return stem
+
 def stem_words(words, language='english'):
     """
     Stems words in a list of words
     """
-    stemmer = SnowballStemmer(language)
-    stemmed_words = []
-    for word in words:
-        stemmed_words.append(stemmer.stem(word))
+    return [stem_word(word, language) for word in words]
 
-    return stemmed_words
+def tokenize(text, tokenizer=None):
+    """
+    Returns the tuple (tokens of a text, whether they are lowercased and without punctuation)
+    They are got with NLTK's word_tokenize or, if the tokenizer given (or the KEYWORDS_TOKENIZER
+    setting) is 'regex', with a few regular expressions over the whole text, much faster
+    """
+    if (tokenizer or getattr(settings, 'KEYWORDS_TOKENIZER', 'nltk')) == 'regex':
+        return PUNCTUATION_RE.sub('', SEPARATORS_RE.sub(' ', text.lower())).split(), True
+    return word_tokenize(text), False
 
-def get_words(text, stem=False, language='english'):
+def iter_words(text, stem=False, language='english', tokenizer=None):
     """
-    Given a text, it returns a list of stemmed and cleaned words
-    Steps: - Tokenize words
-           - Remove punctuation
-           - Clean stopwords
+    Given a text, it yields its cleaned (and stemmed if stem = True) words
+    Every token goes through all the steps at once, without intermediate lists:
+           - Lowercase and remove punctuation
+           - Clean stopwords and invalid words
            - (if stem = True) Stem words using stemmer
     """
+    tokens, cleaned = tokenize(text, tokenizer)
+    punctuation, stop_words, max_length = REMOVE_PUNCTUATION_MAPPING, ALL_STOPWORDS, WORD_MAX_LENGTH
+    for token in tokens:
+        word = token if cleaned else token.lower().translate(punctuation)
+        if len(word) < 2 or len(word) > max_length or word in stop_words or word.isdigit():
+            continue
+        yield stem_word(word, language) if stem else word
 
-    tokenized_words = word_tokenize(text)
-    lower_tokenized_words = [token.lower() for token in tokenized_words]
-    no_punct_words = remove_punctuation(lower_tokenized_words)
-    no_stop_words = clean_stopwords(no_punct_words, language)
-    valid_words = clean_invalid_words(no_stop_words)
-    if stem:
-        stemmed_words = stem_words(valid_words, language)
-        return stemmed_words
-    else:
-        return valid_words
+def get_words(text, stem=False, language='english', tokenizer=None):
+    """
+    Given a text, it returns a list of stemmed and cleaned words
+    """
+    return list(iter_words(text, stem, language, tokenizer))
 
-def get_freq_words(text, language='english'):
+def get_freq_words(text, language='english', tokenizer=None):
     """
     Given a text, it a FreqDist of processed words
+    The words are counted as they are found, and the FreqDist built from the counts
     """
-    words = get_words(text, stem=False, language=language)
-    return FreqDist(words)
-
+    counts = {}
+    get_count = counts.get
+    for word in iter_words(text, language=language, tokenizer=tokenizer):
+        counts[word] = get_count(word, 0) + 1
+    return FreqDist(counts)
@@ -1,32 +1,116 @@
+import urlparse
+
 import langid
+from langid.langid import LanguageIdentifier
 # TODO: ojo con licencia
 
+from mnopi import constants
+from mnopi.domains import get_registrable_domain, normalize_host
+from mnopi.utils import LRUCache
+
 LANGUAGE_NAMES =\
 {
     "es": "spanish",
     "en": "english"
 }
+DEFAULT_LANGUAGE = "en"
+
+# Language most pages of a country code top level domain are written in
+TLD_HINTS = ("es", "mx", "ar", "co", "cl", "pe", "ve", "uy", "ec", "bo", "py", "cr", "do", "gt", "hn", "ni",
+             "pa", "sv", "cu", "uk", "us", "au", "ie", "nz", "ca", "za", "in")
 
+# Counters of the pages whose language was classified or taken from the domain caches
+detection_stats = {'classified': 0, 'cached': 0}
 
-def detect_language(text):
+_identifier = None
+
+def get_identifier():
+    """
+    langid identifier restricted to the languages processed, with probabilities
+    normalized so that they can be compared with the confidence threshold
     """
-    Detects the language used in a given text.
-    It returns a language identifier, which can be one of the following:
+    global _identifier
+    if _identifier is None:
+        identifier = LanguageIdentifier.from_modelstring(langid.langid.model, norm_probs=True)
+        identifier.set_languages(LANGUAGE_NAMES.keys())
+        _identifier = identifier
+    return _identifier
 
-       af, am, an, ar, as, az, be, bg, bn, br, bs, ca, cs, cy, da, de, dz, el, en,
-       eo, es, et, eu, fa, fi, fo, fr, ga, gl, gu, he, hi, hr, ht, hu, hy, id, is,
-       it, ja, jv, ka, kk, km, kn, ko, ku, ky, la, lb, lo, lt, lv, mg, mk, ml, mn,
-       mr, ms, mt, nb, ne, nl, nn, no, oc, or, pa, pl, ps, pt, qu, ro, ru, rw, se,
-       si, sk, sl, sq, sr, sv, sw, ta, te, th, tl, tr, ug, uk, ur, vi, vo, wa, xh,
-       zh, zu
+def get_text_sample(text, length=None, chunks=None):
+    """
+    Returns at most length characters of a text, taken from chunks places spread over it,
+    so that a long menu at the beginning of a page does not decide its language
+    """
+    length = length or constants.LANGUAGE_SAMPLE_LENGTH
+    chunks = chunks or constants.LANGUAGE_SAMPLE_CHUNKS
+    if len(text) <= length or chunks < 2:
+        return text[:length]
+
+    chunk_length = length // chunks
+    step = (len(text) - chunk_length) // (chunks - 1)
+    return " ".join(text[i * step:i * step + chunk_length] for i in range(chunks))
+
+class LanguageCache(object):
+    """
+    Language of the pages of a domain, known once min_pages pages in a row were detected in it
+    A page detected in another language starts the count again
+    """
+
+    def __init__(self, min_pages, max_size=None):
+        self.min_pages = min_pages
+        self._entries = LRUCache(max_size or constants.LANGUAGE_CACHE_MAX_SIZE) # key -> (language, pages)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] >= self.min_pages:
+            return entry[0]
+        return None
+
+    def add(self, key, language):
+        entry = self._entries.get(key)
+        pages = entry[1] + 1 if entry is not None and entry[0] == language else 1
+        self._entries.set(key, (language, pages))
+
+    def clear(self):
+        self._entries.clear()
+
+domains_languages = LanguageCache(constants.LANGUAGE_DOMAIN_MIN_PAGES)
+tlds_languages = LanguageCache(constants.LANGUAGE_TLD_MIN_PAGES)
+
+def get_url_cache_keys(url):
+    """
+    Returns the tuple (registrable domain, country code top level domain hint) of an url
+    Any of them can be None
+    """
+    if not url:
+        return None, None
+    host = normalize_host(urlparse.urlparse(url)[1])
+    domain = get_registrable_domain(host)
+    if domain is None:
+        return None, None
+    tld = domain.rpartition('.')[2]
+    return domain, tld if tld in TLD_HINTS else None
+
+def detect_language(text, url=None):
+    """
+    Detects the language used in a given text, one of LANGUAGE_NAMES
 
+    Only a sample of the text is classified. If the url of the page is given and the
+    language of its domain (or of its top level domain) is known, the text is not
+    classified at all
     """
+    domain, tld = get_url_cache_keys(url)
+    for cache, key in ((domains_languages, domain), (tlds_languages, tld)):
+        lang = cache.get(key) if key else None
+        if lang is not None:
+            detection_stats['cached'] += 1
+            return LANGUAGE_NAMES[lang]
 
-    # TODO: Eval performance, quiza sea mejor utilizar en algunos casos la url de la web si esta disponible (en plan .es)
-    # TODO: otra opcion es utilizar solamente una pequenya parte del texto
+    lang, confidence = get_identifier().classify(get_text_sample(text))
+    detection_stats['classified'] += 1
+    if confidence >= constants.LANGUAGE_CONFIDENCE_THRESHOLD:
+        for cache, key in ((domains_languages, domain), (tlds_languages, tld)):
+            if key:
+                cache.add(key, lang)
 
-    lang = langid.classify(text)[0]
-    if lang in LANGUAGE_NAMES:
-        return LANGUAGE_NAMES[lang]
-    else:
-        return LANGUAGE_NAMES['en']
\ No newline at end of file
+    return LANGUAGE_NAMES.get(lang, LANGUAGE_NAMES[DEFAULT_LANGUAGE])
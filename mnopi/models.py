@@ -1,19 +1,25 @@
 from django.db import models
 
-from django.db.models.signals import pre_save
+from django.db.models import Count, F
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.db import connection
 from django.contrib.auth.models import AbstractUser
+from django.core import signing
+from django.conf import settings
 from django.utils.timezone import utc
 
 from nltk import FreqDist
 
 import datetime
+import calendar
+import time
 import os
 import base64
 
 import models_mongo
 import constants
+from utils import LRUCache, ModelCache, TwoTierCache
 
 # TODO: Documentar modelo
 # Ojo, hay una redundandia en el modelo entre las categorias de las paginas visitadas y el peso de cada
@@ -21,12 +27,14 @@ import constants
 
 PASSWORD_MAX_LENGTH = 100
 URL_MAX_LENGTH = 500
+DOMAIN_MAX_LENGTH = 255 # Indexable as unique by MySQL with utf8
 SEARCH_QUERY_MAX_LENGTH = 300
 CATEGORY_MAX_LENGTH = 50
 TAXONOMY_MAX_LENGTH = 10
 KEYWORD_MAX_LENGTH = 50
 CLIENT_MAX_LENGTH = 50
 MONGO_DB_ID_LENGTH = 24
+SIGNED_TOKEN_ID_LENGTH = 16
 
 METADATA_KEYWORD = 1
 SITE_KEYWORD = 2
@@ -150,13 +158,50 @@ class User(AbstractUser):
         """
         Updates the number of visits to categories for a given user
         """
-        database_categories = [UserCategory.objects.get(name=cat) for cat in categories]
-        for cat in database_categories:
-            categorization, created = \
-                UserCategorization.objects.get_or_create(user=self, category=cat,
-                                                         defaults={'weigh': 0})
-            categorization.weigh += 1
-            categorization.save()
+        self.add_categories_visits(dict.fromkeys(categories, 1))
+
+    def add_categories_visits(self, categories_visits):
+        """
+        Adds a number of visits to each category for a given user
+        Receives a dict of the form {"News/Media": 3, "Sports": 1, ...}
+        """
+        user_categories_visits = {}
+        for name, visits in categories_visits.items():
+            try:
+                user_categories_visits[user_categories_cache.get(name)] = visits
+            except UserCategory.DoesNotExist:
+                pass
+        self.add_user_categories_visits(user_categories_visits)
+
+    def add_user_categories_visits(self, categories_visits):
+        """
+        Adds a number of visits to each category for a given user
+        Receives a dict of UserCategory objects and visits {<UserCategory>: 3, ...}
+        Visits can be negative to take them away, but only from categories already visited
+
+        The number of queries does not depend on the number of categories, only on
+        the number of different visits values
+        """
+        if not categories_visits:
+            return
+
+        categories_ids = [cat.pk for cat in categories_visits]
+        existing_ids = set(UserCategorization.objects.filter(user=self, category__in=categories_ids)
+                                                     .values_list('category_id', flat=True))
+
+        # Categories with the same number of visits are updated at once
+        existing_by_visits = {}
+        for cat, visits in categories_visits.items():
+            if cat.pk in existing_ids:
+                existing_by_visits.setdefault(visits, []).append(cat.pk)
+        for visits, ids in existing_by_visits.items():
+            UserCategorization.objects.filter(user=self, category__in=ids).update(weigh=F('weigh') + visits)
+
+        new_categorizations = [UserCategorization(user=self, category=cat, weigh=visits)
+                               for cat, visits in categories_visits.items()
+                               if cat.pk not in existing_ids and visits > 0]
+        if new_categorizations:
+            UserCategorization.objects.bulk_create(new_categorizations)
 
     def get_searches_done(self,
                           datetime_from=datetime.datetime.min,
@@ -172,27 +217,80 @@ class User(AbstractUser):
     def new_session(self, client):
         """
         Opens a new session for the user in the specified client
+
+        If SIGNED_SESSION_TOKENS is set the token is signed and carries the session data,
+        so it is not saved in the database
         """
+        if getattr(settings, 'SIGNED_SESSION_TOKENS', False):
+            return new_signed_session_token(self, client)
+
         session_token = base64.b64encode(os.urandom(32))
         ClientSession.objects.create(user=self, session_token=session_token, client=client)
 
         return session_token
 
 class CategorizedDomain(models.Model):
-    domain = models.CharField(max_length=URL_MAX_LENGTH)
+    domain = models.CharField(max_length=DOMAIN_MAX_LENGTH, unique=True)
     categories = models.ManyToManyField(UserCategory)
+    pending = models.BooleanField(default=False) # Categories not retrieved yet
+    last_checked = models.DateTimeField(null=True, blank=True) # Last time categories were retrieved
+    refresh = models.BooleanField(default=False) # Categories expired and waiting to be retrieved again
+    failures = models.IntegerField(default=0) # Consecutive failed queries to OpenDNS
+    retry_after = models.DateTimeField(null=True, blank=True) # Not queried again before, after failures
 
     class Meta:
         db_table = "domains"
 
+    def categories_expired(self):
+        """
+        Checks if the categories were retrieved more than DOMAIN_CATEGORIES_TTL_DAYS ago
+        """
+        if self.last_checked is None:
+            return True
+        expiration_time = self.last_checked + datetime.timedelta(days=constants.DOMAIN_CATEGORIES_TTL_DAYS)
+        return expiration_time < datetime.datetime.utcnow().replace(tzinfo=utc)
+
     def add_categories(self, categories):
         """
         Adds categories to a domain.
         For instance: add [News/Media, Technology] to 'www.cnn.com'
         """
-        database_categories = [UserCategory.objects.get(name=cat) for cat in categories]
-        for cat in database_categories:
-            self.categories.add(cat)
+        database_categories = [user_categories_cache.get(cat) for cat in categories]
+        self.categories.add(*database_categories)
+
+        return database_categories
+
+    def add_visitors_categories_visits(self, categories, removed_categories=()):
+        """
+        Adds to every user who visited the domain one visit to each category for every page
+        of the domain visited, and takes them away from each removed category. Used to catch up
+        with the visits received while the domain was waiting to be categorized, and to apply
+        the changes of the categories of a domain when they are retrieved again
+        """
+        if not categories and not removed_categories:
+            return
+
+        visits_by_user = PageVisited.objects.filter(domain=self).values('user').annotate(visits=Count('id'))
+        visits_by_user = dict((x['user'], x['visits']) for x in visits_by_user)
+        for user in User.objects.filter(pk__in=visits_by_user.keys()):
+            categories_visits = dict.fromkeys(categories, visits_by_user[user.pk])
+            categories_visits.update(dict.fromkeys(removed_categories, -visits_by_user[user.pk]))
+            user.add_categories_visits(categories_visits)
+
+# Categorized domains: domain -> (domain id, categories ids). Pending domains are not cached
+domains_cache = TwoTierCache("mnopi.domains.", constants.DOMAINS_CACHE_MAX_SIZE,
+                             ttl=constants.DOMAINS_CACHE_TTL_SECONDS,
+                             shared_cache_alias=getattr(settings, 'DOMAINS_SHARED_CACHE', None))
+
+@receiver(post_save, sender=CategorizedDomain)
+@receiver(post_delete, sender=CategorizedDomain)
+def invalidate_cached_domain(sender, instance, **kwargs):
+    domains_cache.delete(instance.domain)
+
+@receiver(m2m_changed, sender=CategorizedDomain.categories.through)
+def invalidate_cached_domain_categories(sender, instance, **kwargs):
+    if isinstance(instance, CategorizedDomain):
+        domains_cache.delete(instance.domain)
 
 class UserCategorization(models.Model):
     user = models.ForeignKey(User)
@@ -213,6 +311,22 @@ class Client(models.Model):
     #class Meta:
         #db_table = "clients" # TODO: Change name for consistency
 
+# Categories and clients by name, as they are looked up on every ingestion but almost never change
+user_categories_cache = ModelCache(UserCategory, 'name', ttl=constants.REFERENCE_DATA_CACHE_TTL_SECONDS,
+                                   min_reload=constants.REFERENCE_DATA_CACHE_MIN_RELOAD_SECONDS)
+clients_cache = ModelCache(Client, 'client_name', ttl=constants.REFERENCE_DATA_CACHE_TTL_SECONDS,
+                           min_reload=constants.REFERENCE_DATA_CACHE_MIN_RELOAD_SECONDS)
+
+@receiver(post_save, sender=UserCategory)
+@receiver(post_delete, sender=UserCategory)
+def invalidate_cached_user_categories(sender, **kwargs):
+    user_categories_cache.invalidate()
+
+@receiver(post_save, sender=Client)
+@receiver(post_delete, sender=Client)
+def invalidate_cached_clients(sender, **kwargs):
+    clients_cache.invalidate()
+
 class PageVisited(models.Model):
     user = models.ForeignKey(User)
     page_visited = models.CharField(max_length=URL_MAX_LENGTH)
@@ -242,11 +356,133 @@ def get_new_expiration_time(): # TODO : mover a un utils.py?
 class ClientSession(models.Model):
 
     user = models.ForeignKey(User)
-    expiration_time = models.DateTimeField(default=get_new_expiration_time)
-    session_token = models.CharField(max_length=128)
+    expiration_time = models.DateTimeField(default=get_new_expiration_time, db_index=True)
+    session_token = models.CharField(max_length=128, unique=True)
     client = models.ForeignKey(Client)
 
     # Note: At the moment, no checks are done that renew logins are made by the same client
 
     class Meta:
-        db_table = "client_sessions"
\ No newline at end of file
+        db_table = "client_sessions"
+
+def purge_expired_sessions(batch_size):
+    """
+    Deletes the expired sessions and the revoked tokens which have expired too, in batches
+    of batch_size rows so that tables are never locked for long
+
+    Returns the tuple (sessions deleted, revoked tokens deleted)
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=utc)
+    deleted = []
+    for model in (ClientSession, RevokedSessionToken):
+        model_deleted = 0
+        while True:
+            ids = list(model.objects.filter(expiration_time__lt=now).values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            model.objects.filter(id__in=ids).delete()
+            model_deleted += len(ids)
+        deleted.append(model_deleted)
+
+    return tuple(deleted)
+
+# Sessions already validated by this process: session token -> ((user, client, expiration time), token id),
+# copied by api.get_session for every request
+sessions_cache = LRUCache(constants.SESSIONS_CACHE_MAX_SIZE, ttl=constants.SESSIONS_CACHE_TTL_SECONDS)
+
+@receiver(post_save, sender=ClientSession)
+@receiver(post_delete, sender=ClientSession)
+def invalidate_cached_session(sender, instance, **kwargs):
+    sessions_cache.delete(instance.session_token)
+
+class RevokedSessionToken(models.Model):
+    """
+    Signed session tokens ended before their expiration time, by a logout or a renew
+    """
+    token_id = models.CharField(max_length=SIGNED_TOKEN_ID_LENGTH, unique=True)
+    expiration_time = models.DateTimeField(db_index=True) # Not needed anymore after it
+
+    class Meta:
+        db_table = "revoked_session_tokens"
+
+class RevokedSessionTokens(object):
+    """
+    Ids of the revoked signed session tokens not expired yet, kept in memory by every worker
+
+    It is reloaded from the database every refresh_seconds, so every worker learns the
+    revocations made by the others
+    """
+
+    def __init__(self, refresh_seconds):
+        self.refresh_seconds = refresh_seconds
+        self._token_ids = frozenset()
+        self._loaded_at = None
+
+    def refresh(self):
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        self._token_ids = frozenset(RevokedSessionToken.objects.filter(expiration_time__gte=now)
+                                                               .values_list('token_id', flat=True))
+        self._loaded_at = time.time()
+
+    def add(self, token_id):
+        self._token_ids = self._token_ids | frozenset([token_id])
+
+    def __contains__(self, token_id):
+        if self._loaded_at is None or time.time() - self._loaded_at > self.refresh_seconds:
+            self.refresh()
+        return token_id in self._token_ids
+
+revoked_session_tokens = RevokedSessionTokens(constants.REVOKED_SESSION_TOKENS_REFRESH_SECONDS)
+
+SIGNED_SESSION_SALT = "mnopi.session"
+
+def is_signed_session_token(session_token):
+    # Random tokens are base64 encoded, so they never contain the separator used by signed ones
+    return ':' in session_token
+
+def new_signed_session_token(user, client):
+    """
+    Returns a session token signed with the secret key which carries the user, the client
+    and the expiration time of the session
+    """
+    expiration_time = get_new_expiration_time()
+    return signing.dumps({'u': user.pk,
+                          'c': client.pk,
+                          'e': calendar.timegm(expiration_time.utctimetuple()),
+                          'n': base64.urlsafe_b64encode(os.urandom(SIGNED_TOKEN_ID_LENGTH * 3 / 4))},
+                         salt=SIGNED_SESSION_SALT)
+
+def load_signed_session_token(session_token):
+    """
+    Returns the session data of a signed token: a dict with user_id, client_id, expiration_time
+    and token_id. None is returned if the signature is not valid or the token was revoked
+    """
+    try:
+        data = signing.loads(session_token, salt=SIGNED_SESSION_SALT)
+    except signing.BadSignature:
+        return None
+
+    if data['n'] in revoked_session_tokens:
+        return None
+
+    return {
+        'user_id': data['u'],
+        'client_id': data['c'],
+        'expiration_time': datetime.datetime.utcfromtimestamp(data['e']).replace(tzinfo=utc),
+        'token_id': data['n']
+    }
+
+def revoke_signed_session_token(session_token):
+    """
+    Ends the session of a signed token. Other workers notice it when they reload their revoked tokens
+    Expired tokens are rejected anyway, so they are not saved
+    """
+    session = load_signed_session_token(session_token)
+    if session is None or session['expiration_time'] < datetime.datetime.utcnow().replace(tzinfo=utc):
+        sessions_cache.delete(session_token)
+        return
+
+    RevokedSessionToken.objects.get_or_create(token_id=session['token_id'],
+                                              defaults={'expiration_time': session['expiration_time']})
+    revoked_session_tokens.add(session['token_id'])
+    sessions_cache.delete(session_token)
\ No newline at end of file
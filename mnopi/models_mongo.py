@@ -1,54 +1,590 @@
 from mnopimining import html, keywords, language
 
 
-from HTMLParser import HTMLParser
+from array import array
 import datetime
-import nltk
+import hashlib
+import sys
+import zlib
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+from bson.binary import Binary
+from django.conf import settings
+
+import constants
+from utils import LRUCache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 db = MongoClient().mnopi # TODO: casque cuando no hay
 
+# States of the html pages in the mining queue
+MINING_PENDING = 'pending'
+MINING_PROCESSING = 'processing'
+MINING_DONE = 'done'
+MINING_FAILED = 'failed'
+
+# Fields of htmlVisited saved compressed when HTML_COMPRESSED_STORAGE is set
+COMPRESSED_FIELDS = ('html_code', 'clean_html')
+
+# Results of mining an html, memoized in htmlContent when HTML_DEDUPLICATION is set
+MINING_RESULT_FIELDS = ('properties', 'language', 'keywords_freq')
+
+# Fields of userKeywords, and the keywords_freq of htmlVisited added to them
+USER_KEYWORDS_FIELDS = {'site_keywords_freq': 'text', 'metadata_keywords_freq': 'metadata'}
+
+# Ids of the keywords vocabulary, and the ones of each keyword, kept in memory by every process
+keywords_ids_cache = LRUCache(constants.KEYWORDS_VOCABULARY_CACHE_MAX_SIZE)
+keywords_cache = LRUCache(constants.KEYWORDS_VOCABULARY_CACHE_MAX_SIZE)
+
+def reconnect():
+    """
+    Opens a new connection to the database
+    Connections must not be shared between processes, so it has to be called by forked workers
+    """
+    global db
+    db = MongoClient()[db.name]
+
 def register_html_visited(page_visited, user, html_code):
     """
     Saves an htmlVisited object in the database
+    If HTML_MINING_ASYNC is set, the html is saved raw and queued for mining, otherwise
+    it is mined before being saved
 
     Returns the _id ob the object created
     """
 
     html_visited = HtmlVisited(page_visited, html_code, user)
+    if getattr(settings, 'HTML_DEDUPLICATION', False):
+        return register_deduplicated_html_visited(html_visited)
+    if getattr(settings, 'HTML_MINING_ASYNC', False):
+        return enqueue_html_visited(html_visited)
+
     html_visited.process()
-    object_id = db.htmlVisited.insert(html_visited.__dict__)
+    object_id = db.htmlVisited.insert(html_visited.to_document())
     return object_id
 
+def hash_html(html_code):
+    """ Gets the hash which identifies an html in the htmlContent collection """
+    return hashlib.sha1(html_code.encode('utf-8')).hexdigest()
+
+def register_deduplicated_html_visited(html_visited):
+    """
+    Saves an htmlVisited object whose html is kept only once in the htmlContent collection,
+    identified by its hash, along with the results of mining it
+
+    The htmlVisited document references the html by its hash and has a copy of the mining
+    results, so they are obtained without mining the same html again
+
+    Returns the _id ob the object created
+    """
+    html_hash = hash_html(html_visited.html_code)
+    html_code = html_visited.html_code
+    if getattr(settings, 'HTML_COMPRESSED_STORAGE', False):
+        html_code = compress_text(html_code)
+    def add_visit(upsert):
+        return db.htmlContent.find_and_modify(
+            query={'_id': html_hash},
+            update={'$inc': {'visits': 1},
+                    '$setOnInsert': {'html_code': html_code, 'mined': False}},
+            fields=dict.fromkeys(COMPRESSED_FIELDS, 0),
+            upsert=upsert,
+            new=True)
+    try:
+        html_content = add_visit(upsert=True)
+    except DuplicateKeyError:
+        # Another first visit of the same html inserted it meanwhile
+        html_content = add_visit(upsert=False)
+
+    html_visited_document = {'page_visited': html_visited.page_visited,
+                             'user': html_visited.user,
+                             'date': html_visited.date,
+                             'html_hash': html_hash}
+    if html_content['mined']:
+        _count_html_content_lookup(hit=True)
+        html_visited_document.update((field, html_content[field]) for field in MINING_RESULT_FIELDS)
+    elif getattr(settings, 'HTML_MINING_ASYNC', False):
+        html_visited_document['mining'] = {'state': MINING_PENDING,
+                                           'attempts': 0,
+                                           'available_at': datetime.datetime.utcnow()}
+    else:
+        html_visited_document.update(mine_html_content(html_hash, html_visited.page_visited))
+
+    return db.htmlVisited.insert(html_visited_document)
+
+def mine_html_content(html_hash, page_visited=None):
+    """
+    Gets the results of mining an html of the htmlContent collection
+    The html is mined only if it was not mined before, as visited in the page given (its url
+    lets the language be known from its domain)
+
+    Returns a dict with the MINING_RESULT_FIELDS
+    """
+    html_content = db.htmlContent.find_one({'_id': html_hash})
+    if html_content['mined']:
+        _count_html_content_lookup(hit=True)
+        return dict((field, html_content[field]) for field in MINING_RESULT_FIELDS)
+
+    html_visited = HtmlVisited(page_visited, HtmlVisitedDocument(html_content)['html_code'], None)
+    html_visited.process()
+    _count_html_content_lookup(hit=False)
+
+    mining_results = dict((field, getattr(html_visited, field)) for field in MINING_RESULT_FIELDS)
+    clean_html = html_visited.clean_html
+    if getattr(settings, 'HTML_COMPRESSED_STORAGE', False):
+        clean_html = compress_text(clean_html)
+    db.htmlContent.update({'_id': html_hash},
+                          {'$set': dict(mining_results, clean_html=clean_html, mined=True)})
+    return mining_results
+
+def _count_html_content_lookup(hit):
+    db.counters.update({'_id': 'htmlContent'}, {'$inc': {'hits' if hit else 'misses': 1}}, upsert=True)
+
+def get_html_content_stats():
+    """
+    Gets the number of different html saved and how many times the results of mining an html
+    were reused (hits) instead of mining it (misses)
+    Returns a dict of the form
+              {'contents': 120, 'hits': 300, 'misses': 110, 'hit_rate': 0.73}
+    """
+    counters = db.counters.find_one({'_id': 'htmlContent'}) or {}
+    hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+    return {'contents': db.htmlContent.count(),
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.0}
+
+def compress_text(text):
+    """ Compresses a text to be saved as binary data """
+    return Binary(zlib.compress(text.encode('utf-8'), constants.HTML_COMPRESSION_LEVEL))
+
+def decompress_text(data):
+    """ Gets the text saved as binary data by compress_text """
+    return zlib.decompress(data).decode('utf-8')
+
+def compress_html_visited_document(html_visited_document):
+    """ Compresses the big fields of an htmlVisited document """
+    for field in COMPRESSED_FIELDS:
+        if isinstance(html_visited_document.get(field), basestring) and \
+                not isinstance(html_visited_document[field], Binary):
+            html_visited_document[field] = compress_text(html_visited_document[field])
+    html_visited_document['compressed'] = True
+
+class HtmlVisitedDocument(dict):
+    """
+    htmlVisited document read from the database
+    Compressed fields are decompressed only when they are accessed, as well as the fields
+    of documents whose html is kept in htmlContent are only then retrieved
+    """
+
+    def __getitem__(self, key):
+        if key in COMPRESSED_FIELDS and not key in self and 'html_hash' in self:
+            html_content = db.htmlContent.find_one({'_id': dict.__getitem__(self, 'html_hash')},
+                                                   dict.fromkeys(COMPRESSED_FIELDS, 1))
+            for field in COMPRESSED_FIELDS:
+                if html_content and field in html_content:
+                    self[field] = html_content[field]
+
+        value = dict.__getitem__(self, key)
+        if key in COMPRESSED_FIELDS and isinstance(value, Binary):
+            value = decompress_text(value)
+            self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+def enqueue_html_visited(html_visited):
+    """
+    Saves a not processed htmlVisited object, leaving it in the mining queue
+
+    Returns the _id ob the object created
+    """
+    html_visited_document = html_visited.to_document()
+    html_visited_document['mining'] = {'state': MINING_PENDING,
+                                       'attempts': 0,
+                                       'available_at': datetime.datetime.utcnow()}
+    return db.htmlVisited.insert(html_visited_document)
+
+def ensure_mining_queue_index():
+    """ Creates the index used to take pages from the mining queue """
+    db.htmlVisited.ensure_index([('mining.state', 1), ('mining.available_at', 1)])
+
+def claim_html_visited():
+    """
+    Takes the next html page available in the mining queue, marking it as being processed
+
+    Pages whose processing was started but not finished before HTML_MINING_LEASE_SECONDS
+    (for instance, because the worker died) are available again, unless they were already
+    claimed HTML_MINING_MAX_ATTEMPTS times: they are marked as failed, as they may be the
+    ones killing the workers.
+    Returns the htmlVisited document or None if the queue is empty
+    """
+    now = datetime.datetime.utcnow()
+    lease_end = now + datetime.timedelta(seconds=constants.HTML_MINING_LEASE_SECONDS)
+    db.htmlVisited.update({'mining.state': MINING_PROCESSING,
+                           'mining.available_at': {'$lte': now},
+                           'mining.attempts': {'$gte': constants.HTML_MINING_MAX_ATTEMPTS}},
+                          {'$set': {'mining.state': MINING_FAILED, 'mining.error': "Mining not finished"}},
+                          multi=True)
+    return db.htmlVisited.find_and_modify(
+        query={'mining.state': {'$in': [MINING_PENDING, MINING_PROCESSING]},
+               'mining.available_at': {'$lte': now},
+               'mining.attempts': {'$lt': constants.HTML_MINING_MAX_ATTEMPTS}},
+        update={'$set': {'mining.state': MINING_PROCESSING, 'mining.available_at': lease_end},
+                '$inc': {'mining.attempts': 1}},
+        sort=[('mining.available_at', 1)],
+        new=True)
+
+def mine_html_visited(html_visited_document):
+    """
+    Processes an html page taken from the mining queue and saves the features found
+    """
+    if 'html_hash' in html_visited_document:
+        mining_results = mine_html_content(html_visited_document['html_hash'],
+                                           html_visited_document['page_visited'])
+        db.htmlVisited.update({'_id': html_visited_document['_id']},
+                              {'$set': dict(mining_results, **{'mining.state': MINING_DONE}),
+                               '$unset': {'mining.error': 1}})
+        return
+
+    html_visited_document = HtmlVisitedDocument(html_visited_document)
+    html_visited = HtmlVisited(html_visited_document['page_visited'], html_visited_document['html_code'],
+                               html_visited_document['user'], html_visited_document['date'])
+    html_visited.process()
+    if getattr(settings, 'HTML_COMPRESSED_STORAGE', False):
+        clean_html = compress_text(html_visited.clean_html)
+    else:
+        clean_html = html_visited.clean_html
+    db.htmlVisited.update({'_id': html_visited_document['_id']},
+                          {'$set': {'clean_html': clean_html,
+                                    'properties': html_visited.properties,
+                                    'language': html_visited.language,
+                                    'keywords_freq': html_visited.keywords_freq,
+                                    'mining.state': MINING_DONE},
+                           '$unset': {'mining.error': 1}})
+
+def fail_html_visited(html_visited_document, error):
+    """
+    Returns an html page whose mining failed to the queue, to be retried later with an
+    exponential delay. After HTML_MINING_MAX_ATTEMPTS the page is marked as failed
+    (dead letter) and it is no longer retried
+
+    Returns True if the page will be retried
+    """
+    attempts = html_visited_document['mining']['attempts']
+    if attempts >= constants.HTML_MINING_MAX_ATTEMPTS:
+        db.htmlVisited.update({'_id': html_visited_document['_id']},
+                              {'$set': {'mining.state': MINING_FAILED, 'mining.error': error}})
+        return False
+
+    retry_delay = constants.HTML_MINING_RETRY_DELAY_SECONDS * 2 ** (attempts - 1)
+    db.htmlVisited.update({'_id': html_visited_document['_id']},
+                          {'$set': {'mining.state': MINING_PENDING,
+                                    'mining.available_at': datetime.datetime.utcnow() +
+                                                           datetime.timedelta(seconds=retry_delay),
+                                    'mining.error': error}})
+    return True
+
+def requeue_failed_html_visited():
+    """
+    Gives another chance to the pages whose mining failed
+    Returns the number of pages queued again
+    """
+    failed_pages = db.htmlVisited.find({'mining.state': MINING_FAILED}).count()
+    db.htmlVisited.update({'mining.state': MINING_FAILED},
+                          {'$set': {'mining.state': MINING_PENDING,
+                                    'mining.attempts': 0,
+                                    'mining.available_at': datetime.datetime.utcnow()}},
+                          multi=True)
+    return failed_pages
+
+def get_mining_queue_stats():
+    """
+    Gets the number of pages in each state of the mining queue
+    Returns a dict of the form
+              {'pending': 20, 'ready': 12, 'processing': 2, 'failed': 1}
+    'ready' being the pending pages that can be processed right now
+    """
+    now = datetime.datetime.utcnow()
+    return {
+        MINING_PENDING: db.htmlVisited.find({'mining.state': MINING_PENDING}).count(),
+        'ready': db.htmlVisited.find({'mining.state': MINING_PENDING,
+                                      'mining.available_at': {'$lte': now}}).count(),
+        MINING_PROCESSING: db.htmlVisited.find({'mining.state': MINING_PROCESSING}).count(),
+        MINING_FAILED: db.htmlVisited.find({'mining.state': MINING_FAILED}).count()
+    }
+
 def get_user_html_visited(user):
     """ Gets the complete html code history of an user """
-    return list(db.htmlVisited.find({'user': user}))
+    return [HtmlVisitedDocument(x) for x in db.htmlVisited.find({'user': user})]
+
+def _stored_size(html_visited_document):
+    """ Number of bytes taken by the compressible fields of an htmlVisited document """
+    size = 0
+    for field in COMPRESSED_FIELDS:
+        value = html_visited_document.get(field) or ""
+        size += len(value) if isinstance(value, Binary) else len(value.encode('utf-8'))
+    return size
+
+def compress_html_visited(batch_size):
+    """
+    Compresses the htmlVisited documents saved without compression, in batches of batch_size
+    documents. Pages being mined are skipped
+    Returns the tuple (documents compressed, bytes before compression, bytes after compression)
+    """
+    query = {'compressed': {'$exists': False}, 'mining.state': {'$ne': MINING_PROCESSING}}
+    fields = dict.fromkeys(COMPRESSED_FIELDS, 1)
+    compressed, size_before, size_after = 0, 0, 0
+    last_id = None
+    while True:
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(db.htmlVisited.find(query, fields).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+
+        bulk = db.htmlVisited.initialize_unordered_bulk_op()
+        for html_visited_document in batch:
+            object_id = html_visited_document.pop('_id')
+            size_before += _stored_size(html_visited_document)
+            compress_html_visited_document(html_visited_document)
+            size_after += _stored_size(html_visited_document)
+            bulk.find({'_id': object_id}).update({'$set': html_visited_document})
+        bulk.execute()
+
+        compressed += len(batch)
+        last_id = object_id
 
-def get_non_processed_keywords():
+    return compressed, size_before, size_after
+
+def get_keywords_ids(keywords):
     """
-    Retrieves list of keywords/frequency for every page not processed
-    The page is then marked as processed.
-    Returns a list of dictionaries of the form
-              {'user': 'alfredo',
-               'site_keywords_freq': {u'keyword_1': 2, u'keyword_2': 5 ...}
-               'metadata_keywords_freq: {u'keyword_1': 2, u'keyword_2': 5 ...}}
-    one for each html page
+    Returns a dict {keyword: id} with the ids of the keywords in the vocabulary kept in the
+    keywords collection. Keywords not in it are added
     """
-    not_processed_pages = db.htmlVisited.find({'processed': {'$exists': False}})
-    users_keywords = []
-    for not_processed_page in not_processed_pages:
-        users_keywords.append({'user': not_processed_page['user'],
-                              'site_keywords_freq': not_processed_page['keywords_freq']['text'],
-                              'metadata_keywords_freq': not_processed_page['keywords_freq']['metadata']})
-        not_processed_page['processed'] = True
-        db.htmlVisited.save(not_processed_page)
+    keywords_ids = {}
+    missing_keywords = []
+    for keyword in keywords:
+        keyword_id = keywords_ids_cache.get(keyword)
+        if keyword_id is None:
+            missing_keywords.append(keyword)
+        else:
+            keywords_ids[keyword] = keyword_id
+    if not missing_keywords:
+        return keywords_ids
 
-    return users_keywords
+    found_ids = dict((document['keyword'], document['_id']) for document in
+                     db.keywords.find({'keyword': {'$in': missing_keywords}}))
+    new_keywords = [keyword for keyword in missing_keywords if keyword not in found_ids]
+    if new_keywords:
+        db.keywords.ensure_index('keyword', unique=True)
+        last_id = db.counters.find_and_modify({'_id': 'keywords'}, {'$inc': {'last_id': len(new_keywords)}},
+                                              upsert=True, new=True)['last_id']
+        first_id = last_id - len(new_keywords) + 1
+        try:
+            db.keywords.insert([{'_id': first_id + i, 'keyword': keyword} for i, keyword in enumerate(new_keywords)],
+                               continue_on_error=True)
+        except DuplicateKeyError:
+            # Some of them were added meanwhile by another process, their ids are read below
+            pass
+        found_ids.update((document['keyword'], document['_id']) for document in
+                         db.keywords.find({'keyword': {'$in': new_keywords}}))
 
-def get_user_keywords(username):
+    for keyword, keyword_id in found_ids.iteritems():
+        keywords_ids_cache.set(keyword, keyword_id)
+        keywords_cache.set(keyword_id, keyword)
+    keywords_ids.update(found_ids)
+    return keywords_ids
+
+def get_keywords(keywords_ids):
+    """
+    Returns a dict {id: keyword} with the keywords of the vocabulary with the ids given
+    """
+    keywords = {}
+    missing_ids = []
+    for keyword_id in keywords_ids:
+        keyword = keywords_cache.get(keyword_id)
+        if keyword is None:
+            missing_ids.append(keyword_id)
+        else:
+            keywords[keyword_id] = keyword
+
+    if missing_ids:
+        for document in db.keywords.find({'_id': {'$in': missing_ids}}):
+            keywords_cache.set(document['_id'], document['keyword'])
+            keywords[document['_id']] = document['keyword']
+    return keywords
+
+def _pack_array(values):
+    """ Binary data of an array of unsigned 32 bit integers, little endian """
+    if numpy is not None:
+        return Binary(numpy.asarray(values, dtype='<u4').tostring())
+    values = array('I', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return Binary(values.tostring())
+
+def _unpack_array(data):
+    """ Array of unsigned 32 bit integers packed by _pack_array """
+    if numpy is not None:
+        return numpy.frombuffer(str(data), dtype='<u4')
+    values = array('I')
+    values.fromstring(str(data))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def is_packed_keywords_freq(keywords_freq):
+    return isinstance(keywords_freq.get('ids'), Binary)
+
+def pack_keywords_freq(keywords_freq):
+    """
+    Gets the compact form of a dict {keyword: frequency}: the ids of its keywords in the
+    vocabulary, sorted, and their frequencies, as parallel arrays of binary data
+        {'ids': Binary, 'counts': Binary}
+    """
+    if is_packed_keywords_freq(keywords_freq):
+        return keywords_freq
+    keywords_ids = get_keywords_ids(keywords_freq.keys())
+    ids_counts = sorted((keywords_ids[keyword], count) for keyword, count in keywords_freq.iteritems())
+    return _pack_ids_counts([keyword_id for keyword_id, count in ids_counts],
+                            [count for keyword_id, count in ids_counts])
+
+def _pack_ids_counts(ids, counts):
+    return {'ids': _pack_array(ids), 'counts': _pack_array(counts)}
+
+def _unpack_ids_counts(keywords_freq):
+    keywords_freq = pack_keywords_freq(keywords_freq)
+    return _unpack_array(keywords_freq['ids']), _unpack_array(keywords_freq['counts'])
+
+def unpack_keywords_freq(keywords_freq):
+    """
+    Gets the dict {keyword: frequency} of a keywords frequency saved by pack_keywords_freq
+    Dicts are returned as they are
+    """
+    if not is_packed_keywords_freq(keywords_freq):
+        return keywords_freq
+    ids, counts = _unpack_ids_counts(keywords_freq)
+    keywords = get_keywords([int(keyword_id) for keyword_id in ids])
+    return dict((keywords[keyword_id], int(count)) for keyword_id, count in zip(ids, counts))
+
+def add_keywords_freqs(*keywords_freqs):
+    """
+    Returns the sum of several keywords frequencies, each of them a dict or a packed one
+    The result is packed if KEYWORDS_COMPACT_STORAGE is set, so frequencies are added as
+    arrays, and a dict otherwise
+    """
+    if not getattr(settings, 'KEYWORDS_COMPACT_STORAGE', False):
+        total = {}
+        for keywords_freq in keywords_freqs:
+            for keyword, count in unpack_keywords_freq(keywords_freq).iteritems():
+                total[keyword] = total.get(keyword, 0) + count
+        return total
+
+    ids_counts = [_unpack_ids_counts(keywords_freq) for keywords_freq in keywords_freqs]
+    if numpy is not None:
+        all_ids, positions = numpy.unique(numpy.concatenate([ids for ids, counts in ids_counts]),
+                                          return_inverse=True)
+        all_counts = numpy.bincount(positions, weights=numpy.concatenate([counts for ids, counts in ids_counts]))
+        return _pack_ids_counts(all_ids, all_counts)
+
+    all_counts = {}
+    for ids, counts in ids_counts:
+        for keyword_id, count in zip(ids, counts):
+            all_counts[keyword_id] = all_counts.get(keyword_id, 0) + count
+    all_ids = sorted(all_counts)
+    return _pack_ids_counts(all_ids, [all_counts[keyword_id] for keyword_id in all_ids])
+
+def add_non_processed_keywords(batch_size):
+    """
+    Adds the keywords frequencies of the pages not processed yet to the ones of their users,
+    reading the pages in batches of batch_size. The frequencies of each batch are added up
+    by user in memory, and written with a bulk update of userKeywords before marking its
+    pages as processed with another update
+    Returns the tuple (pages processed, users updated)
+    """
+    # Pages still in the mining queue have no keywords yet
+    query = {'processed': {'$exists': False}, 'keywords_freq': {'$exists': True}}
+    processed, users_updated = 0, set()
+    last_id = None
+    while True:
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(db.htmlVisited.find(query, {'user': 1, 'keywords_freq': 1}).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+
+        users_keywords = {}
+        for page in batch:
+            user_keywords = users_keywords.setdefault(page['user'], dict((field, []) for field in USER_KEYWORDS_FIELDS))
+            for field, kind in USER_KEYWORDS_FIELDS.iteritems():
+                user_keywords[field].append(page['keywords_freq'][kind])
+
+        # If the bulk update fails, the pages are not processed and added again next time
+        add_users_keywords(users_keywords)
+        page_ids = [page['_id'] for page in batch]
+        db.htmlVisited.update({'_id': {'$in': page_ids}}, {'$set': {'processed': True}}, multi=True)
+
+        processed += len(batch)
+        users_updated.update(users_keywords)
+        last_id = page_ids[-1]
+
+    return processed, len(users_updated)
+
+def add_users_keywords(users_keywords):
+    """
+    Adds keywords frequencies to the ones of several users, given as
+        {'alfredo': {'site_keywords_freq': [keywords frequency, ...],
+                     'metadata_keywords_freq': [keywords frequency, ...]}, ...}
+    Dicts are added with $inc, without reading the frequencies saved. Packed ones, when
+    KEYWORDS_COMPACT_STORAGE is set or they were saved so, are added to the saved ones
+    """
+    if getattr(settings, 'KEYWORDS_COMPACT_STORAGE', False):
+        merged_users = set(users_keywords)
+    else:
+        merged_users = set(document['user'] for document in
+                           db.userKeywords.find({'user': {'$in': users_keywords.keys()}},
+                                                {'user': 1, 'site_keywords_freq.ids': 1})
+                           if is_packed_keywords_freq(document.get('site_keywords_freq', {})))
+    saved_keywords = {}
+    if merged_users:
+        saved_keywords = dict((document['user'], document) for document in
+                              db.userKeywords.find({'user': {'$in': list(merged_users)}}))
+
+    bulk = db.userKeywords.initialize_unordered_bulk_op()
+    for user, user_keywords in users_keywords.iteritems():
+        if user in merged_users:
+            saved = saved_keywords.get(user, {})
+            bulk.find({'user': user}).upsert().update({'$set': dict(
+                (field, add_keywords_freqs(saved.get(field, {}), *keywords_freqs))
+                for field, keywords_freqs in user_keywords.iteritems())})
+            continue
+
+        increments, empty_fields = {}, {}
+        for field, keywords_freqs in user_keywords.iteritems():
+            keywords_freq = add_keywords_freqs(*keywords_freqs)
+            if not keywords_freq:
+                empty_fields[field] = {}
+            for keyword, count in keywords_freq.iteritems():
+                increments[field + '.' + keyword] = count
+        update = {'$setOnInsert': empty_fields} if empty_fields else {}
+        if increments:
+            update['$inc'] = increments
+        bulk.find({'user': user}).upsert().update(update)
+    bulk.execute()
+
+def get_user_keywords(username, unpack=True):
     """
     Retrieves the dictionary of keywords/frequency stored for an user
+    Frequencies saved packed are unpacked, unless unpack is False
     """
     user_keywords = db.userKeywords.find_one({'user': username})
     if user_keywords == None:
@@ -56,6 +592,9 @@ def get_user_keywords(username):
                 'site_keywords_freq': {},
                 'metadata_keywords_freq': {}}
     else:
+        if unpack:
+            for field in ('site_keywords_freq', 'metadata_keywords_freq'):
+                user_keywords[field] = unpack_keywords_freq(user_keywords[field])
         return user_keywords
 
 
@@ -65,8 +604,11 @@ def set_users_keywords(user_keywords_document):
 
 def get_user_html_keywords_freqs(user):
     """ Retrieves list of keywords/frequency for each html saved in the database """
-    keywords_list = list(db.htmlVisited.find({'user': user}, {'_id': 0, 'keywords_freq': 1}))
-    keywords_list = [x['keywords_freq'] for x in keywords_list]
+    # Pages still in the mining queue have no keywords yet
+    keywords_list = list(db.htmlVisited.find({'user': user, 'keywords_freq': {'$exists': True}},
+                                             {'_id': 0, 'keywords_freq': 1}))
+    keywords_list = [dict((kind, unpack_keywords_freq(keywords_freq)) for kind, keywords_freq in
+                          x['keywords_freq'].iteritems()) for x in keywords_list]
     return keywords_list
 
 class HtmlVisited(object):
@@ -88,38 +630,38 @@ class HtmlVisited(object):
         else:
             self.date = date
 
+    def to_document(self):
+        """
+        Gets the document to be saved in the database
+        Big fields are compressed if HTML_COMPRESSED_STORAGE is set
+        """
+        html_visited_document = dict(self.__dict__)
+        if getattr(settings, 'HTML_COMPRESSED_STORAGE', False):
+            compress_html_visited_document(html_visited_document)
+        return html_visited_document
+
     def process(self):
         """
         Process html code and retrieves important features for data analysis
         """
-        self._clean_html_text()
-        self._process_properties()
+        self._extract_html_features()
         self._detect_language()
         self._process_keywords_freq()
 
-    def _clean_html_text(self):
-        """Computes the site clear text without html code"""
-
-        # Even in unicode, there could be html entities like &aocute
-        parser = HTMLParser()
-        unescaped_text = parser.unescape(self.html_code)
-
-        self.clean_html = nltk.clean_html(unescaped_text)
-
-    def _process_properties(self):
-        """Computes site properties from html metadata"""
-        parser = HTMLParser()
-        unescaped_text = parser.unescape(self.html_code)
-
-        self.properties = html.get_html_metadata(unescaped_text)
+    def _extract_html_features(self):
+        """Computes the site clear text without html code and its properties from html metadata"""
+        self.clean_html, self.properties = html.get_html_features(self.html_code)
 
     def _detect_language(self):
         """Detects the language of the page"""
-        self.language = language.detect_language(self.clean_html)
+        self.language = language.detect_language(self.clean_html, self.page_visited)
 
     def _process_keywords_freq(self):
-        """Gets distribution of keywords frequency"""
+        """Gets distribution of keywords frequency, packed if KEYWORDS_COMPACT_STORAGE is set"""
         self.keywords_freq = {
             'text': keywords.get_freq_words(self.clean_html, self.language),
             'metadata': keywords.get_freq_words(" ".join(self.properties.values()), self.language)
         }
+        if getattr(settings, 'KEYWORDS_COMPACT_STORAGE', False):
+            self.keywords_freq = dict((kind, pack_keywords_freq(keywords_freq)) for kind, keywords_freq in
+                                      self.keywords_freq.iteritems())
@@ -1,8 +1,22 @@
 from lxml import html
+from multiprocessing.pool import ThreadPool
 import urllib2 #TODO: pensar si viene mejor el modulo Request+
-from models import CategorizedDomain
+import urlparse
+import httplib
+import socket
+import threading
+import time
+import datetime
+from models import CategorizedDomain, UserCategory, DOMAIN_MAX_LENGTH, domains_cache, user_categories_cache
+from domains import normalize_host, roll_up_host
+from utils import CircuitBreaker, SingleFlight
+import constants
 from django.db import transaction
+from django.db.models import Q
+from django.conf import settings
+from django.utils.timezone import utc
 
+OPENDNS_DOMAIN_URL = "http://domain.opendns.com/" # Can be changed with the setting of the same name
 APPROVED_CATEGORIES_QUERY = "//td[text()=\"Approved\"]/parent::node()/td/b/text()"
 
 CATEGORIES = { "Academic Fraud": "Academic Fraud",
@@ -71,33 +85,478 @@ class OpenDNS_DOMException(Exception):
     """
     pass
 
+class OpenDNSUnavailable(Exception):
+    """
+    Exception that indicates that OpenDNS is not queried for a while because too many queries failed
+    """
+    pass
+
+# Errors reaching OpenDNS, which are retried and count as failures of the circuit breaker
+TRANSPORT_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+# Errors of a query to OpenDNS. Domains whose query fails are not queried again for a while
+LOOKUP_ERRORS = TRANSPORT_ERRORS + (OpenDNS_DOMException,)
+
+# Shared by every query of the process
+circuit_breaker = CircuitBreaker(error_rate=constants.OPENDNS_BREAKER_ERROR_RATE,
+                                 min_calls=constants.OPENDNS_BREAKER_MIN_REQUESTS,
+                                 window=constants.OPENDNS_BREAKER_WINDOW_SECONDS,
+                                 cooldown=constants.OPENDNS_BREAKER_COOLDOWN_SECONDS)
+
+# Lookups of domains whose query failed, answered without querying OpenDNS again
+negative_cache_stats = {'failed': 0, 'hits': 0}
+negative_cache_stats_lock = threading.Lock()
+
+def get_stats():
+    """
+    Returns a dict with the counters of failed lookups and of the circuit breaker
+    """
+    return {'lookups_failed': negative_cache_stats['failed'],
+            'negative_cache_hits': negative_cache_stats['hits'],
+            'circuit_breaker': circuit_breaker.stats()}
+
+def call_opendns(query):
+    """
+    Calls a function which queries OpenDNS through the circuit breaker
+    Raises OpenDNSUnavailable without calling it if the breaker is open
+    """
+    if not circuit_breaker.allow():
+        raise OpenDNSUnavailable()
+
+    try:
+        result = query()
+    except TRANSPORT_ERRORS:
+        circuit_breaker.record(failed=True)
+        raise
+    except OpenDNS_DOMException:
+        # OpenDNS answered, only the domain can not be categorized
+        circuit_breaker.record(failed=False)
+        raise
+    circuit_breaker.record(failed=False)
+    return result
+
+def get_failure_backoff(failures):
+    """
+    Returns the time to wait before querying again a domain whose queries failed failures times in a row
+    """
+    seconds = constants.OPENDNS_FAILURE_BACKOFF_SECONDS * 2 ** min(failures - 1, 30)
+    return datetime.timedelta(seconds=min(seconds, constants.OPENDNS_FAILURE_BACKOFF_MAX_SECONDS))
+
+def parse_categories(html_code):
+    """
+    Returns the list of categories approved in an OpenDNS domain page, adapted to our categories names
+    """
+    xmlTree = html.fromstring(html_code.replace("\n", "").replace("\t", ""))
+    approved_categories = xmlTree.xpath(APPROVED_CATEGORIES_QUERY)
+
+    # Check existence and adapt to our categories
+    for category in approved_categories:
+        if category not in CATEGORIES:
+            raise OpenDNS_DOMException()
+    return [CATEGORIES[cat] for cat in approved_categories]
+
+def fetch_categories(domain):
+    """
+    Queries OpenDNS for the categories of a domain
+    Returns the list of categories, adapted to our categories names
+    """
+    opendns_url = getattr(settings, 'OPENDNS_DOMAIN_URL', OPENDNS_DOMAIN_URL)
+    return call_opendns(lambda: parse_categories(
+        urllib2.urlopen(opendns_url + domain, timeout=constants.OPENDNS_TIMEOUT_SECONDS).read()))
+
+# Queries of domains not saved yet in flight in this process
+new_domains_queries = SingleFlight()
+
+def fetch_new_domain_categories(domain):
+    """
+    Queries OpenDNS for the categories of a domain not saved yet. When a domain starts being
+    visited by many users at once, the threads which ask for it while it is being queried wait
+    for that query instead of making their own
+    """
+    return new_domains_queries.do(domain, lambda: fetch_categories(domain))
+
+class OpenDNSClient(object):
+    """
+    Queries OpenDNS from several threads, each one through its own keep-alive connection
+
+    Requests of every thread are spaced so that no more than rate requests per second
+    (if given) are made, and the failed ones are retried waiting longer every time
+    """
+
+    def __init__(self, rate=None, max_retries=constants.OPENDNS_MAX_RETRIES,
+                 retry_delay=constants.OPENDNS_RETRY_DELAY_SECONDS):
+        opendns_url = urlparse.urlparse(getattr(settings, 'OPENDNS_DOMAIN_URL', OPENDNS_DOMAIN_URL))
+        self.host = opendns_url.netloc
+        self.path = opendns_url.path or "/"
+        self.rate = rate
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next_request_time = 0
+
+    def _wait_turn(self):
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = time.time()
+            request_time = max(now, self._next_request_time)
+            self._next_request_time = request_time + 1.0 / self.rate
+        time.sleep(request_time - now)
+
+    def _get_connection(self):
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = httplib.HTTPConnection(self.host, timeout=constants.OPENDNS_TIMEOUT_SECONDS)
+        return self._local.connection
+
+    def get_page(self, domain):
+        self._wait_turn()
+        connection = self._get_connection()
+        try:
+            connection.request("GET", self.path + domain)
+            response = connection.getresponse()
+            html_code = response.read()
+        except (httplib.HTTPException, socket.error):
+            # It will be opened again by the next request
+            connection.close()
+            raise
+
+        if response.status != httplib.OK:
+            raise urllib2.HTTPError(self.host + self.path + domain, response.status, response.reason,
+                                    response.msg, None)
+        return html_code
+
+    def fetch_categories(self, domain):
+        """
+        Queries OpenDNS for the categories of a domain
+        Returns the list of categories, adapted to our categories names
+        """
+        attempt = 0
+        while True:
+            try:
+                return call_opendns(lambda: parse_categories(self.get_page(domain)))
+            except TRANSPORT_ERRORS:
+                if attempt >= self.max_retries or circuit_breaker.is_open():
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+
+    def fetch_domains_categories(self, domains, threads=1):
+        """
+        Queries OpenDNS for the categories of several domains at once from a pool of threads
+        Yields tuples (domain, list of categories, error) as they are retrieved. The error is
+        the exception raised for the domains which could not be categorized, None otherwise
+        """
+        def fetch(domain):
+            try:
+                return domain, self.fetch_categories(domain), None
+            except LOOKUP_ERRORS + (OpenDNSUnavailable,), e:
+                return domain, None, e
+
+        pool = ThreadPool(threads)
+        try:
+            for result in pool.imap_unordered(fetch, domains):
+                yield result
+        finally:
+            pool.terminate()
+
 def getCategories(domain, add_if_does_not_exist=True):
     """
     Returns list of OpenDNS categories for a domain
+
+    If OPENDNS_ASYNC_CATEGORIZATION is set, a domain not seen before is saved as pending
+    and no categories are returned; it will be categorized later by resolve_pending_domains
+    """
+    categorized_domain, categories = get_categorized_domain(domain, add_if_does_not_exist)
+    return [cat.name for cat in categories]
+
+def get_categorized_domain(domain, add_if_does_not_exist=True):
+    """
+    Returns the tuple (categorized domain, list of UserCategory of the domain)
+    The categorized domain is None if it did not exist and add_if_does_not_exist is False
+
+    The host is normalized first. When it was not saved as it is, its registrable domain
+    (eTLD+1) is used instead, so www.elpais.com, m.elpais.com and elpais.com:80 are all
+    categorized as elpais.com
     """
+    domain = normalize_host(domain)
 
     # First, search domain in pre-fetched categories. If the domain was not previously saved, query OpenDns
-    # Transaction protects from other threads creating same domain
-    # Todo: habra que hacer algo para que con el tiempo se vuelva a hacer peticion a opendns
-    approved_categories = []
+    # Domains whose categories have expired are served as they are, and queued to be refreshed
+    # Hosts served by their registrable domain are cached as the name of that domain, so
+    # invalidating the domain invalidates them too
+    cached_domain_name = domain
+    cached_domain = domains_cache.get(domain)
+    if isinstance(cached_domain, basestring):
+        cached_domain_name = cached_domain
+        cached_domain = domains_cache.get(cached_domain_name)
+    if cached_domain is not None:
+        domain_id, categories_ids = cached_domain
+        return (CategorizedDomain(id=domain_id, domain=cached_domain_name),
+                [user_categories_cache.get_by_pk(category_id) for category_id in categories_ids])
+
+    registrable_domain = roll_up_host(domain)
+    saved_domains = dict((categorized_domain.domain, categorized_domain) for categorized_domain in
+                         CategorizedDomain.objects.prefetch_related('categories')
+                                                  .filter(domain__in=set([domain, registrable_domain])))
+    categorized_domain = saved_domains.get(domain) or saved_domains.get(registrable_domain)
+    if categorized_domain is not None:
+        categories = list(categorized_domain.categories.all())
+        if categorized_domain.failures:
+            with negative_cache_stats_lock:
+                negative_cache_stats['hits'] += 1
+        if not categorized_domain.pending:
+            if not categorized_domain.refresh and categorized_domain.categories_expired():
+                CategorizedDomain.objects.filter(pk=categorized_domain.pk).update(refresh=True)
+            domains_cache.set(categorized_domain.domain, (categorized_domain.pk, [cat.pk for cat in categories]))
+            if categorized_domain.domain != domain:
+                domains_cache.set(domain, categorized_domain.domain)
+        return categorized_domain, categories
+
+    if not add_if_does_not_exist:
+        return None, []
+    domain = registrable_domain
+
+    # The domain is created with get_or_create, as another process may be creating it at the same time
+    if getattr(settings, 'OPENDNS_ASYNC_CATEGORIZATION', False):
+        categorized_domain, created = CategorizedDomain.objects.get_or_create(domain=domain,
+                                                                              defaults={'pending': True})
+        return categorized_domain, [] if created else list(categorized_domain.categories.all())
+
+    # OpenDNS is queried out of the transaction, so it is not held open while waiting
+    try:
+        approved_categories = fetch_new_domain_categories(domain)
+    except LOOKUP_ERRORS + (OpenDNSUnavailable,), e:
+        # Saved as pending, to be categorized in background instead of querying it on every visit
+        categorized_domain, created = CategorizedDomain.objects.get_or_create(domain=domain,
+                                                                              defaults={'pending': True})
+        if not created:
+            return categorized_domain, list(categorized_domain.categories.all())
+        if not isinstance(e, OpenDNSUnavailable):
+            save_failed_domains([categorized_domain])
+        return categorized_domain, []
+
     with transaction.commit_on_success():
-        if CategorizedDomain.objects.filter(domain=domain).exists():
-            approved_categories = CategorizedDomain.objects.get(domain=domain).categories.all()
-            approved_categories = [cat.name for cat in approved_categories]
-        elif add_if_does_not_exist:
-            page = urllib2.urlopen("http://domain.opendns.com/" + domain)
-            htmlCode = "".join(page.readlines()).replace("\n", "").replace("\t", "")
-            xmlTree = html.fromstring(htmlCode)
-            approved_categories = xmlTree.xpath(APPROVED_CATEGORIES_QUERY)
-
-            # Check existence and adapt to our categories
-            for category in approved_categories:
-                if category not in CATEGORIES.keys():
-                    raise OpenDNS_DOMException()
-            approved_categories = [CATEGORIES[cat] for cat in approved_categories]
-
-            cat_domain = CategorizedDomain(domain=domain)
-            cat_domain.save()
-            cat_domain.add_categories(approved_categories)
-
-    return approved_categories
\ No newline at end of file
+        cat_domain, created = CategorizedDomain.objects.get_or_create(
+            domain=domain, defaults={'last_checked': datetime.datetime.utcnow().replace(tzinfo=utc)})
+        if created:
+            database_categories = cat_domain.add_categories(approved_categories)
+        else:
+            database_categories = list(cat_domain.categories.all())
+
+    return cat_domain, database_categories
+
+def is_valid_domain(domain):
+    """ Checks if a normalized host can be saved as a categorized domain """
+    return 0 < len(domain) <= DOMAIN_MAX_LENGTH
+
+def add_categorized_domains(domains_categories):
+    """
+    Saves at once domains already categorized, given a dict {domain: [category, ...]}
+    Categories can be given with OpenDNS or our names, unknown ones are ignored. Domains
+    already saved are skipped
+
+    Returns the tuple (domains added, domains skipped, unknown categories ignored)
+    """
+    saved_domains = set(CategorizedDomain.objects.filter(domain__in=domains_categories.keys())
+                                                 .values_list('domain', flat=True))
+    new_domains = [domain for domain in domains_categories if domain not in saved_domains]
+    if not new_domains:
+        return 0, len(saved_domains), 0
+
+    with transaction.commit_on_success():
+        CategorizedDomain.objects.bulk_create([CategorizedDomain(domain=domain) for domain in new_domains])
+        # bulk_create does not give back the ids
+        domains_ids = CategorizedDomain.objects.filter(domain__in=new_domains).values_list('domain', 'id')
+
+        DomainCategory = CategorizedDomain.categories.through
+        domains_categories_rows = []
+        unknown_categories = 0
+        for domain, domain_id in domains_ids:
+            for category in set(domains_categories[domain]):
+                try:
+                    user_category = user_categories_cache.get(CATEGORIES.get(category, category))
+                except UserCategory.DoesNotExist:
+                    unknown_categories += 1
+                    continue
+                domains_categories_rows.append(DomainCategory(categorizeddomain_id=domain_id,
+                                                              usercategory_id=user_category.pk))
+        DomainCategory.objects.bulk_create(domains_categories_rows)
+
+    return len(new_domains), len(saved_domains), unknown_categories
+
+def save_resolved_domains(domains_categories):
+    """
+    Saves at once the categories of domains which were pending, given a dict
+    {categorized domain: [category, ...]}, and adds them to the users who visited them
+    """
+    DomainCategory = CategorizedDomain.categories.through
+    with transaction.commit_on_success():
+        # The domains are locked until their visits are counted. Requests which read them
+        # pending lock them too before saving their visits (see lock_pending_domains), so
+        # each visit is counted either here or with the categories saved here
+        pending_ids = set(CategorizedDomain.objects.select_for_update()
+                                           .filter(pk__in=[categorized_domain.pk for categorized_domain in
+                                                           domains_categories], pending=True)
+                                           .order_by('pk').values_list('pk', flat=True))
+        domains_categories = dict((categorized_domain, categories) for categorized_domain, categories
+                                  in domains_categories.items() if categorized_domain.pk in pending_ids)
+
+        DomainCategory.objects.bulk_create([
+            DomainCategory(categorizeddomain_id=categorized_domain.pk,
+                           usercategory_id=user_categories_cache.get(category).pk)
+            for categorized_domain, categories in domains_categories.items()
+            for category in set(categories)])
+        CategorizedDomain.objects.filter(pk__in=pending_ids) \
+                                 .update(pending=False, last_checked=datetime.datetime.utcnow().replace(tzinfo=utc),
+                                         failures=0, retry_after=None)
+        for categorized_domain, categories in domains_categories.items():
+            categorized_domain.add_visitors_categories_visits(categories)
+
+def lock_pending_domains(categorized_domains):
+    """
+    Locks until the end of the transaction the domains of a list which were pending, and returns
+    {domain id: [UserCategory, ...]} for those resolved since they were read
+
+    Called in the transaction saving their visits: the visits saved before a domain is resolved
+    are counted by save_resolved_domains, the ones saved after must use the categories returned
+    """
+    pending_ids = sorted(set(categorized_domain.pk for categorized_domain in categorized_domains
+                             if categorized_domain.pending))
+    if not pending_ids:
+        return {}
+
+    # Locked always in the same order, so requests don't deadlock
+    resolved_ids = [domain_id for domain_id, pending in
+                    CategorizedDomain.objects.select_for_update().filter(pk__in=pending_ids)
+                                             .order_by('pk').values_list('pk', 'pending') if not pending]
+    resolved_categories = dict((domain_id, []) for domain_id in resolved_ids)
+    if resolved_ids:
+        # Read with a lock too, to see the categories committed after the transaction started
+        DomainCategory = CategorizedDomain.categories.through
+        for domain_id, category_id in DomainCategory.objects.select_for_update() \
+                                                    .filter(categorizeddomain_id__in=resolved_ids) \
+                                                    .values_list('categorizeddomain_id', 'usercategory_id'):
+            resolved_categories[domain_id].append(user_categories_cache.get_by_pk(category_id))
+    return resolved_categories
+
+def save_refreshed_domains(domains_categories):
+    """
+    Saves the categories retrieved again for domains, given a dict {categorized domain: [category, ...]}
+    The categories added and removed are applied to the users who visited each domain
+    """
+    DomainCategory = CategorizedDomain.categories.through
+    with transaction.commit_on_success():
+        for categorized_domain, categories in domains_categories.items():
+            old_categories = set(cat.name for cat in categorized_domain.categories.all())
+            added_categories = set(categories) - old_categories
+            removed_categories = old_categories - set(categories)
+            if not added_categories and not removed_categories:
+                continue
+
+            DomainCategory.objects.bulk_create([
+                DomainCategory(categorizeddomain_id=categorized_domain.pk,
+                               usercategory_id=user_categories_cache.get(category).pk)
+                for category in added_categories])
+            DomainCategory.objects.filter(categorizeddomain=categorized_domain,
+                                          usercategory__name__in=removed_categories).delete()
+            categorized_domain.add_visitors_categories_visits(added_categories, removed_categories)
+
+        CategorizedDomain.objects.filter(pk__in=[categorized_domain.pk for categorized_domain in domains_categories]) \
+                                 .update(refresh=False, last_checked=datetime.datetime.utcnow().replace(tzinfo=utc),
+                                         failures=0, retry_after=None)
+
+    # Bulk changes don't send the signals which invalidate the cache
+    for categorized_domain in domains_categories:
+        domains_cache.delete(categorized_domain.domain)
+
+def save_failed_domains(categorized_domains):
+    """
+    Records a failed query of several domains, which are not queried again until their backoff passes
+    """
+    now = datetime.datetime.utcnow().replace(tzinfo=utc)
+    domains_by_failures = {}
+    for categorized_domain in categorized_domains:
+        domains_by_failures.setdefault(categorized_domain.failures + 1, []).append(categorized_domain.pk)
+    for failures, domains_ids in domains_by_failures.items():
+        CategorizedDomain.objects.filter(pk__in=domains_ids).update(failures=failures,
+                                                                    retry_after=now + get_failure_backoff(failures))
+    with negative_cache_stats_lock:
+        negative_cache_stats['failed'] += len(categorized_domains)
+
+def add_pending_domains(domains):
+    """
+    Saves as pending the domains of a list not saved yet
+    Returns the number of domains added
+    """
+    domains = set(domains)
+    saved_domains = set(CategorizedDomain.objects.filter(domain__in=domains).values_list('domain', flat=True))
+    CategorizedDomain.objects.bulk_create([CategorizedDomain(domain=domain, pending=True)
+                                           for domain in domains - saved_domains])
+    return len(domains - saved_domains)
+
+def categorize_domains(categorized_domains, save_categories, limit=None, threads=1, rate=None):
+    """
+    Queries OpenDNS for the categories of the domains of a queryset in batches, from threads
+    threads at no more than rate requests per second, and saves every batch with the function
+    save_categories, which receives a dict {categorized domain: [category, ...]}
+    Domains whose previous queries failed are skipped until their backoff passes, and it stops
+    when OpenDNS becomes unavailable
+    Returns the tuple (domains categorized, domains failed)
+    """
+    opendns_client = OpenDNSClient(rate=rate)
+    now = datetime.datetime.utcnow().replace(tzinfo=utc)
+    categorized_domains = categorized_domains.filter(Q(retry_after__isnull=True) | Q(retry_after__lte=now)) \
+                                             .order_by('id')
+
+    resolved, failed = 0, 0
+    last_id = 0
+    while limit is None or resolved + failed < limit:
+        batch_size = constants.OPENDNS_RESOLVE_BATCH_SIZE
+        if limit is not None:
+            batch_size = min(batch_size, limit - resolved - failed)
+        batch = dict((categorized_domain.domain, categorized_domain)
+                     for categorized_domain in categorized_domains.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        last_id = max(categorized_domain.pk for categorized_domain in batch.values())
+
+        domains_categories = {}
+        failed_domains = []
+        for domain, categories, error in opendns_client.fetch_domains_categories(batch.keys(), threads):
+            if error is None:
+                domains_categories[batch[domain]] = categories
+            else:
+                failed += 1
+                if not isinstance(error, OpenDNSUnavailable):
+                    failed_domains.append(batch[domain])
+        save_categories(domains_categories)
+        save_failed_domains(failed_domains)
+        resolved += len(domains_categories)
+
+        if circuit_breaker.is_open():
+            break
+
+    return resolved, failed
+
+def resolve_pending_domains(limit=None, domains=None, threads=1, rate=None):
+    """
+    Categorizes the domains saved as pending, or only those of them in the domains list if given
+    Domains which can't be categorized remain pending
+    Returns the tuple (domains resolved, domains failed)
+    """
+    pending_domains = CategorizedDomain.objects.filter(pending=True)
+    if domains is not None:
+        pending_domains = pending_domains.filter(domain__in=domains)
+
+    return categorize_domains(pending_domains, save_resolved_domains, limit=limit, threads=threads, rate=rate)
+
+def refresh_domains(limit=None, threads=1, rate=None):
+    """
+    Retrieves again the categories of the domains queued because they had expired when visited
+    Domains which can't be categorized remain queued, keeping their categories
+    Returns the tuple (domains refreshed, domains failed)
+    """
+    expired_domains = CategorizedDomain.objects.filter(refresh=True).prefetch_related('categories')
+    return categorize_domains(expired_domains, save_refreshed_domains, limit=limit, threads=threads, rate=rate)
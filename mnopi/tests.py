@@ -1,33 +1,138 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 from django.core.management import call_command
-from models import UserCategory, User, CategorizedDomain, UserCategorization, PageVisited, Search, ClientSession, Client
-from api import UserResource
+from models import UserCategory, User, CategorizedDomain, UserCategorization, PageVisited, Search, ClientSession, Client, \
+    RevokedSessionToken, SIGNED_SESSION_SALT, load_signed_session_token, revoked_session_tokens, domains_cache, \
+    sessions_cache, user_categories_cache
+from api import UserResource, get_session
+from utils import CircuitBreaker
+from domains import normalize_host, get_registrable_domain
 import opendns
 import constants
 import management.commands.process_keywords
-from tastypie.test import ResourceTestCase
+from mnopimining import html, keywords, language
+from tastypie.test import ResourceTestCase, TestApiClient
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.core import signing
+from django.utils.timezone import utc
 
 from pymongo import MongoClient, Connection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import nltk
+import BaseHTTPServer
+import SocketServer
+import tempfile
+import bson
+import threading
+import time
 import datetime
+import os
 import json
 
 API_URI = {
     'user': '/api/v1/user/',
     'signup': '/api/v1/user/',
     'login': '/api/v1/user/login/',
+    'logout': '/api/v1/user/logout/',
     'page_visited': '/api/v1/page_visited/',
+    'page_visited_batch': '/api/v1/page_visited/batch/',
     'page_categories': '/api/v1/page_visited/%s/categories/',
     'html': '/api/v1/page_visited/html/',
-    'search_query': '/api/v1/search_query/'
+    'search_query': '/api/v1/search_query/',
+    'search_query_bulk': '/api/v1/search_query/bulk/'
 }
 
+class OpenDNSStubServer(object):
+    """
+    Local stand-in for domain.opendns.com, which serves the approved categories given
+    for each domain (using OpenDNS names) and records the domains requested and the
+    number of connections opened. The first failures[domain] requests of a domain fail,
+    and every response waits delay seconds
+    """
+
+    def __init__(self, domains_categories, failures=None, delay=0):
+        self.domains_categories = domains_categories
+        self.failures = failures or {}
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+
+        stub = self
+        class OpenDNSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                stub.connections += 1
+
+            def do_GET(self):
+                domain = self.path.lstrip("/")
+                stub.requests.append(domain)
+                time.sleep(stub.delay)
+                if stub.failures.get(domain, 0) > 0:
+                    stub.failures[domain] -= 1
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                rows = "".join("<tr>\n\t<td><b>%s</b></td><td>Approved</td></tr>" % category
+                               for category in stub.domains_categories.get(domain, []))
+                body = "<html><body><table>%s</table></body></html>" % rows
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class OpenDNSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True # Kept alive connections don't block the shutdown
+
+        self.server = OpenDNSServer(("127.0.0.1", 0), OpenDNSHandler)
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class OpenDNSStubTest(TestCase):
+    """ Test case in which OpenDNS is replaced by a local stub server """
+
+    OPENDNS_DOMAINS_CATEGORIES = {}
+    OPENDNS_FAILURES = {}
+
+    def setUp(self):
+        super(OpenDNSStubTest, self).setUp()
+        self.opendns = OpenDNSStubServer(dict(self.OPENDNS_DOMAINS_CATEGORIES), dict(self.OPENDNS_FAILURES))
+        opendns.circuit_breaker.reset()
+        self.opendns.start()
+        self.opendns_settings = override_settings(OPENDNS_DOMAIN_URL=self.opendns.url)
+        self.opendns_settings.enable()
+
+    def tearDown(self):
+        self.opendns_settings.disable()
+        self.opendns.stop()
+        super(OpenDNSStubTest, self).tearDown()
+
 class CategorizableResourceTest(TestCase):
     """ Test case with OpenDNS categories loaded """
 
+    def now(self):
+        return datetime.datetime.utcnow().replace(tzinfo=utc)
+
     def setUp(self):
         super(CategorizableResourceTest, self).setUp()
+        # Domains cached by other tests were rolled back
+        domains_cache.clear()
         for category in opendns.CATEGORIES.values():
             UserCategory.objects.create(name=category, taxonomy="opendns")
 
@@ -91,7 +196,14 @@ class ModelsMongoTest(TestCase):
     def tearDown(self):
         super(ModelsMongoTest, self).tearDown()
         self.test_mongo.db.htmlVisited.drop()
+        self.test_mongo.db.htmlContent.drop()
+        self.test_mongo.db.counters.drop()
         self.test_mongo.db.userKeywords.drop()
+        self.test_mongo.db.keywords.drop()
+        self.test_mongo.keywords_ids_cache.clear()
+        self.test_mongo.keywords_cache.clear()
+        language.domains_languages.clear()
+        language.tlds_languages.clear()
 
     @classmethod
     def tearDownClass(cls):
@@ -344,6 +456,34 @@ class UserLoginTest(AuthenticableResourceTest):
             'reason': "UNEXPECTED_SESSION"
         })
 
+    def test_renewed_session_not_cached(self):
+        # The session is cached by the first authenticated request
+        resp = self.api_client.get(API_URI['page_visited'], format='json',
+                                   HTTP_SESSION_TOKEN=self.last_session_token)
+        self.assertHttpOK(resp)
+        with self.assertNumQueries(2): # Pages visited count and list only
+            self.api_client.get(API_URI['page_visited'], format='json',
+                                HTTP_SESSION_TOKEN=self.last_session_token)
+
+        resp = self.perform_login(username=self.username,
+                                  key=self.last_session_token,
+                                  renew=True)
+        self.assertEqual(self.deserialize(resp)['result'], 'OK')
+
+        resp = self.api_client.get(API_URI['page_visited'], format='json',
+                                   HTTP_SESSION_TOKEN=self.last_session_token)
+        self.assertHttpUnauthorized(resp)
+
+    def test_purge_sessions(self):
+        other_expired_session_token = self.user.new_session(self.client)
+        ClientSession.objects.filter(session_token=other_expired_session_token).update(
+            expiration_time=datetime.datetime(2014, 1, 1, tzinfo=utc))
+
+        call_command('purge_sessions', batch_size=1)
+
+        self.assertEqual(ClientSession.objects.count(), 1)
+        self.assertTrue(ClientSession.objects.filter(session_token=self.last_session_token).exists())
+
     def test_correct_password_login_plus_correct_renew_session(self):
         resp = self.perform_login(username=self.username,
                                   key=self.password,
@@ -457,6 +597,22 @@ class UserLoginTest(AuthenticableResourceTest):
             'reason': "CLIENT_OUTDATED"
         })
 
+    def test_client_disallowed_after_login(self):
+        resp = self.perform_login()
+        self.assertEqual(self.deserialize(resp)['result'], 'OK')
+
+        # Clients are cached, but saving them invalidates the cache
+        with self.assertNumQueries(3): # User, user authentication and session insertion
+            self.perform_login()
+
+        self.client.allowed = False
+        self.client.save()
+        resp = self.perform_login()
+        self.assertEqual(self.deserialize(resp), {
+            'result': 'ERR',
+            'reason': "CLIENT_OUTDATED"
+        })
+
     def test_password_error_password_login(self):
         resp = self.perform_login(username=self.username,
                                   key="abcdefghi",
@@ -484,6 +640,109 @@ class UserLoginTest(AuthenticableResourceTest):
         })
 
 
+@override_settings(SIGNED_SESSION_TOKENS=True)
+class SignedSessionTokensTest(AuthenticableResourceTest):
+    """ Sessions whose tokens are signed instead of saved in the database """
+
+    def perform_logout(self, session_token):
+        return self.api_client.post(API_URI['logout'], data={}, format='json',
+                                    HTTP_SESSION_TOKEN=session_token)
+
+    def get_pages_visited(self, session_token):
+        return self.api_client.get(API_URI['page_visited'], format='json',
+                                   HTTP_SESSION_TOKEN=session_token)
+
+    def test_login_session_not_saved(self):
+        self.perform_login()
+        self.assertEqual(ClientSession.objects.count(), 0)
+        self.assertHttpOK(self.get_pages_visited(self.session_token))
+
+    def test_tampered_token(self):
+        self.perform_login()
+        payload, timestamp, signature = self.session_token.split(':')
+        self.assertHttpUnauthorized(self.get_pages_visited(payload + "a:" + timestamp + ":" + signature))
+        self.assertHttpUnauthorized(self.get_pages_visited(self.session_token + "a"))
+
+    def test_expired_token(self):
+        expired_session_token = signing.dumps({'u': self.user.pk, 'c': self.client.pk, 'e': 0, 'n': "expired"},
+                                              salt=SIGNED_SESSION_SALT)
+        self.assertHttpUnauthorized(self.get_pages_visited(expired_session_token))
+        self.assertHttpUnauthorized(self.get_pages_visited(expired_session_token))
+        self.assertEqual(RevokedSessionToken.objects.count(), 0)
+
+    def test_renew_revokes_token(self):
+        self.perform_login()
+        old_session_token = self.session_token
+        self.assertHttpOK(self.get_pages_visited(old_session_token))
+
+        resp = self.perform_login(key=old_session_token, renew=True)
+        self.assertEqual(self.deserialize(resp)['result'], "OK")
+        self.assertNotEqual(self.session_token, old_session_token)
+        self.assertEqual(RevokedSessionToken.objects.count(), 1)
+
+        self.assertHttpUnauthorized(self.get_pages_visited(old_session_token))
+        self.assertHttpOK(self.get_pages_visited(self.session_token))
+
+        resp = self.perform_login(key=old_session_token, renew=True)
+        self.assertEqual(self.deserialize(resp)['reason'], "UNEXPECTED_SESSION")
+
+    def test_renew_other_user_token(self):
+        other_user = User.objects.create_user("Kuntakinte", "kunta@gmail.com", "joasjoasjoas")
+        other_session_token = other_user.new_session(self.client)
+
+        resp = self.perform_login(key=other_session_token, renew=True)
+        self.assertEqual(self.deserialize(resp)['reason'], "UNEXPECTED_SESSION")
+
+    def test_logout(self):
+        self.perform_login()
+        self.assertHttpOK(self.perform_logout(self.session_token))
+        self.assertHttpUnauthorized(self.get_pages_visited(self.session_token))
+        self.assertHttpUnauthorized(self.perform_logout(self.session_token))
+
+    def test_revoked_by_other_worker(self):
+        self.perform_login()
+        session = load_signed_session_token(self.session_token)
+        RevokedSessionToken.objects.create(token_id=session['token_id'],
+                                           expiration_time=session['expiration_time'])
+
+        revoked_session_tokens.refresh()
+        self.assertIsNone(load_signed_session_token(self.session_token))
+
+    def test_cached_session_revoked_by_other_worker(self):
+        self.perform_login()
+        self.assertHttpOK(self.get_pages_visited(self.session_token))
+        self.assertIsNotNone(sessions_cache.get(self.session_token))
+
+        session = load_signed_session_token(self.session_token)
+        RevokedSessionToken.objects.create(token_id=session['token_id'],
+                                           expiration_time=session['expiration_time'])
+        revoked_session_tokens.refresh()
+        self.assertHttpUnauthorized(self.get_pages_visited(self.session_token))
+
+    def test_cached_session_not_shared(self):
+        self.perform_login()
+        user, client, expiration_time = get_session(self.session_token)
+        user.first_name = "Changed"
+        with self.assertNumQueries(0):
+            cached_user, cached_client, cached_expiration_time = get_session(self.session_token)
+        self.assertIsNot(cached_user, user)
+        self.assertIsNot(cached_client, client)
+        self.assertEqual(cached_user.pk, user.pk)
+        self.assertNotEqual(cached_user.first_name, "Changed")
+        self.assertEqual(cached_expiration_time, expiration_time)
+
+    def test_random_tokens_still_accepted(self):
+        with self.settings(SIGNED_SESSION_TOKENS=False):
+            self.perform_login()
+        self.assertEqual(ClientSession.objects.count(), 1)
+        self.assertHttpOK(self.get_pages_visited(self.session_token))
+
+        self.assertHttpOK(self.perform_logout(self.session_token))
+        self.assertEqual(ClientSession.objects.count(), 0)
+        self.assertHttpUnauthorized(self.get_pages_visited(self.session_token))
+
+
+@override_settings(HTML_MINING_ASYNC=False, HTML_COMPRESSED_STORAGE=False, HTML_DEDUPLICATION=False)
 class HtmlVisitedResourceTest(AuthenticableResourceTest, ModelsMongoTest):
     """ Html visited service tests """
 
@@ -701,6 +960,521 @@ class HtmlVisitedResourceTest(AuthenticableResourceTest, ModelsMongoTest):
         self.assertEqual(user, "alfredo")
 
 
+@override_settings(KEYWORDS_TOKENIZER='regex')
+class RegexTokenizerHtmlVisitedResourceTest(HtmlVisitedResourceTest):
+    """ The same tests for html pages, with the regex tokenizer """
+
+class TokenizersTest(TestCase):
+    """ Keywords counted with both tokenizers """
+
+    TEXTS = ["Hola, Noti.cias H-ola: desde mi casa (pienso) cosas de casa; 1,5 o 1:30!",
+             "Noticias de última \"hora\" [portada] {hoy} <lol> 100% #tag @user $3.88 & más...",
+             "this of course is an english text oh my god!"]
+
+    def test_same_words(self):
+        for text in self.TEXTS:
+            self.assertEqual(keywords.get_freq_words(text, tokenizer='regex'),
+                             keywords.get_freq_words(text, tokenizer='nltk'))
+            self.assertEqual(keywords.get_words(text, stem=True, language='spanish', tokenizer='regex'),
+                             keywords.get_words(text, stem=True, language='spanish', tokenizer='nltk'))
+
+    def test_english_contractions_not_split(self):
+        self.assertEqual(keywords.get_words("peter's house", tokenizer='regex'), ["peters", "house"])
+        self.assertEqual(keywords.get_words("peter's house", tokenizer='nltk'), ["peter", "house"])
+
+class HtmlFeaturesTest(TestCase):
+    """ Extraction of the text and properties of html pages """
+
+    HTML_CODE = ("<!DOCTYPE html><html><head><title>Noticias de &uacute;ltima</title>"
+                 "<META NAME=\"Description\" content=\"Lo &quot;&uacute;ltimo&quot;\">"
+                 "<meta name=\"keywords\" content=\"noticias, hoy\"><meta name=\"author\" content=\"Yo\">"
+                 "<style>body { color: red; }</style>"
+                 "<SCRIPT type=\"text/javascript\">if (a < b) { document.write('<p>No</p>'); }</SCRIPT>"
+                 "</head><body><!-- <p>Comentario</p> --><p>Hola,&nbsp;noticias de&#32;hoy</p>"
+                 "<div>\n  Portada\n</div></body></html>")
+
+    def test_html_features(self):
+        text, properties = html.get_html_features(self.HTML_CODE)
+
+        self.assertEqual(text, "Noticias de \u00faltima Hola, noticias de hoy Portada")
+        self.assertEqual(properties, {"title": "Noticias de \u00faltima",
+                                      "description": "Lo \"\u00faltimo\"",
+                                      "keywords": "noticias, hoy"})
+
+    def test_same_words_as_clean_html(self):
+        text, properties = html.get_html_features(self.HTML_CODE)
+        nltk_text = nltk.clean_html(html.HTMLParser().unescape(self.HTML_CODE))
+
+        self.assertEqual(text.split(), nltk_text.split())
+
+    def test_first_title_kept(self):
+        text, properties = html.get_html_features("<title>Portada</title><svg><title>Icono</title></svg>")
+
+        self.assertEqual(properties, {"title": "Portada"})
+
+class LanguageDetectionTest(TestCase):
+    """ Language detection on samples of the text, known by domain when possible """
+
+    SPANISH_TEXT = "Las noticias de hoy en la portada del periódico, con toda la información de última hora. "
+    ENGLISH_TEXT = "Today's news on the front page of the newspaper, with all the breaking information. "
+
+    def setUp(self):
+        super(LanguageDetectionTest, self).setUp()
+        language.domains_languages.clear()
+        language.tlds_languages.clear()
+
+    def test_text_sample(self):
+        text = "a" * 2000 + self.SPANISH_TEXT * 100 + "z" * 2000
+        sample = language.get_text_sample(text, length=1000, chunks=4)
+
+        self.assertLessEqual(len(sample), 1000 + 3)
+        self.assertTrue(sample.startswith("a" * 250))
+        self.assertTrue(sample.endswith("z" * 250))
+        self.assertIn("noticias", sample)
+        self.assertEqual(language.get_text_sample(self.SPANISH_TEXT), self.SPANISH_TEXT)
+
+    def test_only_processed_languages(self):
+        lang, confidence = language.get_identifier().classify("Les nouvelles du jour à la une du journal")
+
+        self.assertIn(lang, language.LANGUAGE_NAMES)
+        self.assertEqual(language.detect_language(self.SPANISH_TEXT * 50), "spanish")
+        self.assertEqual(language.detect_language(self.ENGLISH_TEXT * 50), "english")
+
+    def test_language_known_by_domain(self):
+        for i in range(constants.LANGUAGE_DOMAIN_MIN_PAGES):
+            self.assertEqual(language.detect_language(self.SPANISH_TEXT, "http://elpais.com/%d" % i), "spanish")
+
+        classified = language.detection_stats['classified']
+        self.assertEqual(language.detect_language(self.ENGLISH_TEXT, "http://m.elpais.com/english"), "spanish")
+        self.assertEqual(language.detection_stats['classified'], classified)
+        # Other domains are still classified
+        self.assertEqual(language.detect_language(self.ENGLISH_TEXT, "http://bbc.co.uk"), "english")
+
+    def test_different_language_starts_again(self):
+        for i in range(constants.LANGUAGE_DOMAIN_MIN_PAGES - 1):
+            language.detect_language(self.SPANISH_TEXT, "http://elpais.com/%d" % i)
+        language.detect_language(self.ENGLISH_TEXT, "http://elpais.com/english")
+        language.detect_language(self.SPANISH_TEXT, "http://elpais.com/last")
+
+        self.assertEqual(language.detect_language(self.ENGLISH_TEXT, "http://elpais.com/english"), "english")
+
+    def test_language_known_by_tld(self):
+        for i in range(constants.LANGUAGE_TLD_MIN_PAGES):
+            language.detect_language(self.SPANISH_TEXT, "http://periodico%d.es" % i)
+
+        self.assertEqual(language.detect_language(self.ENGLISH_TEXT, "http://otro.es"), "spanish")
+        self.assertEqual(language.detect_language(self.ENGLISH_TEXT, "http://otro.com"), "english")
+
+class StopwordsTest(TestCase):
+    """ Stopwords removed from the words of the pages """
+
+    def test_stopwords_of_every_language(self):
+        self.assertEqual(set(keywords.STOPWORDS), set(language.LANGUAGE_NAMES.values()))
+        self.assertEqual(keywords.clean_stopwords(["the", "casa", "de", "house", "of", "el"]), ["casa", "house"])
+
+    def test_stopwords_without_accents(self):
+        self.assertIn("más", keywords.STOPWORDS["spanish"])
+        self.assertEqual(keywords.clean_stopwords(["mas", "más", "noticias"], "spanish"), ["noticias"])
+
+class StemmingTest(TestCase):
+    """ Stems of the words, cached per language """
+
+    def setUp(self):
+        super(StemmingTest, self).setUp()
+        keywords.stems_cache.clear()
+
+    def test_stems_cached(self):
+        hits = keywords.stems_cache.hits
+
+        self.assertEqual(keywords.stem_words(["comprar", "compras", "comprar"], "spanish"), ["compr", "compr", "compr"])
+        self.assertEqual(keywords.stems_cache.hits, hits + 1)
+        self.assertEqual(keywords.stem_word("comprar", "spanish"), "compr")
+        self.assertEqual(keywords.stems_cache.hits, hits + 2)
+
+    def test_stems_per_language(self):
+        self.assertEqual(keywords.stem_word("running", "english"), "run")
+        self.assertEqual(keywords.stem_word("running", "spanish"), "running")
+        self.assertIs(keywords.get_stemmer("spanish"), keywords.get_stemmer("spanish"))
+
+@override_settings(HTML_MINING_ASYNC=True, HTML_DEDUPLICATION=False)
+class HtmlMiningQueueTest(AuthenticableResourceTest, ModelsMongoTest):
+    """ Tests for the html mining queue and the mine_html command """
+
+    def setUp(self):
+        super(HtmlMiningQueueTest, self).setUp()
+        self.perform_login()
+
+    def perform_html_visited(self, url, html_code):
+
+        html_visited_data = {
+            'user': self.user_resource,
+            'url': url,
+            'html_code': html_code,
+            'date': "2014-01-01 00:00:00"
+        }
+        return self.api_client.post(API_URI['html'], data=html_visited_data,
+                                    format='json', HTTP_SESSION_TOKEN=self.session_token)
+
+    def test_html_queued(self):
+        resp = self.perform_html_visited(url="http://mola.com",
+                                         html_code="<html><head><title>Noticias</title></head>"
+                                                   "<body>Hola, Noticias Hola</body></html>")
+        self.assertHttpCreated(resp)
+
+        page = self.test_mongo.HtmlVisitedDocument(self.test_mongo.db.htmlVisited.find_one())
+        self.assertEqual(page["html_code"], "<html><head><title>Noticias</title></head>"
+                                            "<body>Hola, Noticias Hola</body></html>")
+        self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_PENDING)
+        self.assertNotIn("keywords_freq", page)
+        self.assertEqual(PageVisited.objects.filter(html_ref=page["_id"]).count(), 1)
+        self.assertEqual(self.test_mongo.get_mining_queue_stats()["ready"], 1)
+
+    def test_queue_mined(self):
+        self.perform_html_visited(url="http://mola.com",
+                                  html_code="<html><head><title>Noticias</title></head>"
+                                            "<body>Hola, Noticias Hola</body></html>")
+        call_command('mine_html')
+
+        page = self.test_mongo.db.htmlVisited.find_one()
+        self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_DONE)
+        self.assertEqual(page["properties"]["title"], "Noticias")
+        self.assertEqual(page["keywords_freq"]["text"]["hola"], 2)
+        self.assertEqual(page["keywords_freq"]["metadata"]["noticias"], 1)
+        self.assertEqual(self.test_mongo.get_mining_queue_stats()["pending"], 0)
+
+    def test_not_mined_pages_not_processed(self):
+        self.perform_html_visited(url="http://mola.com", html_code="<html><body>limpito</body></html>")
+        call_command('process_keywords')
+        self.assertNotIn("processed", self.test_mongo.db.htmlVisited.find_one())
+
+        call_command('mine_html')
+        call_command('process_keywords')
+        self.assertEqual(self.test_mongo.db.htmlVisited.find_one()["processed"], True)
+        user_keywords = self.test_mongo.db.userKeywords.find_one()
+        self.assertEqual(user_keywords["site_keywords_freq"]["limpito"], 1)
+
+    def test_not_mined_pages_keywords_skipped(self):
+        self.perform_html_visited(url="http://mola.com", html_code="<html><body>limpito</body></html>")
+        call_command('mine_html')
+        self.perform_html_visited(url="http://mola.com/2", html_code="<html><body>sucio</body></html>")
+
+        self.assertEqual(self.test_mongo.get_user_html_keywords_freqs(self.user.username),
+                         [{"text": {"limpito": 1}, "metadata": {}}])
+        self.assertEqual(self.user.get_keywords_freqs_from_html(), [("limpito", 1)])
+
+    def test_mining_retried_and_failed(self):
+        self.perform_html_visited(url="http://mola.com", html_code="<html><body>limpito</body></html>")
+
+        # Html that can not be processed
+        self.test_mongo.db.htmlVisited.update({}, {'$set': {'html_code': None}})
+        call_command('mine_html')
+
+        page = self.test_mongo.db.htmlVisited.find_one()
+        self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_PENDING)
+        self.assertEqual(page["mining"]["attempts"], 1)
+        self.assertIn("error", page["mining"])
+        self.assertEqual(self.test_mongo.get_mining_queue_stats()["ready"], 0)
+
+        # Last attempt
+        self.test_mongo.db.htmlVisited.update({}, {'$set': {
+            'mining.attempts': constants.HTML_MINING_MAX_ATTEMPTS - 1,
+            'mining.available_at': datetime.datetime.utcnow()}})
+        call_command('mine_html')
+
+        page = self.test_mongo.db.htmlVisited.find_one()
+        self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_FAILED)
+        self.assertEqual(self.test_mongo.get_mining_queue_stats()["failed"], 1)
+
+        # Failed pages can be queued again
+        self.test_mongo.db.htmlVisited.update({}, {'$set': {'html_code': "<html><body>limpito</body></html>"}})
+        call_command('mine_html', requeue_failed=True)
+        page = self.test_mongo.db.htmlVisited.find_one()
+        self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_DONE)
+
+    def test_abandoned_mining_retried_and_failed(self):
+        self.perform_html_visited(url="http://mola.com", html_code="<html><body>limpito</body></html>")
+        page = self.test_mongo.claim_html_visited()
+        self.assertIsNone(self.test_mongo.claim_html_visited())
+
+        # The worker died, its lease expires
+        lease_expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.test_mongo.db.htmlVisited.update({}, {'$set': {'mining.available_at': lease_expired}})
+        page = self.test_mongo.claim_html_visited()
+        self.assertEqual(page["mining"]["attempts"], 2)
+
+        self.test_mongo.db.htmlVisited.update({}, {'$set': {
+            'mining.attempts': constants.HTML_MINING_MAX_ATTEMPTS,
+            'mining.available_at': lease_expired}})
+        self.assertIsNone(self.test_mongo.claim_html_visited())
+        page = self.test_mongo.db.htmlVisited.find_one()
+        self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_FAILED)
+        self.assertEqual(self.test_mongo.get_mining_queue_stats()["failed"], 1)
+
+        call_command('mine_html', requeue_failed=True)
+        page = self.test_mongo.db.htmlVisited.find_one()
+        self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_DONE)
+
+
+@override_settings(HTML_MINING_ASYNC=False, HTML_COMPRESSED_STORAGE=True, HTML_DEDUPLICATION=False)
+class HtmlCompressedStorageTest(ModelsMongoTest):
+    """ Tests for htmlVisited documents saved compressed """
+
+    HTML_CODE = ("<html><head><title>Noticias de \u00faltima</title></head>"
+                 "<body>" + "<p>Hola, noticias de \u00faltima hora</p>" * 100 + "</body></html>")
+
+    def test_html_compressed(self):
+        self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                              html_code=self.HTML_CODE)
+
+        page = self.test_mongo.db.htmlVisited.find_one()
+        self.assertTrue(page["compressed"])
+        self.assertLess(len(page["html_code"]), len(self.HTML_CODE))
+        self.assertNotIsInstance(page["clean_html"], unicode)
+        self.assertEqual(page["keywords_freq"]["text"]["hola"], 100)
+
+    def test_html_decompressed_on_access(self):
+        self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                              html_code=self.HTML_CODE)
+
+        page = self.test_mongo.get_user_html_visited("alfredo")[0]
+        self.assertEqual(page["html_code"], self.HTML_CODE)
+        self.assertEqual(page.get("clean_html"), " ".join(["Noticias de \u00faltima"] +
+                                                          ["Hola, noticias de \u00faltima hora"] * 100))
+
+    def test_compressed_html_mined(self):
+        with self.settings(HTML_MINING_ASYNC=True):
+            self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                                  html_code=self.HTML_CODE)
+        self.assertTrue(self.test_mongo.db.htmlVisited.find_one()["compressed"])
+        call_command('mine_html')
+
+        page = self.test_mongo.get_user_html_visited("alfredo")[0]
+        self.assertEqual(page["keywords_freq"]["text"]["hola"], 100)
+        self.assertEqual(page["properties"]["title"], "Noticias de \u00faltima")
+        self.assertTrue(page["clean_html"].startswith("Noticias de \u00faltima Hola"))
+
+    def test_compress_command(self):
+        with self.settings(HTML_COMPRESSED_STORAGE=False):
+            for i in range(3):
+                self.test_mongo.register_html_visited(page_visited="http://mola.com/%d" % i, user="alfredo",
+                                                      html_code=self.HTML_CODE)
+        self.assertNotIn("compressed", self.test_mongo.db.htmlVisited.find_one())
+
+        call_command('compress_html', batch_size=2)
+        self.assertEqual(self.test_mongo.db.htmlVisited.find({'compressed': True}).count(), 3)
+        for page in self.test_mongo.get_user_html_visited("alfredo"):
+            self.assertEqual(page["html_code"], self.HTML_CODE)
+            self.assertEqual(page["keywords_freq"]["text"]["hola"], 100)
+
+@override_settings(HTML_MINING_ASYNC=False, HTML_COMPRESSED_STORAGE=True, HTML_DEDUPLICATION=True)
+class HtmlDeduplicationTest(ModelsMongoTest):
+    """ Tests for html saved and mined once for all the pages visited with the same html """
+
+    HTML_CODE = "<html><head><title>Portada</title></head><body>Noticias de hoy, noticias</body></html>"
+
+    def test_same_html_saved_once(self):
+        first_id = self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                                         html_code=self.HTML_CODE)
+        second_id = self.test_mongo.register_html_visited(page_visited="http://mola.com", user="amparo",
+                                                          html_code=self.HTML_CODE)
+        self.test_mongo.register_html_visited(page_visited="http://mola.com/2", user="amparo",
+                                              html_code="<html><body>Otra cosa</body></html>")
+
+        self.assertEqual(self.test_mongo.db.htmlContent.count(), 2)
+        html_content = self.test_mongo.db.htmlContent.find_one({'_id': self.test_mongo.hash_html(self.HTML_CODE)})
+        self.assertEqual(html_content["visits"], 2)
+
+        first_page = self.test_mongo.db.htmlVisited.find_one({'_id': first_id})
+        second_page = self.test_mongo.db.htmlVisited.find_one({'_id': second_id})
+        self.assertNotIn("html_code", second_page)
+        self.assertEqual(second_page["html_hash"], first_page["html_hash"])
+        self.assertEqual(second_page["user"], "amparo")
+        self.assertEqual(second_page["keywords_freq"], first_page["keywords_freq"])
+        self.assertEqual(second_page["keywords_freq"]["text"]["noticias"], 2)
+        self.assertEqual(second_page["properties"]["title"], "Portada")
+
+        stats = self.test_mongo.get_html_content_stats()
+        self.assertEqual((stats["contents"], stats["hits"], stats["misses"]), (2, 1, 2))
+
+    def test_concurrent_first_visits(self):
+        html_content = self.test_mongo.db.htmlContent
+        find_and_modify = html_content.find_and_modify
+        def insert_meanwhile(query, update, upsert=False, **kwargs):
+            # Another visit of the same html inserts it between the lookup and the insert of this one
+            if upsert:
+                find_and_modify(query, update, upsert=True, **kwargs)
+                raise DuplicateKeyError("E11000 duplicate key error")
+            return find_and_modify(query, update, upsert=upsert, **kwargs)
+        html_content.find_and_modify = insert_meanwhile
+        try:
+            self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                                  html_code=self.HTML_CODE)
+        finally:
+            del html_content.find_and_modify
+
+        self.assertEqual(self.test_mongo.db.htmlContent.count(), 1)
+        self.assertEqual(self.test_mongo.db.htmlContent.find_one()["visits"], 2)
+        self.assertEqual(self.test_mongo.db.htmlVisited.find_one()["keywords_freq"]["text"]["noticias"], 2)
+
+    def test_html_retrieved_on_access(self):
+        self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                              html_code=self.HTML_CODE)
+
+        page = self.test_mongo.get_user_html_visited("alfredo")[0]
+        self.assertEqual(page["html_code"], self.HTML_CODE)
+        self.assertEqual(page["clean_html"], "Portada Noticias de hoy, noticias")
+
+    def test_same_html_mined_once_in_queue(self):
+        with self.settings(HTML_MINING_ASYNC=True):
+            for user in ["alfredo", "amparo", "amparo"]:
+                self.test_mongo.register_html_visited(page_visited="http://mola.com", user=user,
+                                                      html_code=self.HTML_CODE)
+        self.assertEqual(self.test_mongo.db.htmlContent.count(), 1)
+        call_command('mine_html')
+
+        for page in self.test_mongo.db.htmlVisited.find():
+            self.assertEqual(page["mining"]["state"], self.test_mongo.MINING_DONE)
+            self.assertEqual(page["keywords_freq"]["text"]["noticias"], 2)
+        stats = self.test_mongo.get_html_content_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+        # Mined html is not queued again
+        with self.settings(HTML_MINING_ASYNC=True):
+            self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                                  html_code=self.HTML_CODE)
+        self.assertEqual(self.test_mongo.get_mining_queue_stats()["pending"], 0)
+        self.assertEqual(self.test_mongo.get_html_content_stats()["hits"], 3)
+
+    def test_language_known_from_domain(self):
+        cached = language.detection_stats['cached']
+        for i in range(constants.LANGUAGE_DOMAIN_MIN_PAGES):
+            self.test_mongo.register_html_visited(page_visited="http://www.mola.es/%d" % i, user="alfredo",
+                                                  html_code="<p>%d %s</p>" % (i, LanguageDetectionTest.SPANISH_TEXT))
+        self.assertEqual(language.detection_stats['cached'], cached)
+
+        with self.settings(HTML_MINING_ASYNC=True):
+            self.test_mongo.register_html_visited(page_visited="http://mola.es/portada", user="alfredo",
+                                                  html_code="<p>Portada</p>")
+        call_command('mine_html')
+        self.assertEqual(language.detection_stats['cached'], cached + 1)
+        page = self.test_mongo.db.htmlVisited.find_one({'page_visited': "http://mola.es/portada"})
+        self.assertEqual(page["language"], "spanish")
+
+@override_settings(HTML_MINING_ASYNC=False, HTML_DEDUPLICATION=False)
+class ProcessKeywordsTest(ModelsMongoTest):
+    """ Tests for the keywords of the pages added to the ones of their users """
+
+    def register_html_visited(self, user, text):
+        self.test_mongo.register_html_visited(page_visited="http://mola.com", user=user,
+                                              html_code="<html><body>%s</body></html>" % text)
+
+    def test_process_keywords_in_batches(self):
+        for user, text in [("alfredo", "noticias hoy"), ("amparo", "noticias"), ("alfredo", "noticias"),
+                           ("amparo", "portada portada"), ("alfredo", "hoy")]:
+            self.register_html_visited(user, text)
+        with self.settings(HTML_MINING_ASYNC=True):
+            self.register_html_visited("alfredo", "pendiente")
+
+        self.assertEqual(self.test_mongo.add_non_processed_keywords(batch_size=2), (5, 2))
+        self.assertEqual(self.test_mongo.get_user_keywords("alfredo")["site_keywords_freq"],
+                         {"noticias": 2, "hoy": 2})
+        user_keywords = self.test_mongo.get_user_keywords("amparo")
+        self.assertEqual(user_keywords["site_keywords_freq"], {"noticias": 1, "portada": 2})
+        self.assertEqual(user_keywords["metadata_keywords_freq"], {})
+        self.assertEqual(self.test_mongo.db.htmlVisited.find({"processed": True}).count(), 5)
+
+        # Pages are processed only once
+        self.assertEqual(self.test_mongo.add_non_processed_keywords(batch_size=2), (0, 0))
+        self.assertEqual(self.test_mongo.get_user_keywords("alfredo")["site_keywords_freq"],
+                         {"noticias": 2, "hoy": 2})
+        self.assertEqual(self.test_mongo.db.userKeywords.count(), 2)
+
+    def test_pages_not_processed_if_keywords_not_added(self):
+        self.register_html_visited("alfredo", "noticias hoy")
+
+        add_users_keywords = self.test_mongo.add_users_keywords
+        def fail(users_keywords):
+            raise BulkWriteError({})
+        self.test_mongo.add_users_keywords = fail
+        try:
+            self.assertRaises(BulkWriteError, self.test_mongo.add_non_processed_keywords, 2)
+        finally:
+            self.test_mongo.add_users_keywords = add_users_keywords
+        self.assertEqual(self.test_mongo.db.htmlVisited.find({"processed": True}).count(), 0)
+
+        self.assertEqual(self.test_mongo.add_non_processed_keywords(batch_size=2), (1, 1))
+        self.assertEqual(self.test_mongo.get_user_keywords("alfredo")["site_keywords_freq"],
+                         {"noticias": 1, "hoy": 1})
+
+@override_settings(HTML_MINING_ASYNC=False, HTML_DEDUPLICATION=False, KEYWORDS_COMPACT_STORAGE=True)
+class KeywordsCompactStorageTest(ModelsMongoTest):
+    """ Tests for keywords frequencies saved as arrays of ids in the keywords vocabulary """
+
+    HTML_CODE = ("<html><head><title>Noticias de \u00faltima</title></head>"
+                 "<body>Hola, noticias de hoy. Noticias de \u00faltima hora</body></html>")
+
+    def test_keywords_freq_packed(self):
+        self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                              html_code=self.HTML_CODE)
+
+        keywords_freq = self.test_mongo.db.htmlVisited.find_one()["keywords_freq"]
+        self.assertTrue(self.test_mongo.is_packed_keywords_freq(keywords_freq["text"]))
+        self.assertEqual(len(keywords_freq["text"]["ids"]), 4 * 5)
+        self.assertEqual(self.test_mongo.get_user_html_keywords_freqs("alfredo")[0]["text"],
+                         {"noticias": 3, "\u00faltima": 2, "hola": 1, "hoy": 1, "hora": 1})
+
+    def test_vocabulary_ids_reused(self):
+        keywords_ids = self.test_mongo.get_keywords_ids(["noticias", "hoy"])
+        self.test_mongo.keywords_ids_cache.clear()
+        self.test_mongo.keywords_cache.clear()
+
+        self.assertEqual(self.test_mongo.get_keywords_ids(["hoy", "hora", "noticias"]),
+                         dict(keywords_ids, hora=max(keywords_ids.values()) + 1))
+        self.assertEqual(self.test_mongo.db.keywords.count(), 3)
+        self.assertEqual(self.test_mongo.get_keywords(keywords_ids.values()),
+                         dict((keyword_id, keyword) for keyword, keyword_id in keywords_ids.items()))
+
+    def test_add_keywords_freqs(self):
+        keywords_freq = self.test_mongo.pack_keywords_freq({"noticias": 2, "hoy": 1})
+        total = self.test_mongo.add_keywords_freqs(keywords_freq, {"noticias": 1, "hora": 5})
+
+        self.assertTrue(self.test_mongo.is_packed_keywords_freq(total))
+        self.assertEqual(self.test_mongo.unpack_keywords_freq(total), {"noticias": 3, "hoy": 1, "hora": 5})
+        with self.settings(KEYWORDS_COMPACT_STORAGE=False):
+            self.assertEqual(self.test_mongo.add_keywords_freqs(total, {"hoy": 1}),
+                             {"noticias": 3, "hoy": 2, "hora": 5})
+
+    def test_process_keywords(self):
+        with self.settings(KEYWORDS_COMPACT_STORAGE=False):
+            self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                                  html_code=self.HTML_CODE)
+        call_command('process_keywords')
+        self.test_mongo.register_html_visited(page_visited="http://mola.com/2", user="alfredo",
+                                              html_code=self.HTML_CODE)
+        call_command('process_keywords')
+
+        user_keywords = self.test_mongo.db.userKeywords.find_one()
+        self.assertTrue(self.test_mongo.is_packed_keywords_freq(user_keywords["site_keywords_freq"]))
+        user_keywords = self.test_mongo.get_user_keywords("alfredo")
+        self.assertEqual(user_keywords["site_keywords_freq"],
+                         {"noticias": 6, "\u00faltima": 4, "hola": 2, "hoy": 2, "hora": 2})
+        self.assertEqual(user_keywords["metadata_keywords_freq"], {"noticias": 2, "\u00faltima": 2})
+
+    def test_packed_keywords_added_as_dicts(self):
+        self.test_mongo.register_html_visited(page_visited="http://mola.com", user="alfredo",
+                                              html_code=self.HTML_CODE)
+        call_command('process_keywords')
+        with self.settings(KEYWORDS_COMPACT_STORAGE=False):
+            self.test_mongo.register_html_visited(page_visited="http://mola.com/2", user="alfredo",
+                                                  html_code=self.HTML_CODE)
+            call_command('process_keywords')
+
+        user_keywords = self.test_mongo.db.userKeywords.find_one()
+        self.assertEqual(user_keywords["site_keywords_freq"],
+                         {"noticias": 6, "\u00faltima": 4, "hola": 2, "hoy": 2, "hora": 2})
+        self.assertEqual(user_keywords["metadata_keywords_freq"], {"noticias": 2, "\u00faltima": 2})
+
+@override_settings(OPENDNS_ASYNC_CATEGORIZATION=False)
 class PageVisitedResourceTest(AuthenticableResourceTest, CategorizableResourceTest):
     """
     Page visited service tests
@@ -737,6 +1511,14 @@ class PageVisitedResourceTest(AuthenticableResourceTest, CategorizableResourceTe
         return self.api_client.post(API_URI['page_visited'], data=page_visited_data,
                                     format='json', HTTP_SESSION_TOKEN=session_token)
 
+    def perform_pages_visited(self, pages, session_token=None):
+
+        if session_token is None:
+            session_token = self.session_token
+
+        return self.api_client.post(API_URI['page_visited_batch'], data={'objects': pages},
+                                    format='json', HTTP_SESSION_TOKEN=session_token)
+
     def get_pages_visited(self, session_token=None):
 
         if session_token is None:
@@ -893,18 +1675,33 @@ class PageVisitedResourceTest(AuthenticableResourceTest, CategorizableResourceTe
         num_pages = PageVisited.objects.filter(user=self.user).count()
         self.assertEqual(num_pages, 2)
 
-    def test_two_domains_added(self):
+    def test_subdomains_rolled_up(self):
         resp = self.perform_page_visited(url="http://www.lol.com")
         self.assertHttpCreated(resp)
 
-        domains = CategorizedDomain.objects.filter(domain="www.lol.com").count()
+        domains = CategorizedDomain.objects.filter(domain="lol.com").count()
         self.assertEqual(domains, 1)
 
-        resp = self.perform_page_visited(url="http://lol.com")
+        for url in ["http://lol.com", "http://m.lol.com/2", "http://WWW.Lol.com:80/3"]:
+            resp = self.perform_page_visited(url=url)
+            self.assertHttpCreated(resp)
+
+        self.assertEqual(list(CategorizedDomain.objects.values_list('domain', flat=True)), ["lol.com"])
+        domain = CategorizedDomain.objects.get(domain="lol.com")
+        self.assertEqual(PageVisited.objects.filter(user=self.user, domain=domain).count(), 4)
+
+    def test_saved_subdomain_preferred(self):
+        blog = CategorizedDomain.objects.create(domain="blog.lol.com", last_checked=self.now())
+        blog.add_categories(["Blogs"])
+
+        resp = self.perform_page_visited(url="http://Blog.lol.com:8080/post")
+        self.assertHttpCreated(resp)
+        resp = self.perform_page_visited(url="http://www.lol.com")
         self.assertHttpCreated(resp)
 
-        domains = CategorizedDomain.objects.filter(domain="lol.com").count()
-        self.assertEqual(domains, 1)
+        self.assertEqual(PageVisited.objects.get(page_visited="http://Blog.lol.com:8080/post").domain, blog)
+        self.assertEqual(PageVisited.objects.get(page_visited="http://www.lol.com").domain.domain, "lol.com")
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Blogs").weigh, 1)
 
     def test_domains_repeated(self):
         resp = self.perform_page_visited(url="http://www.lol.com")
@@ -913,14 +1710,14 @@ class PageVisitedResourceTest(AuthenticableResourceTest, CategorizableResourceTe
         resp = self.perform_page_visited(url="http://www.lol.com/2")
         self.assertHttpCreated(resp)
 
-        domains = CategorizedDomain.objects.filter(domain="www.lol.com").count()
+        domains = CategorizedDomain.objects.filter(domain="lol.com").count()
         self.assertEqual(domains, 1)
 
     def test_categorized_domain(self):
         resp = self.perform_page_visited(url="http://www.lol.com")
         self.assertHttpCreated(resp)
 
-        domain = CategorizedDomain.objects.get(domain="www.lol.com")
+        domain = CategorizedDomain.objects.get(domain="lol.com")
         self.assertEqual([x.name for x in domain.categories.all()], ['Humor'])
 
     def test_categorized_domain_multiple_categories(self):
@@ -991,6 +1788,523 @@ class PageVisitedResourceTest(AuthenticableResourceTest, CategorizableResourceTe
         self.assertEqual(set(resp_data),
                          set(['Software/Technology', 'Research/Reference', 'Forums/Message boards']))
 
+    def test_add_pages_batch(self):
+        pages = [{'user': self.user_resource, 'url': "http://www.lol.com", 'date': "2014-01-01 00:00:00"},
+                 {'user': self.user_resource, 'url': "http://www.lol.com/2", 'date': "2014-01-01 00:00:01"},
+                 {'user': self.user_resource, 'url': "http://stackoverflow.com", 'date': "2014-01-01 00:00:02"}]
+        resp = self.perform_pages_visited(pages)
+        self.assertHttpAccepted(resp)
+
+        resp_data = self.deserialize(resp)
+        self.assertEqual([x['result'] for x in resp_data['objects']], ["OK", "OK", "OK"])
+        self.assertEqual(PageVisited.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(CategorizedDomain.objects.filter(domain="lol.com").count(), 1)
+
+        humor = UserCategorization.objects.get(user=self.user, category__name="Humor")
+        self.assertEqual(humor.weigh, 2)
+        categories = CategorizedDomain.objects.get(domain="stackoverflow.com").categories.all()
+        for cat in categories:
+            user_cat = UserCategorization.objects.get(user=self.user, category=cat)
+            self.assertEqual(user_cat.weigh, 1)
+
+    def test_add_pages_batch_results_per_page(self):
+        other_user = User.objects.create_user("Kuntakinte", "kunta@gmail.com", "joasjoasjoas")
+        other_user_resource = UserResource().get_resource_uri(other_user)
+
+        pages = [{'user': self.user_resource, 'url': "http://www.lol.com", 'date': "2014-01-01 00:00:00"},
+                 {'user': self.user_resource, 'url': "www.lol.com", 'date': "2014-01-01 00:00:00"},
+                 {'user': other_user_resource, 'url': "http://www.lol.com", 'date': "2014-01-01 00:00:00"}]
+        resp = self.perform_pages_visited(pages)
+        self.assertHttpAccepted(resp)
+
+        resp_data = self.deserialize(resp)
+        self.assertEqual(resp_data['objects'][0]['result'], "OK")
+        self.assertEqual(resp_data['objects'][1]['reason'], "BAD_PARAMETERS")
+        self.assertKeys(resp_data['objects'][1]['erroneous_parameters'], ['url'])
+        self.assertEqual(resp_data['objects'][2]['reason'], "UNAUTHORIZED")
+        self.assertEqual(PageVisited.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(PageVisited.objects.filter(user=other_user).count(), 0)
+
+    def test_add_pages_batch_without_session(self):
+        pages = [{'user': self.user_resource, 'url': "http://www.lol.com", 'date': "2014-01-01 00:00:00"}]
+        resp = self.perform_pages_visited(pages, session_token="asdasd")
+        self.assertHttpUnauthorized(resp)
+
+    def test_add_page_queries_do_not_depend_on_categories(self):
+        # Authenticated requests do not query the session once it is cached
+        self.assertHttpOK(self.get_pages_visited())
+
+        # Domain and domain categories (first visit only, then it is cached), insertion, user
+        # categorizations and their creation (first visit) or update (next visits)
+        for domain, categories in [("www.one.com", ["News/Media"]),
+                                   ("www.three.com", ["Sports", "Games", "Travel"])]:
+            categorized_domain = CategorizedDomain.objects.create(domain=domain, last_checked=self.now())
+            categorized_domain.add_categories(categories)
+
+            url = "http://%s/index.html" % domain
+            with self.assertNumQueries(5):
+                resp = self.perform_page_visited(url=url)
+            self.assertHttpCreated(resp)
+            with self.assertNumQueries(3):
+                resp = self.perform_page_visited(url=url)
+            self.assertHttpCreated(resp)
+
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="News/Media").weigh, 2)
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Games").weigh, 2)
+
+    def test_domain_cache_invalidated_by_new_categories(self):
+        categorized_domain = CategorizedDomain.objects.create(domain="www.one.com", last_checked=self.now())
+        categorized_domain.add_categories(["News/Media"])
+
+        local_hits = domains_cache.stats()['local_hits']
+        self.assertHttpCreated(self.perform_page_visited(url="http://www.one.com/"))
+        self.assertHttpCreated(self.perform_page_visited(url="http://www.one.com/"))
+        self.assertEqual(domains_cache.stats()['local_hits'], local_hits + 1)
+
+        categorized_domain.add_categories(["Sports"])
+        self.assertHttpCreated(self.perform_page_visited(url="http://www.one.com/"))
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="News/Media").weigh, 3)
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Sports").weigh, 1)
+
+    def test_unknown_categories_reload_limited(self):
+        user_categories_cache.get("Sports")
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.assertRaises(UserCategory.DoesNotExist, user_categories_cache.get, "Unknown")
+
+        # Created by another process (without signals), noticed once the reloads are allowed again
+        UserCategory.objects.bulk_create([UserCategory(name="Unknown", taxonomy="opendns")])
+        self.assertRaises(UserCategory.DoesNotExist, user_categories_cache.get, "Unknown")
+        rows = user_categories_cache._rows
+        user_categories_cache._rows = rows[:2] + (rows[2] - constants.REFERENCE_DATA_CACHE_MIN_RELOAD_SECONDS,)
+        with self.assertNumQueries(1):
+            self.assertEqual(user_categories_cache.get("Unknown").name, "Unknown")
+
+    def test_add_pages_batch_not_a_list(self):
+        resp = self.perform_pages_visited("http://www.lol.com")
+        self.assertHttpBadRequest(resp)
+        resp_data = self.deserialize(resp)
+        self.assertEqual(resp_data['reason'], "BAD_PARAMETERS")
+
+class LoadDomainsTest(CategorizableResourceTest):
+    """ Loading of the OpenDNS domains dump """
+
+    DOMAINS_DUMP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "dump", "opendns", "domains.bson")
+
+    def test_load_domains(self):
+        CategorizedDomain.objects.create(domain="www.elmundo.es")
+
+        call_command('load_domains', self.DOMAINS_DUMP, batch_size=10)
+
+        # 98 different domains in the dump
+        self.assertEqual(CategorizedDomain.objects.count(), 98)
+        self.assertEqual(opendns.getCategories("www.lotame.com"), ["Advertising"])
+        self.assertEqual(opendns.getCategories("trello.com"), [])
+        # Domains already saved are not modified
+        self.assertEqual(opendns.getCategories("www.elmundo.es"), [])
+
+        call_command('load_domains', self.DOMAINS_DUMP)
+        self.assertEqual(CategorizedDomain.objects.count(), 98)
+
+    def test_domains_normalized(self):
+        with tempfile.NamedTemporaryFile() as domains_dump:
+            for domain in ["WWW.Mola.com.", "www.mola.com", "www.mola.com:80", "a" * 300 + ".com", 42]:
+                domains_dump.write(bson.BSON.encode({'domain': domain, 'categories': ["Humor"]}))
+            domains_dump.flush()
+            call_command('load_domains', domains_dump.name)
+
+        self.assertEqual(list(CategorizedDomain.objects.values_list('domain', flat=True)), ["www.mola.com"])
+        self.assertEqual(opendns.getCategories("www.mola.com"), ["Humor"])
+
+    def test_opendns_names_mapped(self):
+        added, skipped, unknown_categories = opendns.add_categorized_domains({
+            "stackoverflow.com": ["Software/Technolog...", "Forums/Message boards", "Not a category"]})
+
+        self.assertEqual((added, skipped, unknown_categories), (1, 0, 1))
+        self.assertEqual(sorted(opendns.getCategories("stackoverflow.com")),
+                         ["Forums/Message boards", "Software/Technology"])
+
+class RegistrableDomainTest(TestCase):
+    """ Normalization of hosts and public suffix list lookups """
+
+    def test_normalize_host(self):
+        self.assertEqual(normalize_host("WWW.ElPais.com"), "www.elpais.com")
+        self.assertEqual(normalize_host("elpais.com:80"), "elpais.com")
+        self.assertEqual(normalize_host("user:password@elpais.com:8080"), "elpais.com")
+        self.assertEqual(normalize_host("elpais.com."), "elpais.com")
+        self.assertEqual(normalize_host("[::1]:8000"), "[::1]")
+
+    def test_registrable_domain(self):
+        self.assertEqual(get_registrable_domain("m.elpais.com"), "elpais.com")
+        self.assertEqual(get_registrable_domain("elpais.com"), "elpais.com")
+        self.assertEqual(get_registrable_domain("www.bbc.co.uk"), "bbc.co.uk")
+        self.assertEqual(get_registrable_domain("www.example.unknowntld"), "example.unknowntld")
+        # Private suffixes are included
+        self.assertEqual(get_registrable_domain("a.foo.blogspot.com"), "foo.blogspot.com")
+
+    def test_wildcard_and_exception_rules(self):
+        # *.ck and !www.ck
+        self.assertEqual(get_registrable_domain("a.b.c.ck"), "b.c.ck")
+        self.assertEqual(get_registrable_domain("a.www.ck"), "www.ck")
+        self.assertEqual(get_registrable_domain("b.ck"), None)
+
+    def test_no_registrable_domain(self):
+        for host in ["com", "co.uk", "localhost", "127.0.0.1", "[::1]", ""]:
+            self.assertEqual(get_registrable_domain(host), None)
+
+    def test_internationalized_domains(self):
+        self.assertEqual(get_registrable_domain("www.ejemplo.рф"), "ejemplo.рф")
+        self.assertEqual(get_registrable_domain("www.ejemplo.xn--p1ai"), "ejemplo.xn--p1ai")
+
+@override_settings(OPENDNS_ASYNC_CATEGORIZATION=True)
+class PendingDomainsTest(AuthenticableResourceTest, CategorizableResourceTest, OpenDNSStubTest):
+    """ Tests for domains categorized in background """
+
+    OPENDNS_DOMAINS_CATEGORIES = {
+        'lol.com': ["Humor"],
+        'www.lol.com': ["Humor"],
+        'stackoverflow.com': ["Software/Technolog...", "Research/Reference"],
+        'weird.com': ["Not a category"],
+        'www.weird.com': ["Not a category"],
+        'www.weird2.com': ["Not a category"],
+        'www.weird3.com': ["Not a category"],
+        'www.unstable.com': ["News/Media"],
+        'www.down.com': ["News/Media"],
+        'www.down2.com': ["News/Media"],
+        'www.down3.com': ["News/Media"],
+        'www.down4.com': ["News/Media"]
+    }
+    OPENDNS_FAILURES = {
+        'www.unstable.com': 1,
+        'www.down.com': constants.OPENDNS_MAX_RETRIES + 1,
+        'www.down2.com': constants.OPENDNS_MAX_RETRIES + 1,
+        'www.down3.com': constants.OPENDNS_MAX_RETRIES + 1,
+        'www.down4.com': constants.OPENDNS_MAX_RETRIES + 1
+    }
+
+    def setUp(self):
+        super(PendingDomainsTest, self).setUp()
+        self.perform_login()
+
+    def perform_page_visited(self, url, user_resource=None, session_token=None):
+
+        if user_resource is None:
+            user_resource = self.user_resource
+        if session_token is None:
+            session_token = self.session_token
+
+        page_visited_data = {
+            'user': user_resource,
+            'url': url,
+            'date': "2014-01-01 00:00:00"
+        }
+        return self.api_client.post(API_URI['page_visited'], data=page_visited_data,
+                                    format='json', HTTP_SESSION_TOKEN=session_token)
+
+    def test_unseen_domain_pending(self):
+        resp = self.perform_page_visited("http://www.lol.com")
+        self.assertHttpCreated(resp)
+
+        domain = CategorizedDomain.objects.get(domain="lol.com")
+        self.assertTrue(domain.pending)
+        self.assertEqual(domain.categories.count(), 0)
+        self.assertEqual(PageVisited.objects.filter(domain=domain).count(), 1)
+        self.assertEqual(UserCategorization.objects.filter(user=self.user).count(), 0)
+        self.assertEqual(self.opendns.requests, [])
+
+    def test_pending_domains_resolved(self):
+        other_user = User.objects.create_user("Kuntakinte", "kunta@gmail.com", "joasjoasjoas")
+        other_user_token = other_user.new_session(self.client)
+        other_user_resource = UserResource().get_resource_uri(other_user)
+
+        self.perform_page_visited("http://stackoverflow.com")
+        self.perform_page_visited("http://stackoverflow.com/questions")
+        self.perform_page_visited("http://www.lol.com")
+        self.perform_page_visited("http://stackoverflow.com", user_resource=other_user_resource,
+                                  session_token=other_user_token)
+
+        call_command('resolve_domains')
+        self.assertEqual(set(self.opendns.requests), set(["stackoverflow.com", "lol.com"]))
+
+        domain = CategorizedDomain.objects.get(domain="stackoverflow.com")
+        self.assertFalse(domain.pending)
+        self.assertEqual(set([x.name for x in domain.categories.all()]),
+                         set(['Software/Technology', 'Research/Reference']))
+        for cat in domain.categories.all():
+            self.assertEqual(UserCategorization.objects.get(user=self.user, category=cat).weigh, 2)
+            self.assertEqual(UserCategorization.objects.get(user=other_user, category=cat).weigh, 1)
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Humor").weigh, 1)
+
+        # Once categorized, new visits get the categories immediately
+        self.perform_page_visited("http://www.lol.com/2")
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Humor").weigh, 2)
+        self.assertEqual(len(self.opendns.requests), 2)
+
+    def test_pending_domain_not_categorizable(self):
+        self.perform_page_visited("http://www.weird.com")
+
+        call_command('resolve_domains')
+        self.assertTrue(CategorizedDomain.objects.get(domain="weird.com").pending)
+        self.assertEqual(UserCategorization.objects.filter(user=self.user).count(), 0)
+
+    def test_failed_domain_backoff(self):
+        self.perform_page_visited("http://www.weird.com")
+
+        call_command('resolve_domains')
+        domain = CategorizedDomain.objects.get(domain="weird.com")
+        self.assertEqual(domain.failures, 1)
+        self.assertGreater(domain.retry_after, self.now())
+
+        # Not queried again until the backoff passes
+        call_command('resolve_domains')
+        self.assertEqual(self.opendns.requests, ["weird.com"])
+
+        CategorizedDomain.objects.filter(pk=domain.pk).update(retry_after=self.now())
+        call_command('resolve_domains')
+        self.assertEqual(self.opendns.requests, ["weird.com", "weird.com"])
+        domain = CategorizedDomain.objects.get(domain="weird.com")
+        self.assertEqual(domain.failures, 2)
+        self.assertGreater(domain.retry_after - self.now(),
+                           datetime.timedelta(seconds=constants.OPENDNS_FAILURE_BACKOFF_SECONDS))
+
+    def test_failed_domain_not_queried_on_visits(self):
+        with self.settings(OPENDNS_ASYNC_CATEGORIZATION=False):
+            self.assertHttpCreated(self.perform_page_visited("http://www.weird.com"))
+            self.assertHttpCreated(self.perform_page_visited("http://www.weird.com/2"))
+
+        self.assertEqual(self.opendns.requests, ["weird.com"])
+        domain = CategorizedDomain.objects.get(domain="weird.com")
+        self.assertTrue(domain.pending)
+        self.assertEqual(domain.failures, 1)
+        self.assertEqual(PageVisited.objects.filter(domain=domain).count(), 2)
+
+    def test_circuit_breaker(self):
+        domains = ["www.down.com", "www.down2.com", "www.down3.com", "www.down4.com"]
+        opendns.add_pending_domains(domains)
+
+        circuit_breaker = opendns.circuit_breaker
+        opendns.circuit_breaker = CircuitBreaker(error_rate=0.5, min_calls=2, window=60, cooldown=300)
+        try:
+            # The first domain is retried once before the breaker opens
+            resolved, failed = opendns.resolve_pending_domains()
+            self.assertEqual(len(self.opendns.requests), 2)
+            self.assertEqual((resolved, failed), (0, 4))
+            self.assertEqual(opendns.circuit_breaker.stats()['trips'], 1)
+            self.assertEqual(opendns.circuit_breaker.stats()['rejected'], 3)
+
+            # Domains not queried don't wait for a backoff
+            self.assertEqual(CategorizedDomain.objects.filter(failures=1).count(), 1)
+            self.assertEqual(CategorizedDomain.objects.filter(failures=0, pending=True).count(), 3)
+
+            opendns.resolve_pending_domains()
+            self.assertEqual(len(self.opendns.requests), 2)
+        finally:
+            opendns.circuit_breaker = circuit_breaker
+
+    def test_uncategorizable_domains_not_breaker_failures(self):
+        domains = ["www.weird.com", "www.weird2.com", "www.weird3.com"]
+        opendns.add_pending_domains(domains)
+
+        circuit_breaker = opendns.circuit_breaker
+        opendns.circuit_breaker = CircuitBreaker(error_rate=0.5, min_calls=2, window=60, cooldown=300)
+        try:
+            resolved, failed = opendns.resolve_pending_domains()
+            self.assertEqual(sorted(self.opendns.requests), domains)
+            self.assertEqual((resolved, failed), (0, 3))
+            self.assertEqual(opendns.circuit_breaker.stats()['trips'], 0)
+            self.assertEqual(opendns.circuit_breaker.stats()['successes'], 3)
+
+            # They still wait for their backoff
+            self.assertEqual(CategorizedDomain.objects.filter(failures=1, pending=True).count(), 3)
+        finally:
+            opendns.circuit_breaker = circuit_breaker
+
+    def test_concurrent_lookups_coalesced(self):
+        self.opendns.delay = 0.2
+        results = []
+
+        def lookup():
+            results.append(opendns.fetch_new_domain_categories("stackoverflow.com"))
+
+        threads = [threading.Thread(target=lookup) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.opendns.requests, ["stackoverflow.com"])
+        self.assertEqual(results, [["Software/Technology", "Research/Reference"]] * 10)
+
+    def test_domain_saved_meanwhile_by_other_process(self):
+        def fetch_new_domain_categories(domain):
+            categorized_domain = CategorizedDomain.objects.create(domain=domain, last_checked=self.now())
+            categorized_domain.add_categories(["Humor"])
+            return ["News/Media"]
+
+        original_fetch_new_domain_categories = opendns.fetch_new_domain_categories
+        opendns.fetch_new_domain_categories = fetch_new_domain_categories
+        try:
+            with self.settings(OPENDNS_ASYNC_CATEGORIZATION=False):
+                categorized_domain, categories = opendns.get_categorized_domain("lol.com")
+        finally:
+            opendns.fetch_new_domain_categories = original_fetch_new_domain_categories
+
+        self.assertEqual(CategorizedDomain.objects.filter(domain="lol.com").count(), 1)
+        self.assertEqual([cat.name for cat in categories], ["Humor"])
+
+    def test_failed_requests_retried(self):
+        opendns.add_pending_domains(["www.unstable.com", "www.down.com"])
+
+        resolved, failed = opendns.resolve_pending_domains()
+        self.assertEqual((resolved, failed), (1, 1))
+        self.assertFalse(CategorizedDomain.objects.get(domain="www.unstable.com").pending)
+        self.assertTrue(CategorizedDomain.objects.get(domain="www.down.com").pending)
+        self.assertEqual(self.opendns.requests.count("www.down.com"), constants.OPENDNS_MAX_RETRIES + 1)
+
+    def test_connections_kept_alive(self):
+        domains = ["www.domain%d.com" % i for i in range(20)]
+        opendns.add_pending_domains(domains)
+
+        resolved, failed = opendns.resolve_pending_domains(threads=4)
+        self.assertEqual((resolved, failed), (20, 0))
+        self.assertEqual(sorted(self.opendns.requests), sorted(domains))
+        self.assertLessEqual(self.opendns.connections, 4)
+
+    def test_domains_file_resolved(self):
+        CategorizedDomain.objects.create(domain="lol.com")
+        self.perform_page_visited("http://stackoverflow.com")
+
+        # Domains are saved as they are when visited
+        with tempfile.NamedTemporaryFile() as domains_file:
+            domains_file.write("WWW.Lol.com\nstackoverflow.com\n\nwww.weird.com:80\n")
+            domains_file.flush()
+            call_command('resolve_domains', file=domains_file.name, threads=2, rate=100)
+
+        self.assertEqual(sorted(self.opendns.requests), ["stackoverflow.com", "weird.com"])
+        self.assertEqual(sorted(opendns.getCategories("stackoverflow.com")),
+                         ['Research/Reference', 'Software/Technology'])
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Research/Reference").weigh, 1)
+        self.assertTrue(CategorizedDomain.objects.get(domain="weird.com").pending)
+        self.assertEqual(CategorizedDomain.objects.count(), 3)
+
+    def test_expired_domain_refreshed(self):
+        categorized_domain = CategorizedDomain.objects.create(
+            domain="stackoverflow.com",
+            last_checked=self.now() - datetime.timedelta(days=constants.DOMAIN_CATEGORIES_TTL_DAYS + 1))
+        categorized_domain.add_categories(["News/Media", "Software/Technology"])
+
+        # Expired categories are still used until they are refreshed
+        self.perform_page_visited("http://stackoverflow.com")
+        self.perform_page_visited("http://stackoverflow.com/questions")
+        self.assertTrue(CategorizedDomain.objects.get(domain="stackoverflow.com").refresh)
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="News/Media").weigh, 2)
+        self.assertEqual(self.opendns.requests, [])
+
+        call_command('resolve_domains', refresh=True)
+        self.assertEqual(self.opendns.requests, ["stackoverflow.com"])
+
+        categorized_domain = CategorizedDomain.objects.get(domain="stackoverflow.com")
+        self.assertFalse(categorized_domain.refresh)
+        self.assertFalse(categorized_domain.categories_expired())
+        self.assertEqual(sorted(opendns.getCategories("stackoverflow.com")),
+                         ['Research/Reference', 'Software/Technology'])
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="News/Media").weigh, 0)
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Software/Technology").weigh, 2)
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Research/Reference").weigh, 2)
+
+        self.perform_page_visited("http://stackoverflow.com/tags")
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Research/Reference").weigh, 3)
+
+    def test_domain_not_expired_not_refreshed(self):
+        CategorizedDomain.objects.create(domain="www.lol.com", last_checked=self.now())
+        self.perform_page_visited("http://www.lol.com")
+        self.assertFalse(CategorizedDomain.objects.get(domain="www.lol.com").refresh)
+
+        call_command('resolve_domains', refresh=True)
+        self.assertEqual(self.opendns.requests, [])
+
+@override_settings(OPENDNS_ASYNC_CATEGORIZATION=True)
+class PendingDomainsVisitsTest(TransactionTestCase):
+    """ Visits of pending domains saved while they are resolved, with the transactions committed """
+
+    def setUp(self):
+        super(PendingDomainsVisitsTest, self).setUp()
+        domains_cache.clear()
+        for category in opendns.CATEGORIES.values():
+            UserCategory.objects.create(name=category, taxonomy="opendns")
+        self.user = User.objects.create_user('alfredo', 'alfredo@example.com', '1aragon1')
+        Client.objects.create(client_name="test-client")
+
+        self.api_client = TestApiClient()
+        resp = self.api_client.post(API_URI['login'], format='json',
+                                    data={'username': 'alfredo', 'key': '1aragon1', 'client': "test-client"})
+        login = json.loads(resp.content)
+        self.user_resource = login['user_resource']
+        self.session_token = login['session_token']
+
+    def perform_page_visited(self, url):
+        return self.api_client.post(API_URI['page_visited'], format='json', HTTP_SESSION_TOKEN=self.session_token,
+                                    data={'user': self.user_resource, 'url': url, 'date': "2014-01-01 00:00:00"})
+
+    def perform_pages_visited(self, *urls):
+        pages = [{'user': self.user_resource, 'url': url, 'date': "2014-01-01 00:00:00"} for url in urls]
+        return self.api_client.post(API_URI['page_visited_batch'], format='json',
+                                    HTTP_SESSION_TOKEN=self.session_token, data={'objects': pages})
+
+    def test_visits_counted_once(self):
+        self.assertEqual(self.perform_page_visited("http://www.lol.com/1").status_code, 201)
+        categorized_domain = CategorizedDomain.objects.get(domain="lol.com")
+        self.assertTrue(categorized_domain.pending)
+
+        # Resolved after the next requests read the domain pending, before they save their visits
+        get_categorized_domain = opendns.get_categorized_domain
+        def get_categorized_domain_and_resolve(domain, *args, **kwargs):
+            result = get_categorized_domain(domain, *args, **kwargs)
+            if CategorizedDomain.objects.get(pk=categorized_domain.pk).pending:
+                opendns.save_resolved_domains({categorized_domain: ["Humor", "Games"]})
+            return result
+
+        opendns.get_categorized_domain = get_categorized_domain_and_resolve
+        try:
+            self.assertEqual(self.perform_page_visited("http://www.lol.com/2").status_code, 201)
+        finally:
+            opendns.get_categorized_domain = get_categorized_domain
+        self.assertEqual(self.perform_page_visited("http://www.lol.com/3").status_code, 201)
+
+        for category in ["Humor", "Games"]:
+            self.assertEqual(UserCategorization.objects.get(user=self.user, category__name=category).weigh, 3)
+
+    def test_batch_visits_counted_once(self):
+        self.assertEqual(self.perform_page_visited("http://www.lol.com/1").status_code, 201)
+        categorized_domain = CategorizedDomain.objects.get(domain="lol.com")
+
+        get_categorized_domain = opendns.get_categorized_domain
+        def get_categorized_domain_and_resolve(domain, *args, **kwargs):
+            result = get_categorized_domain(domain, *args, **kwargs)
+            if CategorizedDomain.objects.get(pk=categorized_domain.pk).pending:
+                opendns.save_resolved_domains({categorized_domain: ["Humor"]})
+            return result
+
+        opendns.get_categorized_domain = get_categorized_domain_and_resolve
+        try:
+            self.assertEqual(self.perform_pages_visited("http://www.lol.com/2", "http://www.lol.com/3").status_code,
+                             202)
+        finally:
+            opendns.get_categorized_domain = get_categorized_domain
+
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Humor").weigh, 3)
+
+    def test_resolved_once(self):
+        self.assertEqual(self.perform_page_visited("http://www.lol.com/1").status_code, 201)
+        categorized_domain = CategorizedDomain.objects.get(domain="lol.com")
+
+        # Another resolver saved it first
+        opendns.save_resolved_domains({categorized_domain: ["Humor"]})
+        opendns.save_resolved_domains({categorized_domain: ["Humor"]})
+        self.assertEqual(UserCategorization.objects.get(user=self.user, category__name="Humor").weigh, 1)
+        self.assertEqual(categorized_domain.categories.count(), 1)
+
 class SearchQueryResourceTest(AuthenticableResourceTest):
     """ Test case for search engines queries """
 
@@ -1038,6 +2352,13 @@ class SearchQueryResourceTest(AuthenticableResourceTest):
         return self.api_client.patch(API_URI['search_query'], data=data, format='json',
                                      HTTP_SESSION_TOKEN=session_token)
 
+    def bulk_search_queries(self, session_token, *queries):
+
+        data = {"objects": list(queries)}
+
+        return self.api_client.post(API_URI['search_query_bulk'], data=data, format='json',
+                                    HTTP_SESSION_TOKEN=session_token)
+
     ######################
     # Security tests
     ######################
@@ -1262,3 +2583,50 @@ class SearchQueryResourceTest(AuthenticableResourceTest):
         # It is not possible to test correct rollback of the database as TransactionTestCase
         # would be needed. They are currently not supported by TastyPie tests
 
+    def test_bulk_searches(self):
+        search_query_1 = {'search_query': "Carrozas de papel 1", 'search_results': "http://unamierda.com",
+                          'date': "2014-01-01 00:00:00"}
+        search_query_2 = {'search_query': "Carrozas de papel 2", 'search_results': "http://unamierda.com",
+                          'date': "2014-01-01 00:00:01"}
+        search_query_3 = self.search_query(user_resource=self.user_resource,
+                                           search_query="Carrozas de papel 3",
+                                           search_results="http://unamierda.com")
+
+        with self.assertNumQueries(2): # Session and insertion
+            resp = self.bulk_search_queries(self.session_token, search_query_1, search_query_2,
+                                            search_query_3)
+        self.assertHttpCreated(resp)
+        self.assertEqual(Search.objects.filter(user=self.user, client=self.client).count(), 3)
+
+    def test_bulk_searches_none_saved_if_one_fails(self):
+        search_query_1 = {'search_query': "Carrozas de papel 1", 'search_results': "http://unamierda.com",
+                          'date': "2014-01-01 00:00:00"}
+        search_query_2 = {'search_query': "", 'search_results': "http://unamierda.com",
+                          'date': "2014-01-01 00:00:00"}
+
+        resp = self.bulk_search_queries(self.session_token, search_query_1, search_query_2)
+        self.assertHttpBadRequest(resp)
+        resp_data = self.deserialize(resp)
+        self.assertEqual(resp_data['reason'], "BAD_PARAMETERS")
+        self.assertEqual(resp_data['erroneous_parameters'][0], {})
+        self.assertKeys(resp_data['erroneous_parameters'][1], ['search_query'])
+        self.assertEqual(Search.objects.all().count(), 0)
+
+    def test_bulk_searches_other_user(self):
+        other_user = User.objects.create_user("Kuntakinte", "kunta@gmail.com", "joasjoasjoas")
+        other_user_resource = UserResource().get_resource_uri(other_user)
+
+        other_search_query = self.search_query(user_resource=other_user_resource,
+                                               search_query="Carrozas de papel",
+                                               search_results="http://unamierda.com")
+
+        resp = self.bulk_search_queries(self.session_token, other_search_query)
+        self.assertHttpUnauthorized(resp)
+        self.assertEqual(Search.objects.all().count(), 0)
+
+    def test_bulk_searches_no_session(self):
+        search_query = {'search_query': "Carrozas de papel", 'search_results': "http://unamierda.com",
+                        'date': "2014-01-01 00:00:00"}
+
+        resp = self.bulk_search_queries("", search_query)
+        self.assertHttpUnauthorized(resp)
@@ -0,0 +1,316 @@
+"""
+Generic helpers shared by the mnopi modules
+"""
+from collections import OrderedDict, deque
+import hashlib
+import sys
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    Bounded in-process cache. When it is full the least recently used entry is evicted,
+    and entries older than ttl seconds (if given) are considered missing
+
+    It is safe to use from several threads. Being in-process, every worker has its own
+    copy, so entries must be invalidated in every process or have a short ttl
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (value, insertion time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, inserted = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self.ttl is not None and time.time() - inserted > self.ttl:
+                self.misses += 1
+                return default
+
+            # Reinserted so that it becomes the most recently used
+            self._entries[key] = (value, inserted)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Returns a dict with the usage counters of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0
+        }
+
+class ModelCache(object):
+    """
+    Every row of a small model which rarely changes, kept in memory and looked up by a
+    unique field or by primary key
+
+    Rows are loaded on first use and again after invalidate() is called or ttl seconds have
+    passed, which bounds the time a change made by another process goes unnoticed. Keys not
+    found reload them too, but not more than once every min_reload seconds, so a stream of
+    unknown keys doesn't query the whole table for each one
+    """
+
+    def __init__(self, model, field, ttl, min_reload=0):
+        self.model = model
+        self.field = field
+        self.ttl = ttl
+        self.min_reload = min_reload
+        self._rows = None # (rows by field, rows by pk, load time)
+
+    def _get_rows(self, reload_if_cached=False):
+        rows = self._rows
+        if rows is None or reload_if_cached or time.time() - rows[2] > self.ttl:
+            objects = list(self.model.objects.all())
+            rows = (dict((getattr(obj, self.field), obj) for obj in objects),
+                    dict((obj.pk, obj) for obj in objects),
+                    time.time())
+            self._rows = rows
+        return rows
+
+    def _lookup(self, key, index):
+        rows = self._get_rows()
+        try:
+            return rows[index][key]
+        except KeyError:
+            pass
+
+        # It may have been created by another process
+        if time.time() - rows[2] >= self.min_reload:
+            rows = self._get_rows(reload_if_cached=True)
+        try:
+            return rows[index][key]
+        except KeyError:
+            raise self.model.DoesNotExist("%s matching %r does not exist" % (self.model.__name__, key))
+
+    def get(self, key):
+        """
+        Returns the object whose field value is key. Raises DoesNotExist as a query would
+        """
+        return self._lookup(key, 0)
+
+    def get_by_pk(self, pk):
+        return self._lookup(pk, 1)
+
+    def invalidate(self):
+        self._rows = None
+
+class TwoTierCache(object):
+    """
+    In-process LRUCache in front of a cache of Django's cache framework shared by every
+    worker (the CACHES alias given, if any). Values found in the shared cache are kept
+    in the local one too
+    """
+
+    def __init__(self, prefix, max_size, ttl, shared_cache_alias=None):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local = LRUCache(max_size, ttl=ttl)
+        self.shared_cache_alias = shared_cache_alias
+        self._shared = None
+        self.shared_hits = 0
+
+    @property
+    def shared(self):
+        if self._shared is None and self.shared_cache_alias:
+            from django.core.cache import get_cache
+            self._shared = get_cache(self.shared_cache_alias)
+        return self._shared
+
+    def _shared_key(self, key):
+        # Keys are hashed so that any string is a valid key for every cache backend
+        return self.prefix + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(self._shared_key(key))
+            if value is not None:
+                self.shared_hits += 1
+                self.local.set(key, value)
+                return value
+
+        return default
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(self._shared_key(key), value, self.ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(self._shared_key(key))
+
+    def clear(self):
+        """ Empties the local cache. The shared one is left as it is, other applications may use it """
+        self.local.clear()
+
+    def stats(self):
+        """
+        Returns a dict with the usage counters of both layers
+        """
+        local_stats = self.local.stats()
+        lookups = local_stats['hits'] + local_stats['misses']
+        hits = local_stats['hits'] + self.shared_hits
+        return {
+            'size': local_stats['size'],
+            'local_hits': local_stats['hits'],
+            'shared_hits': self.shared_hits,
+            'misses': lookups - hits,
+            'hit_rate': float(hits) / lookups if lookups else 0.0
+        }
+
+class CircuitBreaker(object):
+    """
+    Stops calls to a failing service. When at least min_calls calls were made in the last
+    window seconds and the ratio of them which failed reaches error_rate, no more calls are
+    allowed during cooldown seconds. Then it starts counting again
+
+    It is safe to use from several threads
+    """
+
+    def __init__(self, error_rate, min_calls, window, cooldown):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._calls = deque() # (time, failed)
+        self._open_until = 0
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self):
+        """
+        Checks if a call can be made now, counting it as rejected otherwise
+        """
+        with self._lock:
+            if time.time() < self._open_until:
+                self.rejected += 1
+                return False
+            return True
+
+    def record(self, failed):
+        """
+        Records the result of a call
+        """
+        with self._lock:
+            now = time.time()
+            if failed:
+                self.failures += 1
+            else:
+                self.successes += 1
+
+            self._calls.append((now, failed))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+
+            failed_calls = sum(1 for call_time, call_failed in self._calls if call_failed)
+            if len(self._calls) >= self.min_calls and failed_calls >= self.error_rate * len(self._calls):
+                self._open_until = now + self.cooldown
+                self._calls.clear()
+                self.trips += 1
+
+    def is_open(self):
+        return time.time() < self._open_until
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._open_until = 0
+
+    def stats(self):
+        return {
+            'open': self.is_open(),
+            'successes': self.successes,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'trips': self.trips
+        }
+
+class SingleFlight(object):
+    """
+    Runs a function only once at a time for each key. Threads which ask for a key whose call
+    is in flight wait for it to finish and get its result, or its exception, instead of
+    running it again
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function()
+            return call.result
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -17,7 +17,7 @@ import urlparse
 import json
 import simplejson
 
-from models import User, PageVisited, Search, CategorizedDomain, SITE_KEYWORD, METADATA_KEYWORD
+from models import User, PageVisited, Search, SITE_KEYWORD, METADATA_KEYWORD
 from invitation.models import InvitationKey
 import models_mongo
 import opendns
@@ -151,10 +151,10 @@ def page_visited(request):
     username = post_data['idUser']
 
     url_domain = urlparse.urlparse(url)[1]
-    categories = opendns.getCategories(url_domain)
+    categorized_domain, categories = opendns.get_categorized_domain(url_domain)
+    categories = [cat.name for cat in categories]
 
     user = User.objects.get(username=username)
-    categorized_domain = CategorizedDomain.objects.get(domain=url_domain)
     PageVisited.objects.create(user=user, page_visited=url, domain=categorized_domain)
     user.update_categories_visited(categories)
 
@@ -137,6 +137,39 @@ INSTALLED_APPS = (
 
 AUTH_USER_MODEL = "mnopi.User"
 
+# Html received from clients is saved raw and mined later by the mine_html command
+HTML_MINING_ASYNC = True
+
+# Html code and clean text of the pages visited are saved compressed in MongoDB.
+# Documents saved before can be compressed with the compress_html command
+HTML_COMPRESSED_STORAGE = True
+
+# Every different html is saved once, and mined once, in MongoDB's htmlContent
+# collection, which the pages visited with the same html reference by its hash
+HTML_DEDUPLICATION = True
+
+# Tokenizer of the texts whose keywords are counted: 'nltk' (word_tokenize) or 'regex',
+# several times faster and equal but for english contractions, which it does not split
+KEYWORDS_TOKENIZER = 'nltk'
+
+# Keywords frequencies of the pages and users are saved as sorted arrays of the ids the
+# keywords have in MongoDB's keywords collection and their counts, packed as binary data
+# (several times smaller, and added as arrays with numpy if it is installed). Frequencies
+# saved in either format are read whatever its value
+KEYWORDS_COMPACT_STORAGE = False
+
+# Domains not categorized yet are saved as pending and categorized later by the
+# resolve_domains command, so visits don't wait for OpenDNS
+OPENDNS_ASYNC_CATEGORIZATION = True
+
+# New sessions get tokens signed with SECRET_KEY, checked without querying client_sessions.
+# Tokens of both kinds are accepted whatever its value, so it can be switched at any time
+SIGNED_SESSION_TOKENS = False
+
+# Alias in CACHES of a cache shared by every worker where the categories of the domains are
+# kept, behind the cache of each worker. None to use only the latter
+DOMAINS_SHARED_CACHE = None
+
 LOGIN_URL = "/"
 
 # A sample logging configuration. The only tangible logging
@@ -0,0 +1,98 @@
+"""
+Compares the extraction of the clean text and properties of html pages done by
+mnopimining.html.get_html_features with the former one (unescaping the html twice,
+nltk.clean_html and a regular expression scan for each meta tag and property)
+
+The pages are read from the html files or directories given, or from the htmlVisited
+collection of MongoDB when --mongo is used:
+
+    python others/benchmarks/html_features.py ~/pages/*.html
+    python others/benchmarks/html_features.py --mongo 1000
+"""
+from HTMLParser import HTMLParser
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "mnopi"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mnopiBackend.settings")
+
+import nltk
+from mnopimining import html
+
+
+def former_get_html_metadata(html_code):
+    properties_list = {}
+    for tag in re.findall("<meta.*?>", html_code):
+        for property_name in html.RELEVANT_META_PROPERTIES:
+            match = re.compile("name.*?\"(.*?)\"").search(tag)
+            if match and match.groups()[0] == property_name:
+                match = re.compile("content.*?\"(.*?)\"").search(tag)
+                if match:
+                    properties_list[property_name] = match.groups()[0]
+                break
+    title_match = re.search("<title>(.*)</title>", html_code)
+    if title_match:
+        properties_list["title"] = title_match.groups()[0]
+    return properties_list
+
+def former_get_html_features(html_code):
+    clean_text = nltk.clean_html(HTMLParser().unescape(html_code))
+    properties = former_get_html_metadata(HTMLParser().unescape(html_code))
+    return clean_text, properties
+
+def read_files(paths):
+    pages = []
+    for path in paths:
+        if os.path.isdir(path):
+            pages.extend(read_files(os.path.join(path, name) for name in sorted(os.listdir(path))))
+        else:
+            with open(path) as html_file:
+                pages.append(html_file.read().decode("utf-8", "replace"))
+    return pages
+
+def read_mongo(limit):
+    import models_mongo
+    return [page["html_code"] for page in
+            models_mongo.db.htmlVisited.find({"html_code": {"$exists": True}}).limit(limit)]
+
+def run(function, pages, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        results = [function(page) for page in pages]
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="html files or directories of html files")
+    parser.add_argument("--mongo", type=int, metavar="LIMIT", help="read LIMIT pages from htmlVisited")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each extraction, the best is shown")
+    args = parser.parse_args()
+
+    pages = read_files(args.paths) if args.paths else []
+    if args.mongo:
+        pages.extend(read_mongo(args.mongo))
+    if not pages:
+        parser.error("no pages given")
+
+    megabytes = sum(len(page.encode("utf-8")) for page in pages) / (1024.0 * 1024)
+    print "%d pages, %.1f MB" % (len(pages), megabytes)
+
+    former_time, former_results = run(former_get_html_features, pages, args.repeat)
+    current_time, current_results = run(html.get_html_features, pages, args.repeat)
+    for name, elapsed in [("former", former_time), ("single pass", current_time)]:
+        print "%-12s %8.3f s %8.1f pages/s %6.2f MB/s" % (name, elapsed, len(pages) / elapsed, megabytes / elapsed)
+    print "speedup: %.2fx" % (former_time / current_time)
+
+    same_words = sum(1 for (former_text, former_properties), (text, properties)
+                     in zip(former_results, current_results) if former_text.split() == text.split())
+    print "pages with the same words: %d of %d" % (same_words, len(pages))
+
+if __name__ == "__main__":
+    main()
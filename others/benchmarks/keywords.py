@@ -0,0 +1,83 @@
+"""
+Measures the throughput, in MB of text per second, of counting the keywords of pages
+with keywords.get_freq_words and both tokenizers, compared with the former pipeline
+which built a list for every step
+
+The texts are the clean text of the html files or directories given, or the clean_html
+of the htmlVisited collection of MongoDB when --mongo is used:
+
+    python others/benchmarks/keywords.py ~/pages/*.html
+    python others/benchmarks/keywords.py --mongo 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "mnopi"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mnopiBackend.settings")
+
+from nltk import FreqDist
+from nltk.tokenize import word_tokenize
+from mnopimining import html, keywords
+
+
+def former_get_freq_words(text, language='english'):
+    tokenized_words = word_tokenize(text)
+    lower_tokenized_words = [token.lower() for token in tokenized_words]
+    no_punct_words = keywords.remove_punctuation(lower_tokenized_words)
+    no_stop_words = keywords.clean_stopwords(no_punct_words, language)
+    valid_words = keywords.clean_invalid_words(no_stop_words)
+    return FreqDist(valid_words)
+
+def read_files(paths):
+    texts = []
+    for path in paths:
+        if os.path.isdir(path):
+            texts.extend(read_files(os.path.join(path, name) for name in sorted(os.listdir(path))))
+        else:
+            with open(path) as html_file:
+                texts.append(html.get_html_features(html_file.read().decode("utf-8", "replace"))[0])
+    return texts
+
+def read_mongo(limit):
+    import models_mongo
+    return [models_mongo.HtmlVisitedDocument(page)["clean_html"] for page in
+            models_mongo.db.htmlVisited.find({"clean_html": {"$exists": True}}).limit(limit)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="html files or directories of html files")
+    parser.add_argument("--mongo", type=int, metavar="LIMIT", help="read LIMIT pages from htmlVisited")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each pipeline, the best is shown")
+    args = parser.parse_args()
+
+    texts = read_files(args.paths) if args.paths else []
+    if args.mongo:
+        texts.extend(read_mongo(args.mongo))
+    if not texts:
+        parser.error("no pages given")
+
+    megabytes = sum(len(text.encode("utf-8")) for text in texts) / (1024.0 * 1024)
+    print "%d texts, %.1f MB" % (len(texts), megabytes)
+
+    pipelines = [("former", former_get_freq_words),
+                 ("nltk", lambda text: keywords.get_freq_words(text, tokenizer='nltk')),
+                 ("regex", lambda text: keywords.get_freq_words(text, tokenizer='regex'))]
+    results = {}
+    for name, function in pipelines:
+        best = None
+        for i in range(args.repeat):
+            start = time.time()
+            results[name] = [function(text) for text in texts]
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print "%-8s %8.3f s %6.2f MB/s" % (name, best, megabytes / best)
+
+    for name in ("nltk", "regex"):
+        same = sum(1 for former, current in zip(results["former"], results[name]) if former == current)
+        print "%s: same keywords as the former pipeline in %d of %d texts" % (name, same, len(texts))
+
+if __name__ == "__main__":
+    main()
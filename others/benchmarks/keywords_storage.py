@@ -0,0 +1,81 @@
+"""
+Compares the keywords frequencies of pages saved as dicts with the compact storage of
+KEYWORDS_COMPACT_STORAGE (arrays of ids in the keywords vocabulary), in BSON size and in
+the time it takes to add them all into a user profile
+
+The texts are the clean text of the html files or directories given, or the clean_html
+of the htmlVisited collection of MongoDB when --mongo is used:
+
+    python others/benchmarks/keywords_storage.py ~/pages/*.html
+    python others/benchmarks/keywords_storage.py --mongo 1000
+
+The ids of the vocabulary are given in memory, MongoDB is only read with --mongo
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "mnopi"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mnopiBackend.settings")
+
+from bson import BSON
+from django.conf import settings
+from mnopimining import html, keywords
+import models_mongo
+
+
+def read_files(paths):
+    texts = []
+    for path in paths:
+        if os.path.isdir(path):
+            texts.extend(read_files(os.path.join(path, name) for name in sorted(os.listdir(path))))
+        else:
+            with open(path) as html_file:
+                texts.append(html.get_html_features(html_file.read().decode("utf-8", "replace"))[0])
+    return texts
+
+def read_mongo(limit):
+    return [models_mongo.HtmlVisitedDocument(page)["clean_html"] for page in
+            models_mongo.db.htmlVisited.find({"clean_html": {"$exists": True}}).limit(limit)]
+
+def add_all(keywords_freqs, compact):
+    settings.KEYWORDS_COMPACT_STORAGE = compact
+    start = time.time()
+    total = {}
+    for keywords_freq in keywords_freqs:
+        total = models_mongo.add_keywords_freqs(total, keywords_freq)
+    return total, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="html files or directories of html files")
+    parser.add_argument("--mongo", type=int, metavar="LIMIT", help="read LIMIT pages from htmlVisited")
+    args = parser.parse_args()
+
+    texts = read_files(args.paths) if args.paths else []
+    if args.mongo:
+        texts.extend(read_mongo(args.mongo))
+    if not texts:
+        parser.error("no pages given")
+
+    keywords_freqs = [dict(keywords.get_freq_words(text)) for text in texts]
+    vocabulary = set(keyword for keywords_freq in keywords_freqs for keyword in keywords_freq)
+    for keyword_id, keyword in enumerate(sorted(vocabulary)):
+        models_mongo.keywords_ids_cache.set(keyword, keyword_id)
+        models_mongo.keywords_cache.set(keyword_id, keyword)
+    packed_freqs = [models_mongo.pack_keywords_freq(keywords_freq) for keywords_freq in keywords_freqs]
+
+    print "%d texts, %d keywords (numpy %s)" % (len(texts), len(vocabulary),
+                                                "used" if models_mongo.numpy is not None else "not installed")
+    print "%-8s %12s %12s" % ("format", "BSON bytes", "add time s")
+    dicts_total, dicts_time = add_all(keywords_freqs, compact=False)
+    packed_total, packed_time = add_all(packed_freqs, compact=True)
+    for name, freqs, total, elapsed in [("dicts", keywords_freqs, dicts_total, dicts_time),
+                                        ("compact", packed_freqs, packed_total, packed_time)]:
+        print "%-8s %12d %12.3f" % (name, sum(len(BSON.encode({"text": freq})) for freq in freqs), elapsed)
+    print "same user keywords: %s" % (models_mongo.unpack_keywords_freq(packed_total) == dicts_total)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Compares the cost per page of removing stopwords with the former lists, which were
+built from the NLTK corpus for every word and scanned linearly, and with the frozen
+sets of keywords.STOPWORDS, as the stopword lists grow
+
+    python others/benchmarks/stopwords.py
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "mnopi"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from nltk.corpus import stopwords
+from mnopimining import keywords
+
+
+def former_clean_stopwords(words, english_stopwords, spanish_stopwords):
+    # stopwords.words() built a new list on every call, it is copied to keep that cost
+    return [word for word in words if word not in list(english_stopwords) and word not in spanish_stopwords]
+
+def make_page(words_number):
+    vocabulary = ([unicode(word, 'utf-8') for word in stopwords.words('spanish')[:50]] +
+                  [u"noticias", u"portada", u"deportes", u"economia", u"politica", u"cultura", u"hoy"])
+    return [random.choice(vocabulary) for i in range(words_number)]
+
+def time_per_page(function, page, repeat):
+    start = time.time()
+    for i in range(repeat):
+        function(page)
+    return (time.time() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--words", type=int, default=2000, help="words of each page")
+    parser.add_argument("--repeat", type=int, default=5, help="pages cleaned for each size")
+    args = parser.parse_args()
+
+    random.seed(0)
+    page = make_page(args.words)
+    english = list(stopwords.words('english'))
+    spanish = [unicode(word, 'utf-8') for word in stopwords.words('spanish')]
+
+    print "%10s %14s %14s" % ("stopwords", "former ms/page", "sets ms/page")
+    for padding in [0, 1000, 10000, 50000]:
+        extra = [u"relleno%d" % i for i in range(padding)]
+        english_stopwords, spanish_stopwords = english + extra, spanish + extra
+        stopword_sets = keywords.build_stopwords(english_stopwords) | keywords.build_stopwords(spanish_stopwords)
+
+        former = time_per_page(lambda words: former_clean_stopwords(words, english_stopwords, spanish_stopwords),
+                               page, args.repeat)
+        current = time_per_page(lambda words: [word for word in words if word not in stopword_sets],
+                                page, args.repeat)
+        print "%10d %14.3f %14.3f" % (len(english_stopwords) + len(spanish_stopwords), former * 1000, current * 1000)
+
+if __name__ == "__main__":
+    main()